@@ -0,0 +1,72 @@
+'''
+asyncio 中的并发提交和并发读取
+
+    python benchmarks/bench_async.py [COROUTINES]
+
+- commit：COROUTINES 个协程各写一个键并 commit，AsyncDBDB 把同时到达的
+  提交合并成一次存储提交
+- get：COROUTINES 个协程同时读取少数几个热点键，相同的读取只执行一次
+'''
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dbdb import AsyncDBDB
+
+TREE = 'balanced'
+ROUNDS = 10
+HOT_KEYS = 8
+
+async def bench_commit(db, coroutines):
+    async def writer(round, i):
+        await db.set('%02d-%06d' % (round, i), 'v' * 32)
+        await db.commit()
+    start = time.perf_counter()
+    for round in range(ROUNDS):
+        await asyncio.gather(*[writer(round, i) for i in range(coroutines)])
+    return ROUNDS * coroutines / (time.perf_counter() - start)
+
+async def bench_get(db, coroutines):
+    reads = [0]
+    read = db._read
+
+    def counting_read(key):
+        reads[0] += 1
+        return read(key)
+    db._read = counting_read
+    start = time.perf_counter()
+    for round in range(ROUNDS):
+        await asyncio.gather(*[db.get('%02d-%06d' % (round, i % HOT_KEYS))
+                               for i in range(coroutines)])
+    seconds = time.perf_counter() - start
+    return ROUNDS * coroutines / seconds, reads[0]
+
+async def run(path, coroutines):
+    async with AsyncDBDB(path, tree=TREE) as db:
+        commit_rate = await bench_commit(db, coroutines)
+        commits = db.commits
+        get_rate, reads = await bench_get(db, coroutines)
+    return commit_rate, commits, get_rate, reads
+
+def main(argv):
+    counts = [int(argv[1])] if len(argv) > 1 else [1, 10, 100, 1000]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%10s %12s %10s %10s %10s' % (
+            'coroutines', 'commits/s', 'commits', 'gets/s', 'reads'))
+        for coroutines in counts:
+            path = os.path.join(temp_dir, '%d.db' % coroutines)
+            commit_rate, commits, get_rate, reads = asyncio.run(
+                run(path, coroutines))
+            print('%10d %12.0f %10d %10.0f %10d' % (
+                coroutines, commit_rate, commits, get_rate, reads))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,55 @@
+'''
+批量写入事务与逐键提交的吞吐量对比
+
+    python benchmarks/bench_batch.py [N]
+
+- per-key commit：每个键 set 之后 commit，不 fsync（原有的提交方式）
+- per-key batch：每个键一个 with db.batch()，一次写入加一次 fsync
+- one batch：所有键放在一个 with db.batch() 中
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+def per_key_commit(db, keys):
+    for key in keys:
+        db[key] = 'v' * 32
+        db.commit()
+
+def per_key_batch(db, keys):
+    for key in keys:
+        with db.batch():
+            db[key] = 'v' * 32
+
+def one_batch(db, keys):
+    with db.batch():
+        for key in keys:
+            db[key] = 'v' * 32
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 2000
+    keys = ['%010d' % i for i in range(n)]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-16s %8s %12s %14s' % ('mode', 'n', 'keys/s', 'bytes/key'))
+        for load in [per_key_commit, per_key_batch, one_batch]:
+            path = os.path.join(temp_dir, load.__name__ + '.db')
+            db = dbdb.connect(path, tree='balanced')
+            start = time.perf_counter()
+            load(db, keys)
+            seconds = time.perf_counter() - start
+            db.close()
+            size = os.path.getsize(path) - 4096
+            print('%-16s %8d %12.0f %14.1f' % (
+                load.__name__.replace('_', ' '), n, n / seconds, size / n))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,53 @@
+'''
+布隆过滤器：不存在的键的查找延迟和误判率
+
+    python benchmarks/bench_bloom.py [N]
+
+数据库中有 N 个键，再查找 N 个不存在的键。节点缓存关闭，每次查找
+都从磁盘读取节点。误判率是过滤器认为可能存在、实际不存在的比例。
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+from dbdb.logical import _bloom_key
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 20000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-10s %-6s %8s %14s %10s' % (
+            'tree', 'bloom', 'n', 'miss us/op', 'fp rate'))
+        for tree in ['balanced', 'bplus']:
+            path = os.path.join(temp_dir, tree + '.db')
+            dbdb.bulk_load(path, (('%010d' % (2 * i), 'v') for i in range(n)),
+                           tree=tree)
+            db = dbdb.connect(path, tree=tree, bloom=True)
+            # 提交一次，为已有的树生成过滤器
+            db.commit()
+            db.close()
+            misses = ['%010d' % (2 * i + 1) for i in range(n)]
+            for bloom in [False, True]:
+                db = dbdb.connect(path, tree=tree, cache_size=0, bloom=bloom)
+                start = time.perf_counter()
+                for key in misses:
+                    key in db
+                seconds = time.perf_counter() - start
+                fp_rate = ''
+                if bloom:
+                    filter_ = db._tree._bloom
+                    fp = sum(_bloom_key(key) in filter_ for key in misses)
+                    fp_rate = '%.2f%%' % (100.0 * fp / n)
+                db.close()
+                print('%-10s %-6s %8d %14.1f %10s' % (
+                    tree, bloom, n, seconds / n * 1e6, fp_rate))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
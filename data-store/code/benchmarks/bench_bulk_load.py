@@ -0,0 +1,56 @@
+'''
+有序导入：逐键插入与 bulk_load 的对比
+
+    python benchmarks/bench_bulk_load.py [N]
+
+- one batch：所有键在一个 with db.batch() 中逐个 db[key] = value，
+  朴素二叉树退化成链表，跳过
+- bulk load：dbdb.bulk_load 自底向上构建，传入生成器，不给出长度
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+def one_batch(path, tree, keys):
+    db = dbdb.connect(path, tree=tree)
+    with db.batch():
+        for key in keys:
+            db[key] = 'v' * 32
+    db.close()
+
+def bulk_load(path, tree, keys):
+    dbdb.bulk_load(path, ((key, 'v' * 32) for key in keys), tree=tree)
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 20000
+    keys = ['%010d' % i for i in range(n)]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-10s %-12s %8s %12s %14s' % (
+            'tree', 'mode', 'n', 'keys/s', 'bytes/key'))
+        for tree in ['binary', 'balanced', 'bplus']:
+            for load in [one_batch, bulk_load]:
+                if tree == 'binary' and load is one_batch:
+                    # 顺序插入时朴素二叉树退化成链表，插入是 O(n^2)，提交时
+                    # 递归写入节点的深度也是 n，几百个键就超过递归限制
+                    print('%-10s %-12s %8d %12s' % (tree, 'one batch', n, 'skipped'))
+                    continue
+                path = os.path.join(temp_dir, tree + load.__name__ + '.db')
+                start = time.perf_counter()
+                load(path, tree, keys)
+                seconds = time.perf_counter() - start
+                size = os.path.getsize(path) - 4096
+                print('%-10s %-12s %8d %12.0f %14.1f' % (
+                    tree, load.__name__.replace('_', ' '), n, n / seconds,
+                    size / n))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,61 @@
+'''
+值编码：大 JSON 值在各种编码下的文件大小和读写速度
+
+    python benchmarks/bench_codecs.py [N]
+
+每个值是约 8KB 的 JSON 文本。keys 一列是只遍历键的速度，不解码值。
+'''
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+def make_value(i):
+    return json.dumps({
+        'id': i,
+        'events': [{'type': 'click', 'x': j % 640, 'y': j % 480,
+                    'target': 'button-%d' % (j % 17)} for j in range(120)],
+    })
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 2000
+    values = [make_value(i) for i in range(n)]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-8s %12s %10s %10s %12s' % (
+            'codec', 'bytes/value', 'writes/s', 'reads/s', 'keys/s'))
+        for codec in ['utf-8', 'pickle', 'zlib', 'lzma']:
+            path = os.path.join(temp_dir, codec + '.db')
+            db = dbdb.connect(path, tree='bplus', codec=codec)
+            start = time.perf_counter()
+            with db.batch():
+                for i, value in enumerate(values):
+                    db['%08d' % i] = value
+            write_seconds = time.perf_counter() - start
+            db.close()
+            size = os.path.getsize(path) - 4096
+
+            db = dbdb.connect(path, tree='bplus')
+            start = time.perf_counter()
+            for key, value in db.items():
+                pass
+            read_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            for key in db.keys():
+                pass
+            key_seconds = time.perf_counter() - start
+            db.close()
+            print('%-8s %12.0f %10.0f %10.0f %12.0f' % (
+                codec, size / n, n / write_seconds, n / read_seconds,
+                n / key_seconds))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
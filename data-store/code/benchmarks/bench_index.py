@@ -0,0 +1,78 @@
+'''
+二级索引：按值中的字段查找与全表扫描对比
+
+    python benchmarks/bench_index.py [RECORDS]
+
+每条记录的值是 {'email': ..., 'group': ...}，按 email 查找：
+
+- scan：遍历所有记录比较 email
+- index：create_index('by_email') 之后用 find 查找
+
+同时给出维护索引时批量写入的速度。
+'''
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+TREE = 'bplus'
+LOOKUPS = 200
+BATCH = 1000
+
+def by_email(value):
+    return value['email']
+
+def record(i):
+    return {'email': 'user%d@example.com' % i, 'group': i % 10}
+
+def load(path, records, index):
+    db = dbdb.connect(path, tree=TREE, codec='pickle')
+    if index:
+        db.create_index('by_email', by_email)
+    start = time.perf_counter()
+    for first in range(0, records, BATCH):
+        with db.batch():
+            for i in range(first, min(records, first + BATCH)):
+                db['%08d' % i] = record(i)
+    seconds = time.perf_counter() - start
+    db.close()
+    return records / seconds
+
+def lookup(path, records, index):
+    db = dbdb.connect(path, tree=TREE, codec='pickle')
+    emails = [record(i)['email'] for i in random.sample(range(records), LOOKUPS)]
+    start = time.perf_counter()
+    if index:
+        db.create_index('by_email', by_email)
+        for email in emails:
+            list(db.find('by_email', email))
+    else:
+        for email in emails:
+            [key for key, value in db.items() if value['email'] == email]
+    seconds = time.perf_counter() - start
+    db.close()
+    return LOOKUPS / seconds
+
+def main(argv):
+    records = int(argv[1]) if len(argv) > 1 else 10000
+    random.seed(0)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-6s %12s %12s' % ('mode', 'writes/s', 'lookups/s'))
+        for index in [False, True]:
+            path = os.path.join(temp_dir, '%s.db' % index)
+            writes = load(path, records, index)
+            lookups = lookup(path, records, index)
+            print('%-6s %12.0f %12.1f' % (
+                'index' if index else 'scan', writes, lookups))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,49 @@
+'''
+节点编码的大小和解码速度：pickle（格式版本 0）与定长结构（格式版本 1）
+
+    python benchmarks/bench_node_encoding.py [N]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dbdb.avl_tree import AVLNode, AVLNodeRef, PackedAVLNodeRef
+from dbdb.binary_tree import BinaryNode, BinaryNodeRef, PackedBinaryNodeRef
+from dbdb.logical import ValueRef
+
+def make_nodes(n):
+    binary = []
+    avl = []
+    for i in range(n):
+        args = (BinaryNodeRef(address=4096 + i * 64), '%010d' % i,
+                ValueRef(address=4096 + i * 64 + 32),
+                BinaryNodeRef(address=4096 + i * 64 + 48), i + 1)
+        binary.append(BinaryNode(*args))
+        avl.append(AVLNode(*args + (i % 20, i % 21)))
+    return binary, avl
+
+def measure(ref_class, nodes):
+    strings = [ref_class.referent_to_string(node) for node in nodes]
+    start = time.perf_counter()
+    for string in strings:
+        ref_class.string_to_referent(string)
+    elapsed = time.perf_counter() - start
+    size = sum(len(s) for s in strings) / len(strings)
+    return size, len(strings) / elapsed
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 100000
+    binary, avl = make_nodes(n)
+    print('%-22s %12s %14s' % ('encoding', 'bytes/node', 'decodes/s'))
+    for name, ref_class, nodes in [
+            ('binary pickle', BinaryNodeRef, binary),
+            ('binary packed', PackedBinaryNodeRef, binary),
+            ('avl pickle', AVLNodeRef, avl),
+            ('avl packed', PackedAVLNodeRef, avl)]:
+        size, rate = measure(ref_class, nodes)
+        print('%-22s %12.1f %14.0f' % (name, size, rate))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,51 @@
+'''
+分片存储的写入吞吐量
+
+    python benchmarks/bench_sharded.py [KEYS]
+
+每次提交写入 BATCH 个随机的键，比较单个文件和 2、4、8 个分片。分片的
+写入和 fsync 在不同的进程中并行进行，吞吐量随 CPU 核数增长。
+'''
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+from dbdb import ShardedDBDB
+
+TREE = 'bplus'
+BATCH = 1000
+
+def write(db, keys):
+    start = time.perf_counter()
+    for first in range(0, len(keys), BATCH):
+        for key in keys[first:first + BATCH]:
+            db[key] = 'v' * 32
+        db.commit()
+    return len(keys) / (time.perf_counter() - start)
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    random.seed(0)
+    keys = ['%010d' % random.randrange(10 ** 10) for _ in range(count)]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('cpus: %d' % os.cpu_count())
+        print('%-8s %12s' % ('shards', 'writes/s'))
+        db = dbdb.connect(os.path.join(temp_dir, 'single.db'), tree=TREE)
+        print('%-8s %12.0f' % ('file', write(db, keys)))
+        db.close()
+        for shards in [2, 4, 8]:
+            directory = os.path.join(temp_dir, 'sharded-%d' % shards)
+            with ShardedDBDB(directory, shards=shards, tree=TREE) as db:
+                print('%-8d %12.0f' % (shards, write(db, keys)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
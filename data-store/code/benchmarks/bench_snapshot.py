@@ -0,0 +1,88 @@
+'''
+多进程并发读取：一个写入者不断提交，若干读者同时读取
+
+    python benchmarks/bench_snapshot.py [SECONDS]
+
+写入者每次提交都把 x 和 y 更新为同一个新的版本号。读者每次读取 x 和 y：
+
+- plain：直接 db['x']、db['y']，两次读取可能跨越一次提交（torn）
+- snapshot：在 with db.snapshot() 中读取，两个值总是来自同一个版本
+
+读者都不加锁，报告所有读者合计的读取次数和 torn 的比例。
+'''
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+TREE = 'balanced'
+
+def writer(path, seconds):
+    db = dbdb.connect(path, tree=TREE)
+    deadline = time.time() + seconds
+    generation = 0
+    while time.time() < deadline:
+        generation += 1
+        db['x'] = str(generation)
+        db['y'] = str(generation)
+        db.commit()
+    db.close()
+
+def reader(path, seconds, mode, results):
+    db = dbdb.connect(path, tree=TREE)
+    deadline = time.time() + seconds
+    reads = torn = 0
+    while time.time() < deadline:
+        if mode == 'snapshot':
+            with db.snapshot() as snap:
+                x, y = snap['x'], snap['y']
+        else:
+            x, y = db['x'], db['y']
+        reads += 1
+        if x != y:
+            torn += 1
+    db.close()
+    results.put((reads, torn))
+
+def run(path, seconds, mode, readers):
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=writer, args=(path, seconds))]
+    procs += [multiprocessing.Process(target=reader,
+                                      args=(path, seconds, mode, results))
+              for _ in range(readers)]
+    for p in procs:
+        p.start()
+    totals = [results.get() for _ in range(readers)]
+    for p in procs:
+        p.join()
+    reads = sum(r for r, t in totals)
+    torn = sum(t for r, t in totals)
+    return reads / seconds, torn / max(reads, 1)
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 2.0
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'bench.db')
+        dbdb.bulk_load(path, (('%06d' % i, 'v') for i in range(10000)),
+                       tree=TREE)
+        db = dbdb.connect(path, tree=TREE)
+        db['x'] = db['y'] = '0'
+        db.commit()
+        db.close()
+        print('%-10s %8s %14s %8s' % ('mode', 'readers', 'pair reads/s', 'torn'))
+        for mode in ['plain', 'snapshot']:
+            for readers in [1, 2, 4]:
+                rate, torn = run(path, seconds, mode, readers)
+                print('%-10s %8d %14.0f %7.2f%%' % (mode, readers, rate, torn * 100))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,75 @@
+'''
+顺序插入时二叉树、AVL 树与 B+ 树的查找深度对比
+
+    python benchmarks/bench_tree_depth.py
+
+对每种树顺序写入 n 个键并提交，然后关闭节点缓存统计一次查找平均需要
+多少次 Storage.read，也就是查找路径上从磁盘读取的节点数，最后打开缓存
+测量查找速度。
+'''
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+# 朴素二叉树顺序插入会退化成链表，递归深度限制了它能测试的规模
+SIZES = {
+    'binary': [64, 128, 256],
+    'balanced': [64, 128, 256, 1024, 4096, 16384],
+    'bplus': [64, 1024, 16384, 131072],
+}
+
+def measure(tree, n, temp_dir):
+    path = os.path.join(temp_dir, '%s-%d.db' % (tree, n))
+    db = dbdb.connect(path, tree=tree)
+    start = time.perf_counter()
+    for i in range(n):
+        db['%010d' % i] = 'v'
+    db.commit()
+    insert_seconds = time.perf_counter() - start
+    db.close()
+
+    db = dbdb.connect(path, tree=tree, cache_size=0)
+    storage = db._storage
+    reads = [0]
+    read = storage.read
+
+    def counting_read(address):
+        reads[0] += 1
+        return read(address)
+
+    storage.read = counting_read
+    for i in range(n):
+        db['%010d' % i]
+    db.close()
+
+    db = dbdb.connect(path, tree=tree)
+    start = time.perf_counter()
+    for i in range(n):
+        db['%010d' % i]
+    get_seconds = time.perf_counter() - start
+    db.close()
+    # 每次查找还会读取一次值
+    return reads[0] / n - 1, n / insert_seconds, n / get_seconds
+
+def main():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-9s %7s %9s %9s %12s %12s' % (
+            'tree', 'n', 'depth', 'log2(n)', 'insert/s', 'get/s'))
+        for tree, sizes in sorted(SIZES.items()):
+            for n in sizes:
+                depth, insert_rate, get_rate = measure(tree, n, temp_dir)
+                print('%-9s %7d %9.2f %9.2f %12.0f %12.0f' % (
+                    tree, n, depth, math.log2(n), insert_rate, get_rate))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
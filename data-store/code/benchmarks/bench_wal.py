@@ -0,0 +1,62 @@
+'''
+多个线程并发提交小事务：WAL 与逐次 fsync 的树提交对比
+
+    python benchmarks/bench_wal.py [COMMITS_PER_THREAD]
+
+每个线程使用自己的连接，每次提交写入一个键：
+
+- tree：with db.batch()，每次提交重写树的路径并 fsync
+- wal：connect(wal=True)，每次提交追加一条日志记录，同时提交的线程共用 fsync
+'''
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbdb
+
+TREE = 'balanced'
+
+def worker(db, thread_id, commits):
+    for i in range(commits):
+        with db.batch():
+            db['%02d-%06d' % (thread_id, i)] = 'v' * 32
+
+def run(path, threads, commits, wal):
+    dbs = [dbdb.connect(path, tree=TREE, wal=wal) for _ in range(threads)]
+    fsyncs = dbs[0]._wal.fsyncs if wal else None
+    workers = [threading.Thread(target=worker, args=(db, i, commits))
+               for i, db in enumerate(dbs)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    seconds = time.perf_counter() - start
+    if wal:
+        fsyncs = dbs[0]._wal.fsyncs - fsyncs
+    for db in dbs:
+        db.close()
+    return threads * commits / seconds, fsyncs
+
+def main(argv):
+    commits = int(argv[1]) if len(argv) > 1 else 200
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%-6s %8s %12s %14s' % ('mode', 'threads', 'commits/s', 'fsync/commit'))
+        for wal in [False, True]:
+            for threads in [1, 4, 16]:
+                path = os.path.join(temp_dir, '%s-%d.db' % (wal, threads))
+                rate, fsyncs = run(path, threads, commits, wal)
+                per_commit = 1.0 if fsyncs is None else fsyncs / (threads * commits)
+                print('%-6s %8d %12.0f %14.2f' % (
+                    'wal' if wal else 'tree', threads, rate, per_commit))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
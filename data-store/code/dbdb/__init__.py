@@ -1,16 +1,169 @@
 import os
+import pickle
+import tempfile
 
+from dbdb.async_interface import AsyncDBDB
 from dbdb.interface import DBDB
+from dbdb.sharded import ShardedDBDB
+from dbdb.wal import WriteAheadLog
 
 # 指定能被其它模块引用的函数、类等
-__all__ = ['DBDB', 'connect']
+__all__ = ['DBDB', 'AsyncDBDB', 'ShardedDBDB', 'connect', 'compact', 'bulk_load']
 
-def connect(dbname):
+def connect(dbname, tree=None, cache_size=1024, mmap=False, wal=False,
+            bloom=False, codec=None):
     '''连接数据库，其实就是打开本地文件
+
+    tree 选择逻辑层实现：'binary' 为朴素二叉树，'balanced' 为 AVL 树，
+    'bplus' 为高扇出的 B+ 树。
+    树的类型记录在文件头中，为 None 时使用记录的类型，新文件默认为
+    'binary'；非空的文件用别的树打开时抛出 ValueError。
+    cache_size 是已解码节点的 LRU 缓存容量，为 0 时不缓存。
+    mmap 为 True 时通过内存映射读取节点，读多写少时可以省去大部分系统调用。
+    wal 为 True 时使用预写日志，提交只追加一条日志记录，后台定期合并进树。
+    bloom 为 True 时每次提交都为新根写入布隆过滤器，不存在的键不必读取节点。
+    codec 是值的编码（见 ValueRef.codecs），记录在文件头中：'utf-8'（默认）、
+    'raw'、'pickle'、'zlib' 或 'lzma'，为 None 时使用文件中记录的编码。
+
+    dbname-wal 存在时（上次没有正常关闭），先重放其中的记录。
     '''
     try:
         f = open(dbname, 'r+b')
     except IOError:
         fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
         f = os.fdopen(fd, 'r+b')
-    return DBDB(f)
\ No newline at end of file
+    log = None
+    if wal or os.path.exists(dbname + '-wal'):
+        try:
+            log = WriteAheadLog.acquire(dbname + '-wal', lambda: DBDB(
+                open(dbname, 'r+b'), tree=tree, bloom=bloom, codec=codec
+            ))
+        except RuntimeError:
+            # 日志正被其他进程使用，不是 WAL 模式时直接读写树
+            if wal:
+                f.close()
+                raise
+        if not wal and log is not None:
+            log.release()
+            log = None
+    return DBDB(f, tree=tree, cache_size=cache_size, mmap=mmap, wal=log,
+                bloom=bloom, codec=codec)
+
+def compact(src, dst=None, tree=None, codec=None):
+    '''压缩数据库文件
+
+    只复制当前根可达的键值，按键的顺序重新构建一棵平衡的树写入 dst。
+    复制期间持有 src 的写锁，其他写入者需要等待，读者不受影响。
+
+    dst 为 None 时先写入同一目录下的临时文件，再原子地替换 src。已经打开
+    src 的读者继续读取旧文件，重新连接后看到新文件；旧文件上的写入者再次
+    加锁时会得到 RuntimeError，需要重新连接。
+
+    src 带有布隆过滤器时，为压缩后的树重建一个只包含现存键的过滤器。
+    codec 为 None 时沿用 src 的值编码，也可以指定新的编码重新编码所有值。
+    tree 为 None 时沿用 src 的树。
+    '''
+    db = connect(src, tree=tree)
+    try:
+        if tree is None:
+            tree = db._storage.tree or 'binary'
+        db._storage.lock()
+        db._tree._refresh_tree_ref()
+        bloom = db._storage.get_bloom_address() != 0
+        if codec is None:
+            codec = db._tree.value_ref_class.codec
+        target_name = src + '.compact' if dst is None else dst
+        try:
+            f = open(target_name, 'w+b')
+            target = DBDB(f, tree=tree, bloom=bloom, codec=codec)
+            try:
+                target._tree.load(db._tree.items(), len(db._tree))
+                target.commit()
+                os.fsync(f.fileno())
+            finally:
+                target.close()
+            if dst is None:
+                os.replace(target_name, src)
+        finally:
+            # 失败时不留下临时文件
+            if dst is None and os.path.exists(target_name):
+                os.remove(target_name)
+    finally:
+        db.close()
+
+def bulk_load(dbname, items, length=None, tree='binary', codec=None):
+    '''用按键严格递增的 (键, 值) 创建新的数据库
+
+    自底向上构建一棵平衡的树，每个节点只写一次，n 条记录只需要 O(n) 次
+    写入，内存中只保留构建中的路径。dbname 必须不存在或为空文件。
+
+    构建二叉树需要预先知道记录数：length 为 None 且 items 没有长度时，
+    先把记录依次写入临时文件计数，再读回构建。B+ 树逐层流式构建，不需要
+    记录数。键不是严格递增或记录数与 length 不符时抛出 ValueError，
+    dbname 保持不变。
+    '''
+    if os.path.exists(dbname) and os.path.getsize(dbname) > 0:
+        raise ValueError('%s already exists' % dbname)
+    if length is None and hasattr(items, '__len__'):
+        length = len(items)
+    spool = None
+    target_name = dbname + '.load'
+    try:
+        if length is None and tree != 'bplus':
+            spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(dbname)))
+            length = 0
+            for item in _check_sorted(items):
+                pickle.dump(item, spool, pickle.HIGHEST_PROTOCOL)
+                length += 1
+            spool.seek(0)
+            items = (pickle.load(spool) for _ in range(length))
+        else:
+            items = _check_sorted(items)
+        f = open(target_name, 'w+b')
+        target = DBDB(f, tree=tree, codec=codec)
+        try:
+            items = _check_length(items, length)
+            target._tree.load(items, length)
+            # 二叉树只取 length 项，多出的记录在这里报错
+            for _ in items:
+                pass
+            target.commit()
+            os.fsync(f.fileno())
+        finally:
+            target.close()
+        os.replace(target_name, dbname)
+    finally:
+        if spool is not None:
+            spool.close()
+        if os.path.exists(target_name):
+            os.remove(target_name)
+
+def _check_sorted(items):
+    '''逐项检查键严格递增
+    '''
+    items = iter(items)
+    for prev_key, value in items:
+        yield prev_key, value
+        break
+    for key, value in items:
+        if not prev_key < key:
+            raise ValueError(
+                'bulk_load keys must be strictly increasing: %r after %r'
+                % (key, prev_key)
+            )
+        yield key, value
+        prev_key = key
+
+def _check_length(items, length):
+    '''检查记录数与 length 一致，length 为 None 时不检查
+    '''
+    count = 0
+    for item in items:
+        count += 1
+        if length is not None and count > length:
+            raise ValueError('bulk_load got more than %d items' % length)
+        yield item
+    if length is not None and count < length:
+        raise ValueError(
+            'bulk_load expected %d items, got %d' % (length, count)
+        )
@@ -0,0 +1,245 @@
+'''
+asyncio 接口
+
+DBDB 的读写都会阻塞在文件 I/O 和 flock 上，直接在事件循环中调用会卡住
+所有协程。AsyncDBDB 把存储操作交给线程执行：读取在有界的线程池中进行，
+每个线程有自己的连接；写入只有一个线程和一个连接。
+
+set 和 delete 只修改内存中的待提交修改，commit 时在写线程中作为一个批量
+事务写入。正在等待的提交会合并：一次提交进行时到达的所有 commit 共享
+下一次存储提交。同时读取同一个键的协程共享一次读取。
+'''
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import dbdb
+from dbdb.interface import Snapshot
+from dbdb.wal import TOMBSTONE
+
+# 待提交的修改中没有这个键
+_MISSING = object()
+
+class AsyncDBDB(object):
+    """DBDB 的 asyncio 包装
+
+    readers 是读线程的数量，其余参数传给 dbdb.connect。读取看到的是最近
+    一次提交的内容加上本对象尚未提交的修改。
+    """
+
+    def __init__(self, dbname, readers=4, **kwargs):
+        self._dbname = dbname
+        self._kwargs = kwargs
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._readers = ThreadPoolExecutor(max_workers=readers)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._db = None
+        # 尚未提交的修改，以及正在写入的那一组修改
+        self._pending = {}
+        self._flushing = {}
+        # 正在进行的读取，键到 future
+        self._reads = {}
+        self._commit_future = None
+        self._commit_lock = None
+        self.commits = 0
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _connect(self):
+        db = dbdb.connect(self._dbname, **self._kwargs)
+        with self._connections_lock:
+            self._connections.append(db)
+        return db
+
+    def _reader(self):
+        """当前读线程的连接
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def _assert_not_closed(self):
+        if self.closed:
+            raise ValueError('Database closed.')
+
+    def _pending_value(self, key):
+        value = self._pending.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._flushing.get(key, _MISSING)
+        return value
+
+    async def _run(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def _read(self, key):
+        return self._reader()[key]
+
+    async def get(self, key):
+        """读取 key 的值，不存在时抛出 KeyError
+        """
+        self._assert_not_closed()
+        value = self._pending_value(key)
+        if value is TOMBSTONE:
+            raise KeyError(key)
+        if value is not _MISSING:
+            return value
+        future = self._reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(self._readers, self._read, key))
+            self._reads[key] = future
+
+            def done(future):
+                if self._reads.get(key) is future:
+                    del self._reads[key]
+            future.add_done_callback(done)
+        # 某个等待者被取消时，不影响共享这次读取的其他协程
+        return await asyncio.shield(future)
+
+    async def contains(self, key):
+        """判断 key 是否存在
+        """
+        self._assert_not_closed()
+        value = self._pending_value(key)
+        if value is not _MISSING:
+            return value is not TOMBSTONE
+        return await self._run(self._readers, self._contains, key)
+
+    def _contains(self, key):
+        return key in self._reader()
+
+    async def set(self, key, value):
+        """修改 key 的值，commit 之后才写入文件
+        """
+        self._assert_not_closed()
+        self._pending[key] = value
+
+    async def delete(self, key):
+        """删除 key，不存在时抛出 KeyError
+        """
+        if not await self.contains(key):
+            raise KeyError(key)
+        self._pending[key] = TOMBSTONE
+
+    async def commit(self):
+        """提交此前所有的修改
+
+        已经有提交在等待时直接加入它，同一组的修改在一个批量事务中写入，
+        只做一次存储提交。
+        """
+        self._assert_not_closed()
+        future = self._commit_future
+        if future is None:
+            future = self._commit_future = asyncio.get_running_loop().create_future()
+            asyncio.ensure_future(self._flush(future))
+        await asyncio.shield(future)
+
+    async def _flush(self, future):
+        if self._commit_lock is None:
+            self._commit_lock = asyncio.Lock()
+        async with self._commit_lock:
+            # 从这里开始到达的 commit 进入下一组
+            self._commit_future = None
+            self._flushing, self._pending = self._pending, {}
+            try:
+                if self._flushing:
+                    await self._run(self._writer, self._apply, self._flushing)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+            finally:
+                self._flushing = {}
+                # 提交之前开始的读取可能返回旧值，之后的读取不再共享它们
+                self._reads = {}
+
+    def _apply(self, changes):
+        """在写线程中把一组修改作为一个事务写入
+        """
+        if self._db is None:
+            self._db = self._connect()
+        with self._db.batch():
+            for key, value in changes.items():
+                if value is TOMBSTONE:
+                    try:
+                        del self._db[key]
+                    except KeyError:
+                        pass
+                else:
+                    self._db[key] = value
+        self.commits += 1
+
+    def _read_range(self, start, stop, reverse, overlay, root_address, limit):
+        """在读线程中读取一段，返回 (项, 根地址, 覆盖层)
+
+        第一段记下根地址和 WAL 中的修改，后续各段从同一个根开始读取。
+        """
+        db = self._reader()
+        tree = db._tree
+        if root_address is None:
+            if db._wal is not None:
+                base, root_ref = db._wal.view(tree)
+                base.update(overlay)
+                overlay = base
+            else:
+                root_ref = tree.snapshot()
+        else:
+            root_ref = tree.node_ref_class(address=root_address)
+        snap = Snapshot(tree, root_ref, overlay)
+        items = list(islice(snap.range(start, stop, reverse), limit))
+        return items, root_ref.address, overlay
+
+    async def range(self, start=None, stop=None, reverse=False, chunk_size=100):
+        """按顺序遍历 start <= 键 < stop 的 (键, 值)，用 async for 迭代
+
+        每次在读线程中读取 chunk_size 项，整个遍历固定在开始时的版本上。
+        """
+        self._assert_not_closed()
+        chunk_size = max(2, chunk_size)
+        overlay = dict(self._flushing)
+        overlay.update(self._pending)
+        root_address = None
+        last_key = _MISSING
+        while True:
+            items, root_address, overlay = await self._run(
+                self._readers, self._read_range, start, stop, reverse, overlay,
+                root_address, chunk_size
+            )
+            # 正序时下一段从上一段的最后一个键开始，跳过这个已经返回的键
+            skip = last_key is not _MISSING and items and not (
+                items[0][0] < last_key or last_key < items[0][0])
+            for item in items[1:] if skip else items:
+                yield item
+            if len(items) < chunk_size:
+                return
+            last_key = items[-1][0]
+            if reverse:
+                stop = last_key
+                last_key = _MISSING
+            else:
+                start = last_key
+
+    async def close(self):
+        """关闭所有连接，尚未提交的修改被丢弃
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._pending = {}
+        self._writer.shutdown(wait=False)
+        self._readers.shutdown(wait=False)
+        await self._run(None, self._close)
+
+    def _close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        for db in self._connections:
+            db.close()
@@ -0,0 +1,205 @@
+import pickle
+import struct
+
+from dbdb.binary_tree import BinaryNode, BinaryNodeRef, BinaryTree
+from dbdb.logical import ValueRef, pack_key, unpack_key
+
+class AVLNode(BinaryNode):
+    """AVL 树节点，额外记录左右子树的高度
+    """
+    @classmethod
+    def from_node(cls, node, **kwargs):
+        """根据旧节点生成新节点，替换了子树时同时更新对应的高度
+        """
+        new_node = super(AVLNode, cls).from_node(node, **kwargs)
+        if 'left_ref' in kwargs:
+            new_node.left_height = kwargs['left_ref'].height
+        else:
+            new_node.left_height = node.left_height
+        if 'right_ref' in kwargs:
+            new_node.right_height = kwargs['right_ref'].height
+        else:
+            new_node.right_height = node.right_height
+        return new_node
+
+    def __init__(self, left_ref, key, value_ref, right_ref, length,
+                 left_height=0, right_height=0):
+        super(AVLNode, self).__init__(left_ref, key, value_ref, right_ref, length)
+        # 子树高度保存在父节点中，重新计算高度时不必读取兄弟节点
+        self.left_height = left_height
+        self.right_height = right_height
+
+    @property
+    def height(self):
+        """以该节点为根的子树高度
+        """
+        return 1 + max(self.left_height, self.right_height)
+
+    @property
+    def balance(self):
+        """平衡因子，右子树高度减去左子树高度
+        """
+        return self.right_height - self.left_height
+
+class AVLNodeRef(BinaryNodeRef):
+    """AVL 树节点的引用
+    """
+    @property
+    def height(self):
+        """子树高度
+        """
+        if self._referent is None and self._address:
+            raise RuntimeError('Asking for AVLNodeRef height of unloaded node')
+        if self._referent:
+            return self._referent.height
+        else:
+            return 0
+
+    @staticmethod
+    def referent_to_string(referent):
+        """将节点序列化
+        """
+        return pickle.dumps({
+            'left': referent.left_ref.address,
+            'key': referent.key,
+            'value': referent.value_ref.address,
+            'right': referent.right_ref.address,
+            'length': referent.length,
+            'left_height': referent.left_height,
+            'right_height': referent.right_height,
+        })
+
+    @staticmethod
+    def string_to_referent(string):
+        """将序列化数据还原为节点对象
+        """
+        d = pickle.loads(string)
+        return AVLNode(
+            AVLNodeRef(address=d['left']),
+            d['key'],
+            ValueRef(address=d['value']),
+            AVLNodeRef(address=d['right']),
+            d['length'],
+            d['left_height'],
+            d['right_height']
+        )
+
+    @classmethod
+    def copy_referent(cls, referent):
+        """复制缓存中的节点，子节点和值的引用只保留地址
+        """
+        return AVLNode(
+            cls(address=referent.left_ref.address),
+            referent.key,
+            ValueRef(address=referent.value_ref.address),
+            cls(address=referent.right_ref.address),
+            referent.length,
+            referent.left_height,
+            referent.right_height
+        )
+
+class PackedAVLNodeRef(AVLNodeRef):
+    """用定长结构编码 AVL 节点的引用，文件格式版本 1 使用
+
+    在 PackedBinaryNodeRef 的布局上增加左右子树的高度（uint8）。
+    """
+    NODE_STRUCT = struct.Struct("!QQQQBBB")
+
+    @staticmethod
+    def referent_to_string(referent):
+        """将节点编码为定长结构加键的字节
+        """
+        key_type, key = pack_key(referent.key)
+        return PackedAVLNodeRef.NODE_STRUCT.pack(
+            referent.left_ref.address,
+            referent.value_ref.address,
+            referent.right_ref.address,
+            referent.length,
+            referent.left_height,
+            referent.right_height,
+            key_type
+        ) + key
+
+    @staticmethod
+    def string_to_referent(string):
+        """解码节点
+        """
+        node_struct = PackedAVLNodeRef.NODE_STRUCT
+        (left, value, right, length,
+         left_height, right_height, key_type) = node_struct.unpack_from(string)
+        return AVLNode(
+            PackedAVLNodeRef(address=left),
+            unpack_key(key_type, string[node_struct.size:]),
+            ValueRef(address=value),
+            PackedAVLNodeRef(address=right),
+            length,
+            left_height,
+            right_height
+        )
+
+class AVLTree(BinaryTree):
+    """自平衡的 AVL 树
+
+    插入和删除沿用 BinaryTree 的写时复制算法，在每一层返回前做一次
+    旋转检查，使顺序插入时树高仍保持在 O(log n)。
+    """
+    node_ref_class = AVLNodeRef
+    node_ref_classes = {1: PackedAVLNodeRef}
+    node_class = AVLNode
+
+    def _insert(self, node, key, value_ref):
+        return self._rebalance(
+            super(AVLTree, self)._insert(node, key, value_ref)
+        )
+
+    def _delete(self, node, key):
+        return self._rebalance(super(AVLTree, self)._delete(node, key))
+
+    def _build_node(self, left_ref, key, value_ref, right_ref, length,
+                    left_height, right_height):
+        return self.node_class(
+            left_ref, key, value_ref, right_ref, length, left_height, right_height
+        )
+
+    def _rebalance(self, ref):
+        """如果 ref 指向的节点失衡，旋转后返回新的引用
+        """
+        node = self._follow(ref)
+        if node is None:
+            return ref
+        if node.balance < -1:
+            left = self._follow(node.left_ref)
+            if left.balance > 0:
+                node = self.node_class.from_node(
+                    node, left_ref=self._rotate_left(left)
+                )
+            return self._rotate_right(node)
+        if node.balance > 1:
+            right = self._follow(node.right_ref)
+            if right.balance < 0:
+                node = self.node_class.from_node(
+                    node, right_ref=self._rotate_right(right)
+                )
+            return self._rotate_left(node)
+        return ref
+
+    def _rotate_right(self, node):
+        """右旋，左子节点成为新的根
+        """
+        left = self._follow(node.left_ref)
+        # 计算长度和高度需要这两个子树已加载
+        self._follow(left.right_ref)
+        new_right = self.node_class.from_node(node, left_ref=left.right_ref)
+        return self.node_ref_class(referent=self.node_class.from_node(
+            left, right_ref=self.node_ref_class(referent=new_right)
+        ))
+
+    def _rotate_left(self, node):
+        """左旋，右子节点成为新的根
+        """
+        right = self._follow(node.right_ref)
+        self._follow(right.left_ref)
+        new_left = self.node_class.from_node(node, right_ref=right.left_ref)
+        return self.node_ref_class(referent=self.node_class.from_node(
+            right, left_ref=self.node_ref_class(referent=new_left)
+        ))
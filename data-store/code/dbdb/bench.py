@@ -0,0 +1,250 @@
+'''
+性能基准
+
+    python -m dbdb.bench [--sizes 1000,10000,100000] [--trees binary,balanced,bplus]
+                         [--output FILE] [--profile DIR]
+
+对每种树和每个规模依次测量：随机插入、顺序插入、按键查找、查找不存在的键、
+范围扫描和逐键提交。每项报告 ops/s、每次操作写入的字节数、每次操作调用
+Storage.read 的次数，以及树的深度（关闭缓存时一次查找读取的节点数）。
+结果以 JSON 写到标准输出或 --output 指定的文件，表格打印到标准错误，
+便于保存下来比较不同版本。--profile 为每一项保存 cProfile 的结果。
+'''
+import argparse
+import cProfile
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import dbdb
+
+# 朴素二叉树在顺序插入时退化成链表，提交时递归写入节点的深度就是键数，
+# 超过这个规模就跳过，留出递归限制的余量
+MAX_BINARY_SEQUENTIAL = 250
+
+class ReadCounter(object):
+    """替换 storage.read，统计调用次数
+    """
+    def __init__(self, storage):
+        self.calls = 0
+        self._read = storage.read
+        storage.read = self
+
+    def __call__(self, address):
+        self.calls += 1
+        return self._read(address)
+
+def make_key(i):
+    """第 i 个键，数据库中只有偶数，奇数用来测量不存在的键
+    """
+    return '%010d' % (2 * i)
+
+def make_miss(i):
+    return '%010d' % (2 * i + 1)
+
+class Runner(object):
+    """在临时目录中运行一组基准
+    """
+    def __init__(self, args, temp_dir):
+        self.args = args
+        self.temp_dir = temp_dir
+        self.value = 'v' * args.value_size
+        self.results = []
+
+    def connect(self, path, tree, cache_size=None):
+        if cache_size is None:
+            cache_size = self.args.cache_size
+        return dbdb.connect(path, tree=tree, cache_size=cache_size,
+                            mmap=self.args.mmap, bloom=self.args.bloom,
+                            codec=self.args.codec)
+
+    def measure(self, tree, size, workload, path, func, depth=False):
+        """运行 func(db)，它返回操作次数；depth 为 True 时同时测量树的深度
+        """
+        db = self.connect(path, tree)
+        counter = ReadCounter(db._storage)
+        before = os.path.getsize(path)
+        profile = cProfile.Profile() if self.args.profile else None
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        ops = func(db)
+        if profile is not None:
+            profile.disable()
+        seconds = time.perf_counter() - start
+        db.close()
+        if profile is not None:
+            profile.dump_stats(os.path.join(
+                self.args.profile, '%s-%d-%s.prof' % (tree, size, workload)
+            ))
+        result = {
+            'tree': tree,
+            'size': size,
+            'workload': workload,
+            'ops': ops,
+            'seconds': seconds,
+            'ops_per_sec': ops / seconds if seconds else None,
+            'bytes_per_op': (os.path.getsize(path) - before) / ops,
+            'reads_per_op': counter.calls / ops,
+        }
+        if depth:
+            result['depth'] = self.depth(path, tree, size)
+        self.report(result)
+        return result
+
+    def depth(self, path, tree, size):
+        """关闭缓存时查找一个已有的键最多读取的节点数
+        """
+        db = self.connect(path, tree, cache_size=0)
+        counter = ReadCounter(db._storage)
+        depth = 0
+        for i in random.sample(range(size), min(size, 100)):
+            calls = counter.calls
+            db[make_key(i)]
+            # 最后一次读取的是值
+            depth = max(depth, counter.calls - calls - 1)
+        db.close()
+        return depth
+
+    def report(self, result):
+        self.results.append(result)
+        if 'skipped' in result:
+            print('%-10s %9d %-18s skipped: %s' % (
+                result['tree'], result['size'], result['workload'],
+                result['skipped']), file=sys.stderr)
+            return
+        print('%-10s %9d %-18s %12.0f %10.1f %8.2f %6s' % (
+            result['tree'], result['size'], result['workload'],
+            result['ops_per_sec'], result['bytes_per_op'],
+            result['reads_per_op'], result.get('depth', '')), file=sys.stderr)
+
+    def run(self, tree, size):
+        args = self.args
+        keys = [make_key(i) for i in range(size)]
+        random_path = os.path.join(self.temp_dir, '%s-%d-random.db' % (tree, size))
+        sequential_path = os.path.join(
+            self.temp_dir, '%s-%d-sequential.db' % (tree, size)
+        )
+
+        def insert(order):
+            def func(db):
+                for start in range(0, len(order), args.batch):
+                    with db.batch():
+                        for key in order[start:start + args.batch]:
+                            db[key] = self.value
+                return len(order)
+            return func
+
+        shuffled = list(keys)
+        random.shuffle(shuffled)
+        self.measure(tree, size, 'insert_random', random_path,
+                     insert(shuffled), depth=True)
+
+        if tree == 'binary' and size > MAX_BINARY_SEQUENTIAL:
+            self.report({'tree': tree, 'size': size,
+                         'workload': 'insert_sequential',
+                         'skipped': 'unbalanced tree degenerates to a list'})
+        else:
+            self.measure(tree, size, 'insert_sequential', sequential_path,
+                         insert(keys), depth=True)
+            os.remove(sequential_path)
+
+        ops = min(size, args.ops)
+
+        def get(db):
+            for i in random.sample(range(size), ops):
+                db[make_key(i)]
+            return ops
+        self.measure(tree, size, 'get', random_path, get)
+
+        def miss(db):
+            for i in random.sample(range(size), ops):
+                make_miss(i) in db
+            return ops
+        self.measure(tree, size, 'miss', random_path, miss)
+
+        def scan(db):
+            scanned = 0
+            for i in random.sample(range(size), max(1, ops // args.scan_length)):
+                for n, item in enumerate(db.range(make_key(i)), start=1):
+                    if n == args.scan_length:
+                        break
+                scanned += n
+            return scanned
+        self.measure(tree, size, 'range', random_path, scan)
+
+        def commit(db):
+            commits = min(size, args.commits)
+            for i in random.sample(range(size), commits):
+                db[make_key(i)] = self.value
+                db.commit()
+            return commits
+        self.measure(tree, size, 'commit', random_path, commit)
+        os.remove(random_path)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m dbdb.bench', description='dbdb benchmark suite'
+    )
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated key counts (default: %(default)s)')
+    parser.add_argument('--trees', default='binary,balanced,bplus',
+                        help='comma separated tree types (default: %(default)s)')
+    parser.add_argument('--ops', type=int, default=10000,
+                        help='lookups per get/miss/range workload')
+    parser.add_argument('--commits', type=int, default=1000,
+                        help='single key commits in the commit workload')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='keys per transaction when inserting')
+    parser.add_argument('--scan-length', type=int, default=100,
+                        help='keys read by each range scan')
+    parser.add_argument('--value-size', type=int, default=32)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--mmap', action='store_true')
+    parser.add_argument('--bloom', action='store_true')
+    parser.add_argument('--codec', help='value codec, see ValueRef.codecs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', help='directory for temporary database files')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='save a cProfile dump for each workload in DIR')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    random.seed(args.seed)
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=args.dir)
+    runner = Runner(args, temp_dir)
+    print('%-10s %9s %-18s %12s %10s %8s %6s' % (
+        'tree', 'size', 'workload', 'ops/s', 'bytes/op', 'reads/op', 'depth'),
+        file=sys.stderr)
+    try:
+        for tree in args.trees.split(','):
+            for size in [int(size) for size in args.sizes.split(',')]:
+                runner.run(tree, size)
+    finally:
+        shutil.rmtree(temp_dir)
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': vars(args),
+        'results': runner.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    return output
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import pickle
+import struct
 
-from dbdb.logical import LogicalBase, ValueRef
+from dbdb.logical import LogicalBase, ValueRef, pack_key, unpack_key
 
 class BinaryNode(object):
     """二叉树节点
@@ -80,13 +81,62 @@ class BinaryNodeRef(ValueRef):
             d['length']
         )
 
+    @classmethod
+    def copy_referent(cls, referent):
+        """复制缓存中的节点，子节点和值的引用只保留地址
+        """
+        return BinaryNode(
+            cls(address=referent.left_ref.address),
+            referent.key,
+            ValueRef(address=referent.value_ref.address),
+            cls(address=referent.right_ref.address),
+            referent.length
+        )
+
+class PackedBinaryNodeRef(BinaryNodeRef):
+    """用定长结构编码节点的引用，文件格式版本 1 使用
+
+    依次是左子树、值、右子树的地址和子树长度（uint64）以及键的类型标记，
+    剩下的字节都是键。记录本身已经由 Storage 加了长度前缀，键不需要再加。
+    """
+    NODE_STRUCT = struct.Struct("!QQQQB")
+
+    @staticmethod
+    def referent_to_string(referent):
+        """将节点编码为定长结构加键的字节
+        """
+        key_type, key = pack_key(referent.key)
+        return PackedBinaryNodeRef.NODE_STRUCT.pack(
+            referent.left_ref.address,
+            referent.value_ref.address,
+            referent.right_ref.address,
+            referent.length,
+            key_type
+        ) + key
+
+    @staticmethod
+    def string_to_referent(string):
+        """解码节点
+        """
+        node_struct = PackedBinaryNodeRef.NODE_STRUCT
+        left, value, right, length, key_type = node_struct.unpack_from(string)
+        return BinaryNode(
+            PackedBinaryNodeRef(address=left),
+            unpack_key(key_type, string[node_struct.size:]),
+            ValueRef(address=value),
+            PackedBinaryNodeRef(address=right),
+            length
+        )
+
 class BinaryTree(LogicalBase):
     """二叉树
     """
     node_ref_class = BinaryNodeRef
+    node_ref_classes = {1: PackedBinaryNodeRef}
+    node_class = BinaryNode
 
-    def _get(self, node, key):
-        """在node中查找指定的key
+    def _get_ref(self, node, key):
+        """在node中查找指定的key，返回值的引用
         """
         while node is not None:
             if key < node.key:
@@ -94,26 +144,94 @@ class BinaryTree(LogicalBase):
             elif node.key < key:
                 node = self._follow(node.right_ref)
             else:
-                return self._follow(node.value_ref)
+                return node.value_ref
         raise KeyError
 
+    def _range(self, node, start, stop, reverse):
+        """中序遍历 [start, stop) 内的 (key, value_ref)
+
+        用显式的栈代替递归，只会读取范围内的节点和通往它们的路径。子节点
+        通过 _follow_detached 读取，内存中只保留栈上的节点。
+        """
+        def before(key):
+            """key 在遍历方向上位于范围之前"""
+            if reverse:
+                return stop is not None and not key < stop
+            return start is not None and key < start
+
+        def after(key):
+            """key 在遍历方向上位于范围之后"""
+            if reverse:
+                return start is not None and key < start
+            return stop is not None and not key < stop
+
+        def first(node):
+            return node.right_ref if reverse else node.left_ref
+
+        def second(node):
+            return node.left_ref if reverse else node.right_ref
+
+        stack = []
+        while stack or node is not None:
+            if node is not None:
+                if before(node.key):
+                    # 节点和 first 一侧的子树都在范围之前
+                    node = self._follow_detached(second(node))
+                else:
+                    stack.append(node)
+                    node = self._follow_detached(first(node))
+            else:
+                node = stack.pop()
+                if after(node.key):
+                    return
+                yield node.key, node.value_ref
+                node = self._follow_detached(second(node))
+
+    def _build(self, items, length):
+        """从有序的 items 构建完全平衡的树
+
+        按中序消费 items，值在左右子树之间写入，文件中值按键的顺序排列，
+        节点按后序紧随其后。返回只含地址的引用，已写入的子树不会留在内存中。
+        """
+        def build(n):
+            """用接下来的 n 项构建子树，返回 (引用, 高度)"""
+            if n == 0:
+                return self.node_ref_class(), 0
+            left_ref, left_height = build((n - 1) // 2)
+            key, value = next(items)
+            value_ref = self.value_ref_class(value)
+            value_ref.store(self._storage)
+            right_ref, right_height = build(n - 1 - (n - 1) // 2)
+            ref = self.node_ref_class(referent=self._build_node(
+                left_ref, key, value_ref, right_ref, n, left_height, right_height
+            ))
+            ref.store(self._storage)
+            height = 1 + max(left_height, right_height)
+            return self.node_ref_class(address=ref.address), height
+
+        return build(length)[0]
+
+    def _build_node(self, left_ref, key, value_ref, right_ref, length,
+                    left_height, right_height):
+        return self.node_class(left_ref, key, value_ref, right_ref, length)
+
     def _insert(self, node, key, value_ref):
         """在node中插入指定的key
         """
         if node is None:
-            new_node = BinaryNode(
+            new_node = self.node_class(
                 self.node_ref_class(), key, value_ref, self.node_ref_class(), 1
             )
         elif key < node.key:
-            new_node = BinaryNode.from_node(
+            new_node = self.node_class.from_node(
                 node, left_ref=self._insert(self._follow(node.left_ref), key, value_ref)
             )
         elif node.key < key:
-            new_node = BinaryNode.from_node(
+            new_node = self.node_class.from_node(
                 node, right_ref=self._insert(self._follow(node.right_ref), key, value_ref)
             )
         else:
-            new_node = BinaryNode.from_node(node, value_ref=value_ref)
+            new_node = self.node_class.from_node(node, value_ref=value_ref)
         return self.node_ref_class(referent=new_node)
 
     def _delete(self, node, key):
@@ -122,11 +240,11 @@ class BinaryTree(LogicalBase):
         if node is None:
             raise KeyError
         elif key < node.key:
-            new_node = BinaryNode.from_node(
+            new_node = self.node_class.from_node(
                 node, left_ref=self._delete(self._follow(node.left_ref), key)
             )
         elif node.key < key:
-            new_node = BinaryNode.from_node(
+            new_node = self.node_class.from_node(
                 node, right_ref=self._delete(self._follow(node.right_ref), key)
             )
         else:
@@ -137,12 +255,11 @@ class BinaryTree(LogicalBase):
                 left_ref = self._delete(
                     self._follow(node.left_ref), replacement.key
                 )
-                new_node = BinaryNode(
-                    left_ref,
-                    replacement.key,
-                    replacement.value_ref,
-                    node.right_ref,
-                    left_ref.length + node.right_ref.length + 1
+                new_node = self.node_class.from_node(
+                    node,
+                    left_ref=left_ref,
+                    key=replacement.key,
+                    value_ref=replacement.value_ref
                 )
             elif left:
                 return node.left_ref
@@ -0,0 +1,79 @@
+'''
+布隆过滤器
+
+判断一个键“一定不存在”只需要计算几个哈希，不必沿着树从磁盘读取节点。
+每个过滤器记录自己对应的根地址，只在根相同时才能用来排除键。
+'''
+import hashlib
+import math
+import struct
+
+class BloomFilter(object):
+    """按 capacity 个键和期望的误判率确定大小的布隆过滤器
+
+    加入和查询的是键编码后的字节。哈希用 blake2b 计算，不依赖每个进程
+    不同的 hash()，同一个文件可以被多个进程共享。k 个位置由两个 64 位
+    哈希值组合得到。
+    """
+    HEADER = struct.Struct("!QQQQB")
+
+    def __init__(self, capacity, error_rate=0.01, root_address=0):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / capacity * math.log(2)
+        )))
+        self.root_address = root_address
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, data):
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, data):
+        """加入一个键
+        """
+        for position in self._positions(data):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, data):
+        """返回 False 时键一定不在集合中
+        """
+        bits = self._bits
+        for position in self._positions(data):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def copy(self):
+        """复制一个过滤器，用于在新的根上继续加入键
+        """
+        new = BloomFilter.__new__(BloomFilter)
+        new.__dict__.update(self.__dict__)
+        new._bits = bytearray(self._bits)
+        return new
+
+    def to_bytes(self):
+        """序列化
+        """
+        return self.HEADER.pack(
+            self.root_address, self.capacity, self.num_bits, self.count,
+            self.num_hashes
+        ) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """反序列化，data 也可以是 memoryview
+        """
+        new = cls.__new__(cls)
+        (new.root_address, new.capacity, new.num_bits, new.count,
+         new.num_hashes) = cls.HEADER.unpack_from(data)
+        new._bits = bytearray(data[cls.HEADER.size:])
+        return new
@@ -0,0 +1,299 @@
+import pickle
+from bisect import bisect_left, bisect_right
+
+from dbdb.logical import LogicalBase, ValueRef
+
+class BPlusNode(object):
+    """B+ 树节点，一个节点就是磁盘上的一页
+
+    叶子节点的 refs 是值引用，与 keys 一一对应；内部节点的 refs 是子节点
+    引用，比 keys 多一个，counts 记录每个子树中键的数量。
+    """
+    def __init__(self, leaf, keys, refs, counts=()):
+        self.leaf = leaf
+        self.keys = keys
+        self.refs = refs
+        self.counts = counts
+
+    @property
+    def length(self):
+        """子树中键的数量
+        """
+        if self.leaf:
+            return len(self.keys)
+        return sum(self.counts)
+
+    def store_refs(self, storage):
+        """储存页中的所有值或子节点
+        """
+        for ref in self.refs:
+            ref.store(storage)
+
+class PageRefs(object):
+    """按地址惰性创建引用的只读列表
+
+    一页有几百个引用，查找时只会用到其中一个，从磁盘或缓存得到的页
+    不必一次创建全部的引用对象。
+    """
+    def __init__(self, ref_class, addresses):
+        self.ref_class = ref_class
+        self.addresses = addresses
+        self._refs = [None] * len(addresses)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __getitem__(self, i):
+        ref = self._refs[i]
+        if ref is None:
+            ref = self._refs[i] = self.ref_class(address=self.addresses[i])
+        return ref
+
+    def __iter__(self):
+        for i in range(len(self.addresses)):
+            yield self[i]
+
+class BPlusNodeRef(ValueRef):
+    """B+ 树节点的引用
+    """
+    def prepare_to_store(self, storage):
+        if self._referent:
+            self._referent.store_refs(storage)
+
+    @staticmethod
+    def referent_to_string(referent):
+        """将整页序列化
+        """
+        return pickle.dumps({
+            'leaf': referent.leaf,
+            'keys': referent.keys,
+            'refs': [ref.address for ref in referent.refs],
+            'counts': list(referent.counts),
+        })
+
+    @staticmethod
+    def string_to_referent(string):
+        """将序列化数据还原为节点对象
+        """
+        d = pickle.loads(string)
+        ref_class = ValueRef if d['leaf'] else BPlusNodeRef
+        return BPlusNode(
+            d['leaf'],
+            d['keys'],
+            PageRefs(ref_class, d['refs']),
+            d['counts']
+        )
+
+    @staticmethod
+    def copy_referent(referent):
+        """复制缓存中的页，键和地址列表只读可以共享，引用重新创建
+        """
+        refs = referent.refs
+        return BPlusNode(
+            referent.leaf,
+            referent.keys,
+            PageRefs(refs.ref_class, refs.addresses),
+            referent.counts
+        )
+
+class BPlusTree(LogicalBase):
+    """高扇出的 B+ 树
+
+    每页最多保存 max_keys 个键，百万级的键只需要三四层，一次查找只读取
+    三四个页。与二叉树一样采用写时复制，修改时重写从叶子到根的整条路径。
+    删除时不合并半空的页，只移除空页，树高不会因删除而增加。
+    """
+    node_ref_class = BPlusNodeRef
+    max_keys = 256
+
+    def _get_ref(self, node, key):
+        """在 node 中查找指定的 key，返回值的引用
+        """
+        while node is not None and not node.leaf:
+            node = self._follow(node.refs[bisect_right(node.keys, key)])
+        if node is not None:
+            i = bisect_left(node.keys, key)
+            if i < len(node.keys) and not key < node.keys[i]:
+                return node.refs[i]
+        raise KeyError
+
+    def _range(self, node, start, stop, reverse):
+        """按顺序遍历 [start, stop) 内的 (key, value_ref)，只读取与范围相交的页
+
+        子页通过 _follow_detached 读取，内存中只保留从根到当前页的路径。
+        """
+        if node is None:
+            return
+        if node.leaf:
+            lo = 0 if start is None else bisect_left(node.keys, start)
+            hi = len(node.keys) if stop is None else bisect_left(node.keys, stop)
+            indexes = range(lo, hi)
+            for i in reversed(indexes) if reverse else indexes:
+                yield node.keys[i], node.refs[i]
+            return
+        lo = 0 if start is None else bisect_right(node.keys, start)
+        hi = len(node.keys) if stop is None else bisect_left(node.keys, stop)
+        indexes = range(lo, hi + 1)
+        for i in reversed(indexes) if reverse else indexes:
+            yield from self._range(
+                self._follow_detached(node.refs[i]), start, stop, reverse
+            )
+
+    def _build(self, items, length):
+        """从有序的 items 自底向上构建 B+ 树，页尽量装满
+
+        每一层只保留一个正在填充的页，页满了就写入磁盘，再把 (首键, 引用,
+        键数) 交给上一层。叶子中的值在叶子之前按键的顺序写入。
+        """
+        levels = []
+
+        def write(node):
+            ref = self.node_ref_class(referent=node)
+            ref.store(self._storage)
+            return self.node_ref_class(address=ref.address)
+
+        def write_internal(children):
+            node = BPlusNode(
+                False,
+                [child[0] for child in children[1:]],
+                [child[1] for child in children],
+                [child[2] for child in children]
+            )
+            return children[0][0], write(node), node.length
+
+        def add_child(level, child):
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(child)
+            if len(levels[level]) > self.max_keys:
+                children, levels[level] = levels[level], []
+                add_child(level + 1, write_internal(children))
+
+        keys = []
+        refs = []
+        for key, value in items:
+            keys.append(key)
+            refs.append(self.value_ref_class(value))
+            if len(keys) == self.max_keys:
+                add_child(0, (keys[0], write(BPlusNode(True, keys, refs)), len(keys)))
+                keys, refs = [], []
+        if keys:
+            add_child(0, (keys[0], write(BPlusNode(True, keys, refs)), len(keys)))
+
+        level = 0
+        while level < len(levels):
+            children = levels[level]
+            if level == len(levels) - 1 and len(children) == 1:
+                return children[0][1]
+            if children:
+                levels[level] = []
+                add_child(level + 1, write_internal(children))
+            level += 1
+        return self.node_ref_class()
+
+    def _insert(self, node, key, value_ref):
+        """在 node 中插入指定的 key，根节点分裂时树高加一
+        """
+        if node is None:
+            return self.node_ref_class(
+                referent=BPlusNode(True, [key], [value_ref])
+            )
+        new_node, split = self._insert_into(node, key, value_ref)
+        if split is not None:
+            separator, right = split
+            new_node = BPlusNode(
+                False,
+                [separator],
+                [self.node_ref_class(referent=new_node),
+                 self.node_ref_class(referent=right)],
+                [new_node.length, right.length]
+            )
+        return self.node_ref_class(referent=new_node)
+
+    def _insert_into(self, node, key, value_ref):
+        """返回新节点，以及分裂出来的 (分隔键, 右侧节点)，没有分裂时为 None
+        """
+        keys = list(node.keys)
+        refs = list(node.refs)
+        if node.leaf:
+            i = bisect_left(keys, key)
+            if i < len(keys) and not key < keys[i]:
+                refs[i] = value_ref
+            else:
+                keys.insert(i, key)
+                refs.insert(i, value_ref)
+            return self._split(BPlusNode(True, keys, refs))
+
+        counts = list(node.counts)
+        i = bisect_right(keys, key)
+        child, split = self._insert_into(self._follow(refs[i]), key, value_ref)
+        refs[i] = self.node_ref_class(referent=child)
+        counts[i] = child.length
+        if split is not None:
+            separator, right = split
+            keys.insert(i, separator)
+            refs.insert(i + 1, self.node_ref_class(referent=right))
+            counts.insert(i + 1, right.length)
+        return self._split(BPlusNode(False, keys, refs, counts))
+
+    def _split(self, node):
+        """页超过 max_keys 时一分为二
+        """
+        if len(node.keys) <= self.max_keys:
+            return node, None
+        mid = len(node.keys) // 2
+        if node.leaf:
+            left = BPlusNode(True, node.keys[:mid], node.refs[:mid])
+            right = BPlusNode(True, node.keys[mid:], node.refs[mid:])
+            return left, (right.keys[0], right)
+        left = BPlusNode(
+            False, node.keys[:mid], node.refs[:mid + 1], node.counts[:mid + 1]
+        )
+        right = BPlusNode(
+            False, node.keys[mid + 1:], node.refs[mid + 1:], node.counts[mid + 1:]
+        )
+        return left, (node.keys[mid], right)
+
+    def _delete(self, node, key):
+        """在 node 中删除指定的 key，根节点只剩一个子节点时树高减一
+        """
+        if node is None:
+            raise KeyError
+        new_node = self._delete_from(node, key)
+        if new_node is None:
+            return self.node_ref_class()
+        ref = self.node_ref_class(referent=new_node)
+        while not new_node.leaf and len(new_node.refs) == 1:
+            ref = new_node.refs[0]
+            new_node = self._follow(ref)
+        return ref
+
+    def _delete_from(self, node, key):
+        """返回删除 key 后的新节点，页变空时返回 None
+        """
+        keys = list(node.keys)
+        refs = list(node.refs)
+        if node.leaf:
+            i = bisect_left(keys, key)
+            if i == len(keys) or key < keys[i]:
+                raise KeyError
+            del keys[i]
+            del refs[i]
+            if not keys:
+                return None
+            return BPlusNode(True, keys, refs)
+
+        counts = list(node.counts)
+        i = bisect_right(keys, key)
+        child = self._delete_from(self._follow(refs[i]), key)
+        if child is None:
+            del refs[i]
+            del counts[i]
+            if keys:
+                del keys[max(i - 1, 0)]
+            if not refs:
+                return None
+        else:
+            refs[i] = self.node_ref_class(referent=child)
+            counts[i] = child.length
+        return BPlusNode(False, keys, refs, counts)
@@ -0,0 +1,51 @@
+'''
+二级索引
+
+索引是和主树存放在同一个文件中的另一棵树，键是 (索引值, 主键)，值为
+空字符串，同一个索引值的记录按主键的顺序相邻。索引树的根和主树的根写在
+同一张根表中，一次 commit_root_address 一起生效。
+'''
+
+class Index(object):
+    """按 fn(值) 索引主树中的记录
+
+    fn 返回 None 的记录不进入索引。索引值需要能够互相比较大小。
+    """
+
+    def __init__(self, name, fn, tree):
+        self.name = name
+        self.fn = fn
+        self.tree = tree
+
+    def add(self, key, value):
+        """加入一条记录
+        """
+        index_value = self.fn(value)
+        if index_value is not None:
+            self.tree.set((index_value, key), '')
+
+    def remove(self, key, value):
+        """去掉一条记录，value 是它原来的值
+        """
+        index_value = self.fn(value)
+        if index_value is not None:
+            self.tree.pop((index_value, key))
+
+    def build(self, items):
+        """用主树的全部 (键, 值) 重建索引，需要在写锁内调用
+        """
+        entries = []
+        for key, value in items:
+            index_value = self.fn(value)
+            if index_value is not None:
+                entries.append((index_value, key))
+        entries.sort()
+        self.tree.load(((entry, '') for entry in entries), len(entries))
+
+    def keys(self, index_value):
+        """按顺序遍历索引值为 index_value 的主键
+        """
+        for entry in self.tree.keys((index_value,)):
+            if index_value < entry[0]:
+                break
+            yield entry[1]
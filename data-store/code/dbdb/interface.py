@@ -1,17 +1,52 @@
 '''
 接口文件，定义 DBDB，包含 get set del 等方法
 '''
+from contextlib import contextmanager
 
+from dbdb.avl_tree import AVLTree
 from dbdb.binary_tree import BinaryTree
-from dbdb.physical import Storage
+from dbdb.bplus_tree import BPlusTree
+from dbdb.index import Index
+from dbdb.logical import ValueRef
+from dbdb.physical import MmapStorage, Storage
+from dbdb.wal import TOMBSTONE
+
+# connect 的 tree 参数可选的逻辑层实现
+TREES = {
+    'binary': BinaryTree,
+    'balanced': AVLTree,
+    'bplus': BPlusTree,
+}
+
+# 覆盖层中没有这个键
+_MISSING = object()
 
 class DBDB(object):
 
-    def __init__(self, f):
+    def __init__(self, f, tree=None, cache_size=1024, mmap=False, wal=None,
+                 bloom=False, codec=None):
+        if tree is not None and tree not in TREES:
+            raise ValueError('Unknown tree type: %r' % tree)
+        if codec is not None and codec not in ValueRef.codecs:
+            raise ValueError('Unknown codec: %r' % codec)
         # 存储
-        self._storage = Storage(f)
-        # 二叉树
-        self._tree = BinaryTree(self._storage)
+        self._storage = MmapStorage(f) if mmap else Storage(f)
+        try:
+            tree = self._storage.ensure_tree(tree)
+        except ValueError:
+            self._storage.close()
+            raise
+        # 树
+        self._tree = TREES[tree](
+            self._storage, cache_size=cache_size, bloom=bloom,
+            codec=self._storage.ensure_codec(codec)
+        )
+        # WAL 模式下修改先保存在 _pending 中，提交时追加到日志
+        self._wal = wal
+        self._pending = {}
+        # 本连接维护的二级索引，名字到 Index
+        self._indexes = {}
+        self._cache_size = cache_size
 
     def _assert_not_closed(self):
         """断言数据库夫是否关闭
@@ -22,43 +57,408 @@ class DBDB(object):
     def close(self):
         """关闭数据库
         """
+        if self._wal is not None and not self._storage.closed:
+            self._pending = {}
+            self._wal.release()
         self._storage.close()
 
     def commit(self):
         """提交更新
+
+        WAL 模式下只把修改作为一条记录追加到日志并 fsync。
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            ops = [('d', key) if value is TOMBSTONE else ('s', key, value)
+                   for key, value in self._pending.items()]
+            self._pending = {}
+            if ops:
+                self._wal.append(ops)
+            return
+        self._commit()
+
+    def _commit(self):
+        """主树和所有索引树在一次 commit_root_address 中提交
+        """
+        if not self._indexes:
+            self._tree.commit()
+            return
+        # 没有写入时先刷新所有的树，避免用旧的根覆盖其他连接的提交
+        self._begin_write()
+        roots = {}
+        for name, index in self._indexes.items():
+            roots[name] = index.tree.store()
+        self._tree.commit(roots)
+
+    def checkpoint(self):
+        """WAL 模式下立即把日志合并进树
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            self._wal.checkpoint()
+
+    @contextmanager
+    def batch(self):
+        """批量写入事务
+
+        with 块内的修改在退出时作为一个事务提交：所有新节点和值在内存中
+        拼成一块连续的数据，一次写入文件并 fsync 一次，然后更新根地址。
+        块内抛出异常时丢弃所有修改。
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            try:
+                yield self
+                self.commit()
+            except BaseException:
+                self._pending = {}
+                raise
+            return
+        self._storage.begin_batch()
+        try:
+            yield self
+            self._commit()
+        except BaseException:
+            self._tree.rollback()
+            for index in self._indexes.values():
+                index.tree.rollback()
+            raise
+        finally:
+            self._storage.end_batch()
+
+    @contextmanager
+    def snapshot(self):
+        """只读快照
+
+        固定在最近一次提交的根上，with 块内的所有读取看到同一个版本，
+        不受之后的提交影响，也不加锁，多个进程可以和写入者并发读取。
+        本连接尚未提交的修改不在快照中。
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            overlay, root_ref = self._wal.view(self._tree)
+            snap = Snapshot(self._tree, root_ref, overlay)
+        else:
+            snap = Snapshot(self._tree, self._tree.snapshot())
+        try:
+            yield snap
+        finally:
+            snap.close()
+
+    def cache_info(self):
+        """节点缓存的 (hits, misses, maxsize, currsize)，未启用缓存时为 None
+        """
+        return self._tree.cache_info()
+
+    def create_index(self, name, fn):
+        """在值上创建名为 name 的二级索引，之后可以用 find(name, x) 查找
+
+        fn 把值映射为索引值，返回 None 的记录不进入索引。索引保存在同一个
+        文件中，和主树一起提交。fn 不会保存，每个连接都要用同样的名字和
+        函数重新创建：文件中已有这个索引时直接使用，没有时遍历所有记录
+        建立并立即提交；在写事务中创建时随事务一起提交，事务回滚后索引仍然
+        登记在连接上，下一次写入或查找时重建。
+
+        没有创建这个索引的连接提交时，文件中的索引被丢弃，维护它的连接
+        下一次写入或查找时重建。WAL 模式不支持索引。
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            raise ValueError('Indexes are not supported in WAL mode.')
+        if name is None or name in self._indexes:
+            raise ValueError('Invalid or duplicate index name: %r' % (name,))
+        tree = type(self._tree)(
+            self._storage, cache_size=self._cache_size, root_name=name
+        )
+        index = self._indexes[name] = Index(name, fn, tree)
+        if self._storage.locked:
+            # 索引要包含本事务中尚未提交的修改
+            index.build(self._tree.items())
+        elif name not in self._storage.get_root_table():
+            self._begin_write()
+            self._commit()
+
+    def drop_index(self, name):
+        """删除索引，立即提交；在写事务中删除时随事务一起提交
+        """
+        self._assert_not_closed()
+        del self._indexes[name]
+        if not self._storage.locked:
+            self._begin_write()
+            self._commit()
+
+    def find(self, name, index_value):
+        """按主键的顺序惰性遍历索引值为 index_value 的 (键, 值)
         """
         self._assert_not_closed()
-        self._tree.commit()
+        index = self._indexes[name]
+        if (not self._storage.locked
+                and name not in self._storage.get_root_table()):
+            # 其他连接提交时丢弃了这个索引
+            self._begin_write()
+            self._commit()
+        for key in index.keys(index_value):
+            try:
+                value = self._tree.get(key)
+            except KeyError:
+                continue
+            # 索引和主树分别读取根，两次读取之间可能有新的提交
+            if index.fn(value) == index_value:
+                yield key, value
+
+    def _begin_write(self):
+        """有索引时由本对象拿写锁，刷新主树和所有索引树，重建文件中缺失的索引
+        """
+        if not self._storage.lock():
+            return
+        self._tree._begin_write()
+        table = self._storage.get_root_table()
+        for name, index in self._indexes.items():
+            index.tree._begin_write()
+            if name not in table:
+                index.build(self._tree.items())
+
+    def _unindex(self, key):
+        """从所有索引中去掉 key 原来的值，key 不存在时抛出 KeyError
+        """
+        value = self._tree.get(key)
+        for index in self._indexes.values():
+            index.remove(key, value)
 
     def __getitem__(self, key):
         """ get 操作
         """
         self._assert_not_closed()
+        if self._wal is not None:
+            value = self._pending.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._wal.get(key, _MISSING)
+            if value is TOMBSTONE:
+                raise KeyError
+            if value is not _MISSING:
+                return value
         return self._tree.get(key)
 
     def __setitem__(self, key, value):
         """ set 操作
         """
         self._assert_not_closed()
+        if self._wal is not None:
+            self._pending[key] = value
+            return
+        if self._indexes:
+            self._begin_write()
+            try:
+                self._unindex(key)
+            except KeyError:
+                pass
+            for index in self._indexes.values():
+                index.add(key, value)
         return self._tree.set(key, value)
 
     def __delitem__(self, key):
         """ del 操作
         """
         self._assert_not_closed()
+        if self._wal is not None:
+            if key not in self:
+                raise KeyError
+            self._pending[key] = TOMBSTONE
+            return
+        if self._indexes:
+            self._begin_write()
+            self._unindex(key)
         return self._tree.pop(key)
 
+    def _view(self):
+        """WAL 模式下包含日志和本连接未提交修改的只读视图
+        """
+        overlay, root_ref = self._wal.view(self._tree)
+        overlay.update(self._pending)
+        return Snapshot(self._tree, root_ref, overlay)
+
+    def __contains__(self, key):
+        """ 判断 key 是否存在，不解码值
+        """
+        if self._wal is not None:
+            try:
+                self[key]
+            except KeyError:
+                return False
+            else:
+                return True
+        self._assert_not_closed()
+        return self._tree.contains(key)
+    
+    def __len__(self):
+        """ 计算长度
+        """
+        if self._wal is not None:
+            return len(self._view())
+        return len(self._tree)
+
+    def __iter__(self):
+        """ 按顺序遍历所有的键
+        """
+        return self.keys()
+
+    def keys(self):
+        """ 按顺序惰性遍历所有的键，不读取值
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            return self._view().keys()
+        return self._tree.keys()
+
+    def items(self):
+        """ 按顺序惰性遍历所有的 (键, 值)
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            return self._view().items()
+        return self._tree.items()
+
+    def range(self, start=None, stop=None, reverse=False):
+        """ 按顺序惰性遍历 start <= 键 < stop 的 (键, 值)
+
+        start 或 stop 为 None 时该侧不设边界，reverse 为 True 时从大到小。
+        """
+        self._assert_not_closed()
+        if self._wal is not None:
+            return self._view().range(start, stop, reverse)
+        return self._tree.items(start, stop, reverse)
+
+class Snapshot(object):
+    """固定在一个根地址上的只读视图，由 DBDB.snapshot() 创建
+
+    overlay 是 WAL 中尚未合并进树的修改，优先于树中的内容。
+    """
+
+    def __init__(self, tree, root_ref, overlay=None):
+        self._tree = tree
+        self._root_ref = root_ref
+        self._overlay = overlay or {}
+
+    def _assert_not_closed(self):
+        """断言快照是否关闭
+        """
+        if self._root_ref is None:
+            raise ValueError('Snapshot closed.')
+
+    def close(self):
+        """关闭快照，释放已加载的节点
+        """
+        self._root_ref = None
+        self._overlay = {}
+
+    def __getitem__(self, key):
+        """ get 操作
+        """
+        value = self._get(key)
+        if value is _MISSING:
+            return self._tree._follow(self._tree._get_ref(
+                self._tree._follow(self._root_ref), key
+            ))
+        return value
+
     def __contains__(self, key):
-        """ 判断 key 是否存在
+        """ 判断 key 是否存在，不解码值
         """
         try:
-            self[key]
+            value = self._get(key)
+            if value is _MISSING:
+                self._tree._get_ref(self._tree._follow(self._root_ref), key)
         except KeyError:
             return False
         else:
             return True
-    
+
+    def _get(self, key):
+        """覆盖层中的值；需要查找树时返回 _MISSING，确定不存在时抛出 KeyError
+        """
+        self._assert_not_closed()
+        value = self._overlay.get(key, _MISSING)
+        if value is TOMBSTONE:
+            raise KeyError
+        if value is _MISSING and self._tree._bloom_excludes(
+                self._root_ref.address, key):
+            raise KeyError
+        return value
+
     def __len__(self):
         """ 计算长度
         """
-        return len(self._tree)
+        self._assert_not_closed()
+        root = self._tree._follow(self._root_ref)
+        length = root.length if root else 0
+        for key, value in self._overlay.items():
+            try:
+                self._tree._get_ref(root, key)
+            except KeyError:
+                in_tree = False
+            else:
+                in_tree = True
+            if value is TOMBSTONE:
+                length -= in_tree
+            else:
+                length += not in_tree
+        return length
+
+    def __iter__(self):
+        """ 按顺序遍历所有的键
+        """
+        return self.keys()
+
+    def keys(self):
+        """ 按顺序惰性遍历所有的键，不读取值
+        """
+        for key, value_ref, value in self._iter_range(None, None, False):
+            yield key
+
+    def items(self):
+        """ 按顺序惰性遍历所有的 (键, 值)
+        """
+        return self.range()
+
+    def range(self, start=None, stop=None, reverse=False):
+        """ 按顺序惰性遍历 start <= 键 < stop 的 (键, 值)
+        """
+        for key, value_ref, value in self._iter_range(start, stop, reverse):
+            if value is _MISSING:
+                value = self._tree._follow(value_ref)
+            yield key, value
+
+    def _iter_range(self, start, stop, reverse):
+        """按顺序产生 (键, 值的引用, 覆盖层中的值)，已删除的键被跳过
+
+        树中的键和覆盖层中排好序的键归并，同一个键以覆盖层为准。
+        """
+        self._assert_not_closed()
+        tree = self._tree
+        pairs = tree._range(
+            tree._follow_detached(self._root_ref), start, stop, reverse
+        )
+        changes = sorted(
+            ((key, value) for key, value in self._overlay.items()
+             if (start is None or not key < start)
+             and (stop is None or key < stop)),
+            key=lambda change: change[0],
+            reverse=reverse
+        )
+        i = 0
+        for key, value_ref in pairs:
+            while i < len(changes) and (
+                    key < changes[i][0] if reverse else changes[i][0] < key):
+                if changes[i][1] is not TOMBSTONE:
+                    yield changes[i][0], None, changes[i][1]
+                i += 1
+            if i < len(changes) and not (
+                    changes[i][0] < key or key < changes[i][0]):
+                if changes[i][1] is not TOMBSTONE:
+                    yield key, None, changes[i][1]
+                i += 1
+            else:
+                yield key, value_ref, _MISSING
+        for key, value in changes[i:]:
+            if value is not TOMBSTONE:
+                yield key, None, value
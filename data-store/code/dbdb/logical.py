@@ -1,6 +1,100 @@
+import lzma
+import pickle
+import zlib
+from collections import OrderedDict, namedtuple
+
+from dbdb.bloom import BloomFilter
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# 键的类型标记：常见的 str 和 bytes 直接保存字节，其余类型用 pickle
+KEY_STR = 0
+KEY_BYTES = 1
+KEY_PICKLE = 2
+
+def pack_key(key):
+    """把键编码为 (类型标记, 字节)
+    """
+    if type(key) is str:
+        return KEY_STR, key.encode('utf-8')
+    if type(key) is bytes:
+        return KEY_BYTES, key
+    return KEY_PICKLE, pickle.dumps(key)
+
+def unpack_key(key_type, data):
+    """pack_key 的逆操作，data 也可以是 memoryview
+    """
+    if key_type == KEY_STR:
+        return str(data, 'utf-8')
+    if key_type == KEY_BYTES:
+        return bytes(data)
+    return pickle.loads(data)
+
+def _bloom_key(key):
+    """布隆过滤器中使用的键的字节，不使用过滤器的键返回 None
+
+    树按比较查找键，1、1.0 和 True 是同一个键，编码却各不相同，放进
+    过滤器会得到假阴性，所以过滤器只用于 str 和 bytes（包括子类），
+    其他类型的键总是读取节点。
+    """
+    if isinstance(key, str):
+        return bytes([KEY_STR]) + key.encode('utf-8')
+    if isinstance(key, bytes):
+        return bytes([KEY_BYTES]) + bytes(key)
+    return None
+
+class NodeCache(object):
+    """以地址为键、保存已解码节点的 LRU 缓存
+
+    文件只追加，一个地址上的数据写入后永远不变，所以缓存的节点不需要失效，
+    刷新根节点之后仍然可以继续使用。
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._nodes = OrderedDict()
+
+    def get(self, address):
+        """查找节点，没有缓存时返回 None
+        """
+        try:
+            node = self._nodes[address]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._nodes.move_to_end(address)
+        self.hits += 1
+        return node
+
+    def put(self, address, node):
+        """缓存节点，超出容量时淘汰最久未使用的节点
+        """
+        self._nodes[address] = node
+        if len(self._nodes) > self.maxsize:
+            self._nodes.popitem(last=False)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._nodes))
+
 class ValueRef(object):
     """ 用来在数据库中存储二进制对象的Python对象
+
+    默认把 str 按 UTF-8 编码保存。其他值的编码方式是 ValueRef 的子类，
+    用 codec 命名并通过 ValueRef.register 登记到 ValueRef.codecs 中，
+    connect 的 codec 参数按名字选择。
     """
+    codec = 'utf-8'
+    # 编码名到 ValueRef 子类的映射
+    codecs = {}
+
+    @classmethod
+    def register(cls, value_ref_class):
+        """登记一种值的编码，可以用作类装饰器
+        """
+        cls.codecs[value_ref_class.codec] = value_ref_class
+        return value_ref_class
+
     def prepare_to_store(self, storage):
         pass
 
@@ -12,9 +106,15 @@ class ValueRef(object):
 
     @staticmethod
     def string_to_referent(string):
-        """字符串转二进制
+        """字符串转二进制，string 也可以是 memoryview
         """
-        return string.decode('utf-8')
+        return str(string, 'utf-8')
+
+    @staticmethod
+    def copy_referent(referent):
+        """复制缓存中的对象，值是不可变的，直接共享
+        """
+        return referent
 
     def __init__(self, referent=None, address=0):
         self._referent = referent
@@ -24,11 +124,22 @@ class ValueRef(object):
     def address(self):
         return self._address
 
-    def get(self, storage):
+    def get(self, storage, cache=None):
         """获取存储的对象
+
+        cache 不为空时先在已解码的对象中查找。缓存的对象会被多个引用共享，
+        这里拿到的是 copy_referent 的副本，加载子节点不会让缓存的对象越来越大。
+        还在批量写入缓冲区中的数据不进入缓存：批量写入回滚后这些地址会被复用。
         """
         if self._referent is None and self._address:
-            self._referent = self.string_to_referent(storage.read(self._address))
+            if cache is None or storage.is_buffered(self._address):
+                self._referent = self.string_to_referent(storage.read(self._address))
+            else:
+                referent = cache.get(self._address)
+                if referent is None:
+                    referent = self.string_to_referent(storage.read(self._address))
+                    cache.put(self._address, referent)
+                self._referent = self.copy_referent(referent)
         return self._referent
 
     def store(self, storage):
@@ -38,46 +149,297 @@ class ValueRef(object):
             self.prepare_to_store(storage)
             self._address = storage.write(self.referent_to_string(self._referent))
 
+ValueRef.register(ValueRef)
+
+@ValueRef.register
+class BytesValueRef(ValueRef):
+    """值是 bytes，原样保存
+    """
+    codec = 'raw'
+
+    @staticmethod
+    def referent_to_string(referent):
+        return bytes(referent)
+
+    @staticmethod
+    def string_to_referent(string):
+        return bytes(string)
+
+@ValueRef.register
+class PickleValueRef(ValueRef):
+    """值是任意可以 pickle 的对象
+    """
+    codec = 'pickle'
+
+    @staticmethod
+    def referent_to_string(referent):
+        return pickle.dumps(referent, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def string_to_referent(string):
+        return pickle.loads(string)
+
+@ValueRef.register
+class ZlibValueRef(ValueRef):
+    """pickle 之后用 zlib 压缩，适合较大的文本值
+    """
+    codec = 'zlib'
+
+    @staticmethod
+    def referent_to_string(referent):
+        return zlib.compress(pickle.dumps(referent, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def string_to_referent(string):
+        return pickle.loads(zlib.decompress(string))
+
+@ValueRef.register
+class LzmaValueRef(ValueRef):
+    """pickle 之后用 lzma 压缩，压缩率更高，编码更慢
+    """
+    codec = 'lzma'
+
+    @staticmethod
+    def referent_to_string(referent):
+        return lzma.compress(pickle.dumps(referent, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def string_to_referent(string):
+        return pickle.loads(lzma.decompress(string))
+
 class LogicalBase(object):
     """作为父类定义相关接口
     """
     node_ref_class = None
+    # 文件格式版本到节点引用类的映射，没有列出的版本使用 node_ref_class
+    node_ref_classes = {}
     value_ref_class = ValueRef
+    # 布隆过滤器的误判率和最小容量，键数超过容量时按两倍重建
+    bloom_error_rate = 0.01
+    bloom_min_capacity = 1024
 
-    def __init__(self, storage):
+    def __init__(self, storage, cache_size=1024, bloom=False, codec='utf-8',
+                 root_name=None):
         self._storage = storage
+        # 根在根表中的名字，None 是主树，其余是同一文件中的索引树
+        self.root_name = root_name
+        self.node_ref_class = self.node_ref_classes.get(
+            storage.format_version, self.node_ref_class
+        )
+        self.value_ref_class = ValueRef.codecs[codec]
+        # 缓存跨越每次刷新根节点，cache_size 为 0 时不缓存
+        self._node_cache = NodeCache(cache_size) if cache_size else None
+        # _bloom 对应根地址 _bloom_root，_bloom_base 是写事务开始时的过滤器，
+        # _bloom_keys 是事务中新加入的键，提交时合并成新根的过滤器
+        self._bloom_enabled = bloom
+        self._bloom = None
+        self._bloom_root = None
+        self._bloom_address = 0
+        self._bloom_base = None
+        self._bloom_keys = set()
         self._refresh_tree_ref()
 
-    def commit(self):
+    def commit(self, roots=None):
+        """提交修改，roots 是同一事务中其他树已经存储的根（名字到地址）
+        """
+        self._tree_ref.store(self._storage)
+        bloom_address = self._store_bloom() if self._bloom_enabled else 0
+        self._storage.commit_root_address(
+            self._tree_ref.address, bloom_address, roots
+        )
+
+    def store(self):
+        """写入尚未存储的节点，返回根地址，由主树在 commit 时一起提交
+        """
         self._tree_ref.store(self._storage)
-        self._storage.commit_root_address(self._tree_ref.address)
+        return self._tree_ref.address
+
+    def rollback(self):
+        """丢弃尚未提交的修改并释放写锁
+        """
+        self._storage.unlock()
+        self._refresh_tree_ref()
+        self._bloom_keys = set()
+
+    def _bloom_for(self, root_address):
+        """root_address 对应的布隆过滤器，文件中没有有效的过滤器时为 None
+        """
+        if self._bloom_root != root_address:
+            self._bloom = None
+            self._bloom_address = self._storage.get_bloom_address()
+            if self._bloom_address:
+                bloom = BloomFilter.from_bytes(
+                    self._storage.read(self._bloom_address)
+                )
+                if bloom.root_address == root_address:
+                    self._bloom = bloom
+            self._bloom_root = root_address
+        return self._bloom
+
+    def _bloom_excludes(self, root_address, key):
+        """布隆过滤器能否断定 key 不在 root_address 对应的树中
+        """
+        if not self._bloom_enabled or not root_address:
+            return False
+        data = _bloom_key(key)
+        if data is None:
+            return False
+        bloom = self._bloom_for(root_address)
+        return bloom is not None and data not in bloom
+
+    def _begin_write(self):
+        """拿到写锁之后刷新根节点，记下当前根的过滤器
+        """
+        self._refresh_tree_ref()
+        if self._bloom_enabled:
+            self._bloom_base = self._bloom_for(self._tree_ref.address)
+            self._bloom_keys = set()
+
+    def _store_bloom(self):
+        """写入新根的布隆过滤器，返回它的地址
+
+        在事务开始时的过滤器上加入新的键；没有可用的过滤器或者超出容量时，
+        遍历整棵树重建。
+        """
+        root_address = self._tree_ref.address
+        if self._bloom_root == root_address and not self._bloom_keys:
+            return self._bloom_address
+        base = self._bloom_base
+        if base is not None and base.count + len(self._bloom_keys) <= base.capacity:
+            bloom = base.copy()
+            for key in self._bloom_keys:
+                bloom.add(key)
+        else:
+            root = self._follow(self._tree_ref)
+            length = root.length if root else 0
+            bloom = BloomFilter(
+                max(self.bloom_min_capacity, 2 * length), self.bloom_error_rate
+            )
+            for key, value_ref in self._range(root, None, None, False):
+                data = _bloom_key(key)
+                if data is not None:
+                    bloom.add(data)
+        bloom.root_address = root_address
+        self._bloom = self._bloom_base = bloom
+        self._bloom_root = root_address
+        self._bloom_address = self._storage.write(bloom.to_bytes())
+        self._bloom_keys = set()
+        return self._bloom_address
 
     def _refresh_tree_ref(self):
         self._tree_ref = self.node_ref_class(
-            address=self._storage.get_root_address()
+            address=self._storage.get_root_address(self.root_name)
+        )
+
+    def snapshot(self):
+        """返回最近一次提交的根的引用
+
+        文件只追加，从这个根可达的节点永远不会改变，之后的提交不影响
+        从它开始的读取。读取根地址不需要加锁。
+        """
+        return self.node_ref_class(
+            address=self._storage.get_root_address(self.root_name)
         )
 
     def get(self, key):
+        return self._follow(self._get_current(key))
+
+    def contains(self, key):
+        """判断 key 是否存在，不读取也不解码值
+        """
+        try:
+            self._get_current(key)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def _get_current(self, key):
+        """在当前的根中查找 key，返回值的引用
+        """
         if not self._storage.locked:
             self._refresh_tree_ref()
-        return self._get(self._follow(self._tree_ref), key)
+            if self._bloom_excludes(self._tree_ref.address, key):
+                raise KeyError
+        return self._get_ref(self._follow(self._tree_ref), key)
+
+    def _get(self, node, key):
+        """在 node 中查找 key，返回解码后的值
+        """
+        return self._follow(self._get_ref(node, key))
 
     def set(self, key, value):
-        print(key + ":" + str(self._storage.locked))
         if self._storage.lock():
-            self._refresh_tree_ref()
+            self._begin_write()
         self._tree_ref = self._insert(
             self._follow(self._tree_ref), key, self.value_ref_class(value))
+        data = _bloom_key(key) if self._bloom_enabled else None
+        if data is not None:
+            self._bloom_keys.add(data)
 
     def pop(self, key):
         if self._storage.lock():
-            self._refresh_tree_ref()
+            self._begin_write()
         self._tree_ref = self._delete(
             self._follow(self._tree_ref), key)
 
+    def load(self, items, length):
+        """用按键排序的 length 个 (键, 值) 自底向上重建整棵树
+
+        节点边构建边写入，每个节点只写一次，内存中只保留构建中的路径。
+        原来的内容被整体替换，和 set 一样需要 commit 才会生效。
+        """
+        self._storage.lock()
+        self._tree_ref = self._build(iter(items), length)
+        # 提交时遍历新树重建过滤器
+        self._bloom_base = None
+
+    def keys(self, start=None, stop=None, reverse=False):
+        """按键的顺序惰性遍历 [start, stop) 内的键，不读取值
+        """
+        for key, value_ref in self._iter_range(start, stop, reverse):
+            yield key
+
+    def items(self, start=None, stop=None, reverse=False):
+        """按键的顺序惰性遍历 [start, stop) 内的 (键, 值)
+        """
+        for key, value_ref in self._iter_range(start, stop, reverse):
+            yield key, self._follow(value_ref)
+
+    def _iter_range(self, start, stop, reverse):
+        """从当前的根开始遍历，遍历过程中根被替换也不受影响
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return self._range(
+            self._follow_detached(self._tree_ref), start, stop, reverse
+        )
+
     def _follow(self, ref):
+        if isinstance(ref, self.node_ref_class):
+            return ref.get(self._storage, self._node_cache)
+        if type(ref) is not self.value_ref_class and ref._referent is None:
+            # 节点解码出来的值引用不知道数据库的编码，换成对应的类
+            ref = self.value_ref_class(address=ref.address)
         return ref.get(self._storage)
 
+    def _follow_detached(self, ref):
+        """读取 ref 指向的节点，但不把它挂到 ref 上
+
+        遍历时用它加载子节点，读过的节点不会挂在当前的树上，遍历结束前
+        只有栈上的节点留在内存中。尚未写入的节点本来就在内存中，直接返回。
+        """
+        if ref._referent is not None or not ref.address:
+            return self._follow(ref)
+        return self._follow(self.node_ref_class(address=ref.address))
+
+    def cache_info(self):
+        """节点缓存的命中情况，没有启用缓存时返回 None
+        """
+        if self._node_cache is None:
+            return None
+        return self._node_cache.info()
+
     def __len__(self):
         if not self._storage.locked:
             self._refresh_tree_ref()
@@ -6,7 +6,9 @@
 # 简化的 Key/Value 中。简化是因为你不能
 # 选择 key，并且它不会释放空间。
 
+import mmap
 import os
+import pickle
 import struct
 import dbdb.locks as locks
 
@@ -16,27 +18,130 @@ class Storage(object):
     SUPERBLOCK_SIZE = 4096 # 块大小
     INTEGER_FORMAT = "!Q" # 整型格式，"!’代表网络字节序（Big-Endian），Q代表8位unsigned long long
     INTEGER_LENGTH = 8  # 整型长度
+    # 文件头紧跟在超级块的根地址之后：魔数和文件格式版本。
+    # 旧文件这里全是 0，视为版本 0（pickle 节点）。
+    MAGIC = b'DBDB'
+    HEADER_FORMAT = "!4sH"
+    FORMAT_VERSION = 1
+    # 根地址对应的布隆过滤器的地址，没有过滤器时为 0
+    BLOOM_ADDRESS_OFFSET = 16
+    # 值的编码名，以 NUL 补齐，全为 0 时是默认的 UTF-8
+    CODEC_OFFSET = 24
+    CODEC_LENGTH = 16
+    # 标志位。FLAG_ROOT_TABLE 置位后根地址指向一张根表：魔数之后是 pickle 的
+    # 字典，None 对应主树的根，其余是索引树的根。标志只会置位，不会清除
+    FLAGS_OFFSET = 40
+    FLAG_ROOT_TABLE = 1
+    ROOT_TABLE_MAGIC = b'DBRT'
+    # 逻辑层的树的类型（connect 的 tree 参数），以 NUL 补齐，全为 0 时没有记录
+    TREE_OFFSET = 48
+    TREE_LENGTH = 16
 
     def __init__(self, f):
         self._f = f
         self.locked = False
+        # 批量写入的缓冲区，为 None 时直接写文件
+        self._batch = None
+        self._batch_address = 0
+        self.format_version = 0
+        self.codec = None
+        self.tree = None
+        # 最近一次读取的根表和它的地址
+        self._root_table_address = None
+        self._root_table = None
         self._ensure_superblock()
 
     def _ensure_superblock(self):
-        """确保文件长度是整块
+        """确保文件长度是整块，新文件写入文件头，旧文件读取格式版本
         """
         self.lock()
         self._seek_end()
         end_address = self._f.tell() # 文件指针当前位置，即文件长度
         if end_address < self.SUPERBLOCK_SIZE:
             self._f.write(b'\x00' * (self.SUPERBLOCK_SIZE - end_address))
+            self._f.seek(self.INTEGER_LENGTH)
+            self._f.write(struct.pack(
+                self.HEADER_FORMAT, self.MAGIC, self.FORMAT_VERSION
+            ))
+            self.format_version = self.FORMAT_VERSION
+        else:
+            self._f.seek(self.INTEGER_LENGTH)
+            magic, version = struct.unpack(
+                self.HEADER_FORMAT,
+                self._f.read(struct.calcsize(self.HEADER_FORMAT))
+            )
+            if magic == self.MAGIC:
+                if version > self.FORMAT_VERSION:
+                    self.unlock()
+                    raise ValueError('Unsupported file format version: %d' % version)
+                self.format_version = version
+            self._f.seek(self.CODEC_OFFSET)
+            codec = self._f.read(self.CODEC_LENGTH).rstrip(b'\x00')
+            self.codec = codec.decode('ascii') or None
+            self._f.seek(self.TREE_OFFSET)
+            tree = self._f.read(self.TREE_LENGTH).rstrip(b'\x00')
+            self.tree = tree.decode('ascii') or None
         self.unlock()
 
+    def ensure_codec(self, codec):
+        """返回数据库使用的值编码名
+
+        codec 为 None 时使用文件中记录的编码。第一次用非默认的编码打开
+        空数据库时把它写入文件头；与文件中记录的编码不一致时抛出 ValueError。
+        """
+        if codec is None:
+            return self.codec or 'utf-8'
+        if self.codec is None and codec != 'utf-8':
+            self.lock()
+            try:
+                if self.get_root_address():
+                    raise ValueError(
+                        'Cannot change the codec of a non-empty database to %r' % codec
+                    )
+                self._f.seek(self.CODEC_OFFSET)
+                self._f.write(codec.encode('ascii').ljust(self.CODEC_LENGTH, b'\x00'))
+                self.codec = codec
+            finally:
+                self.unlock()
+        elif (self.codec or 'utf-8') != codec:
+            raise ValueError('Database uses the %r codec, not %r' % (self.codec, codec))
+        return codec
+
+    def ensure_tree(self, tree):
+        """返回数据库使用的树的类型
+
+        tree 为 None 时使用文件中记录的类型，没有记录时为 'binary'。
+        空数据库记下 tree；非空数据库用别的树打开时抛出 ValueError，
+        否则节点会按错误的格式解码。没有记录的旧文件不做检查。
+        """
+        if tree is None:
+            tree = self.tree or 'binary'
+        if self.tree == tree:
+            return tree
+        self.lock()
+        try:
+            empty = not self.get_root_address()
+            if self.tree is not None and not empty:
+                raise ValueError(
+                    'Database uses the %r tree, not %r' % (self.tree, tree)
+                )
+            if empty:
+                self._f.seek(self.TREE_OFFSET)
+                self._f.write(tree.encode('ascii').ljust(self.TREE_LENGTH, b'\x00'))
+                self.tree = tree
+        finally:
+            self.unlock()
+        return tree
+
     def lock(self):
         """对数据库加锁
         """
         if not self.locked:
             locks.lock(self._f, locks.LOCK_EX)
+            if os.fstat(self._f.fileno()).st_nlink == 0:
+                # 文件已经被压缩后的新文件替换，写到这里的数据会丢失
+                locks.unlock(self._f)
+                raise RuntimeError('Database file was replaced, reconnect to write.')
             self.locked = True
             return True
         else:
@@ -46,9 +151,8 @@ class Storage(object):
         """对数据库解锁
         """
         if self.locked:
-            self._f.flush()           
-            locks.unlock(self._f)  
-            print("unlock")             
+            self._f.flush()
+            locks.unlock(self._f)
             self.locked = False
 
     def _seek_end(self):
@@ -82,40 +186,136 @@ class Storage(object):
         self.lock()
         self._f.write(self._integer_to_bytes(integer))
 
+    def begin_batch(self):
+        """开始批量写入
+
+        之后的 write 只把长度和数据追加到内存中的缓冲区，commit_root_address
+        时一次写入文件末尾并 fsync 一次，然后才更新根地址。
+        """
+        self._batch = bytearray()
+
+    def end_batch(self):
+        """结束批量写入，丢弃尚未提交的缓冲数据
+        """
+        self._batch = None
+
     def write(self, data):
         """写入数据
         """
         self.lock()
+        if self._batch is not None:
+            if not self._batch:
+                # 缓冲区为空时可能刚拿到锁，其他进程可能已经追加过数据
+                self._seek_end()
+                self._batch_address = self._f.tell()
+            object_address = self._batch_address + len(self._batch)
+            self._batch += self._integer_to_bytes(len(data))
+            self._batch += data
+            return object_address
         self._seek_end()
         object_address = self._f.tell()
         self._write_integer(len(data))
         self._f.write(data)
         return object_address
 
+    def is_buffered(self, address):
+        """address 上的数据是否还在批量写入的缓冲区中
+
+        缓冲区被丢弃后这些地址会被下一次写入复用，从这里读到的数据不能缓存。
+        """
+        return bool(self._batch) and address >= self._batch_address
+
+    def _read_batch(self, address):
+        """从批量写入的缓冲区中读取尚未写入文件的数据
+        """
+        offset = address - self._batch_address
+        length = struct.unpack_from(self.INTEGER_FORMAT, self._batch, offset)[0]
+        offset += self.INTEGER_LENGTH
+        return bytes(self._batch[offset:offset + length])
+
     def read(self, address):
         """读取数据
         """
+        if self.is_buffered(address):
+            return self._read_batch(address)
         self._f.seek(address)
         length = self._read_integer()
         data = self._f.read(length)
         return data
 
-    def commit_root_address(self, root_address):
-        """更新root的地址
+    def commit_root_address(self, root_address, bloom_address=0, roots=None):
+        """更新root的地址，以及对应的布隆过滤器的地址
+
+        roots 是索引树的根（名字到地址）。给出 roots 或者文件已经使用根表时，
+        主树和索引树的根写成一张新的根表，超级块中只替换根表的地址，所有的
+        根一起生效。已经使用根表而没有给出 roots 时，表中的索引被丢弃。
         """
         self.lock()
-        self._f.flush()
+        flags = self._read_flags()
+        if roots is not None or flags & self.FLAG_ROOT_TABLE:
+            table = dict(roots or {})
+            table[None] = root_address
+            root_address = self.write(
+                self.ROOT_TABLE_MAGIC + pickle.dumps(table, pickle.HIGHEST_PROTOCOL)
+            )
+            if not flags & self.FLAG_ROOT_TABLE:
+                # 先置标志再写根地址：读者读到根表的地址时一定也能读到标志，
+                # 读到标志而根地址还是旧的节点时按魔数区分
+                self._f.seek(self.FLAGS_OFFSET)
+                self._write_integer(flags | self.FLAG_ROOT_TABLE)
+                self._f.flush()
+        if self._batch:
+            # 数据一次写入并落盘之后才更新根地址
+            self._seek_end()
+            self._f.write(self._batch)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._batch = bytearray()
+        else:
+            self._f.flush()
         self._seek_superblock()
         self._write_integer(root_address)
+        # 过滤器记录了自己的根地址，读者先看到新根、后看到旧过滤器时会忽略它
+        self._f.seek(self.BLOOM_ADDRESS_OFFSET)
+        self._write_integer(bloom_address)
         self._f.flush()
         self.unlock()
 
-    def get_root_address(self):
-        """获取root的地址
+    def get_root_address(self, name=None):
+        """获取root的地址，name 不为 None 时获取这个索引树的根，没有时为 0
+        """
+        return self.get_root_table().get(name, 0)
+
+    def get_root_table(self):
+        """获取所有的根，名字到地址，None 对应主树，返回的字典不能修改
         """
+        # 带缓冲的文件对象在缓冲区内 seek 时不会重新读取，其他连接提交的
+        # 根地址会被旧的缓冲挡住，flush 会同时丢弃读缓冲
+        self._f.flush()
         self._seek_superblock()
         root_address = self._read_integer()
-        return root_address
+        if not self._read_flags() & self.FLAG_ROOT_TABLE:
+            return {None: root_address}
+        if root_address != self._root_table_address:
+            data = self.read(root_address) if root_address else b''
+            magic_length = len(self.ROOT_TABLE_MAGIC)
+            if bytes(data[:magic_length]) == self.ROOT_TABLE_MAGIC:
+                self._root_table = pickle.loads(data[magic_length:])
+            else:
+                # 标志刚刚置位，根地址还是主树的根
+                self._root_table = {None: root_address}
+            self._root_table_address = root_address
+        return self._root_table
+
+    def _read_flags(self):
+        self._f.seek(self.FLAGS_OFFSET)
+        return self._read_integer()
+
+    def get_bloom_address(self):
+        """获取布隆过滤器的地址，在 get_root_address 之后调用
+        """
+        self._f.seek(self.BLOOM_ADDRESS_OFFSET)
+        return self._read_integer()
 
     def close(self):
         """关闭数据库
@@ -128,4 +328,45 @@ class Storage(object):
         """是否关闭
         """
         return self._f.closed
-        
\ No newline at end of file
+        
+
+class MmapStorage(Storage):
+    """通过内存映射读取数据的存储
+
+    read 直接返回映射区域的 memoryview 切片，不需要 seek 和 read 系统调用。
+    文件只追加，已经映射的部分不会再改变；读取超出映射范围时，说明文件
+    在提交后变长了，这时刷新缓冲区并重新映射整个文件。写入仍然走文件对象。
+    """
+    def __init__(self, f):
+        self._map = None
+        self._view = None
+        super(MmapStorage, self).__init__(f)
+        self._remap()
+
+    def _remap(self):
+        """刷新写缓冲，重新映射整个文件
+        """
+        self._f.flush()
+        # 旧的映射可能还被调用方持有的切片引用，交给垃圾回收释放
+        self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def read(self, address):
+        """读取数据，返回映射区域的 memoryview 切片
+        """
+        if self.is_buffered(address):
+            return self._read_batch(address)
+        start = address + self.INTEGER_LENGTH
+        if start > len(self._map):
+            self._remap()
+        length = struct.unpack_from(self.INTEGER_FORMAT, self._map, address)[0]
+        if start + length > len(self._map):
+            self._remap()
+        return self._view[start:start + length]
+
+    def close(self):
+        """关闭数据库
+        """
+        self._view = None
+        self._map = None
+        super(MmapStorage, self).close()
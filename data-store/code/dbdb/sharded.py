@@ -0,0 +1,195 @@
+'''
+分片存储
+
+一个文件只有一把写锁，同一时刻只能有一个写入者。ShardedDBDB 按键的哈希
+把数据分到一个目录下的 N 个 dbdb 文件中，提交时每个分片的修改交给进程池
+中的一个进程，作为一个批量事务写入，各分片的写入和 fsync 并行进行。
+
+读取在当前进程中进行，每个分片一个连接，读取不需要加锁。范围遍历对每个
+分片分别遍历，再按键归并。
+'''
+import hashlib
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+import dbdb
+from dbdb.interface import Snapshot
+from dbdb.logical import pack_key
+from dbdb.wal import TOMBSTONE
+
+# 待提交的修改中没有这个键
+_MISSING = object()
+
+# 工作进程中打开的连接，分片文件名到 DBDB
+_connections = {}
+
+def _write_shard(path, kwargs, ops):
+    """在工作进程中把一个分片的修改作为一个事务写入
+
+    ops 是 ('s', key, value) 或 ('d', key)。连接在工作进程中保留，后续
+    提交可以复用节点缓存；每次提交之后文件已经落盘并解锁。
+    """
+    db = _connections.get(path)
+    if db is None:
+        db = _connections[path] = dbdb.connect(path, **kwargs)
+    with db.batch():
+        for op in ops:
+            if op[0] == 's':
+                db[op[1]] = op[2]
+            else:
+                try:
+                    del db[op[1]]
+                except KeyError:
+                    pass
+    return len(ops)
+
+class ShardedDBDB(object):
+    """按键的哈希分布在 directory 下 shards 个文件中的数据库
+
+    processes 是写入进程的数量，默认为分片数和 CPU 数中较小的一个。其余
+    参数（tree、codec 等）传给每个分片的 dbdb.connect，不支持 WAL 模式。
+    同一个目录必须始终用同样的分片数打开。各分片分别提交，一次 commit
+    跨越多个分片时不是原子的。
+    """
+    SHARD_NAME = 'shard-%03d.db'
+
+    def __init__(self, directory, shards=4, processes=None, **kwargs):
+        if kwargs.get('wal'):
+            raise ValueError('ShardedDBDB does not support WAL mode.')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = [name for name in os.listdir(directory)
+                    if name.startswith('shard-') and name.endswith('.db')]
+        if existing and len(existing) != shards:
+            raise ValueError('%s has %d shards, not %d' % (
+                directory, len(existing), shards))
+        self._paths = [os.path.join(directory, self.SHARD_NAME % i)
+                       for i in range(shards)]
+        self._kwargs = kwargs
+        # 读取用的连接，第一次连接时也确定了每个分片的值编码
+        self._shards = [dbdb.connect(path, **kwargs) for path in self._paths]
+        if processes is None:
+            processes = min(shards, os.cpu_count() or 1)
+        self._pool = ProcessPoolExecutor(max_workers=processes)
+        # 每个分片尚未提交的修改，键到值或 TOMBSTONE
+        self._pending = [{} for _ in range(shards)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _assert_not_closed(self):
+        if self._pool is None:
+            raise ValueError('Database closed.')
+
+    def shard_for(self, key):
+        """key 所在分片的序号
+
+        用 blake2b 计算，不依赖每个进程不同的 hash()。
+        """
+        key_type, data = pack_key(key)
+        digest = hashlib.blake2b(bytes([key_type]) + data, digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % len(self._paths)
+
+    def close(self):
+        """关闭所有连接，尚未提交的修改被丢弃
+        """
+        if self._pool is None:
+            return
+        self._pool.shutdown()
+        self._pool = None
+        for db in self._shards:
+            db.close()
+
+    def commit(self):
+        """把每个分片的修改交给一个工作进程，全部落盘之后返回
+        """
+        self._assert_not_closed()
+        futures = []
+        for i, pending in enumerate(self._pending):
+            if not pending:
+                continue
+            ops = [('d', key) if value is TOMBSTONE else ('s', key, value)
+                   for key, value in pending.items()]
+            futures.append(self._pool.submit(
+                _write_shard, self._paths[i], self._kwargs, ops
+            ))
+        self._pending = [{} for _ in self._paths]
+        for future in futures:
+            future.result()
+
+    def __getitem__(self, key):
+        """ get 操作
+        """
+        self._assert_not_closed()
+        i = self.shard_for(key)
+        value = self._pending[i].get(key, _MISSING)
+        if value is TOMBSTONE:
+            raise KeyError
+        if value is not _MISSING:
+            return value
+        return self._shards[i][key]
+
+    def __setitem__(self, key, value):
+        """ set 操作，commit 之后才写入文件
+        """
+        self._assert_not_closed()
+        self._pending[self.shard_for(key)][key] = value
+
+    def __delitem__(self, key):
+        """ del 操作
+        """
+        if key not in self:
+            raise KeyError
+        self._pending[self.shard_for(key)][key] = TOMBSTONE
+
+    def __contains__(self, key):
+        """ 判断 key 是否存在
+        """
+        self._assert_not_closed()
+        i = self.shard_for(key)
+        value = self._pending[i].get(key, _MISSING)
+        if value is not _MISSING:
+            return value is not TOMBSTONE
+        return key in self._shards[i]
+
+    def _views(self):
+        """每个分片最近一次提交的根加上本对象尚未提交的修改
+        """
+        self._assert_not_closed()
+        return [Snapshot(db._tree, db._tree.snapshot(), pending)
+                for db, pending in zip(self._shards, self._pending)]
+
+    def __len__(self):
+        """ 计算长度
+        """
+        return sum(len(view) for view in self._views())
+
+    def __iter__(self):
+        """ 按顺序遍历所有的键
+        """
+        return self.keys()
+
+    def keys(self):
+        """ 按顺序惰性遍历所有的键，不读取值
+        """
+        return heapq.merge(*[view.keys() for view in self._views()])
+
+    def items(self):
+        """ 按顺序惰性遍历所有的 (键, 值)
+        """
+        return self.range()
+
+    def range(self, start=None, stop=None, reverse=False):
+        """ 按顺序惰性遍历 start <= 键 < stop 的 (键, 值)
+
+        每个分片内的键已经有序，对各分片的遍历做 k 路归并。
+        """
+        return heapq.merge(
+            *[view.range(start, stop, reverse) for view in self._views()],
+            key=itemgetter(0), reverse=reverse
+        )
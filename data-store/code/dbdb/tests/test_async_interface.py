@@ -0,0 +1,97 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.tools import assert_raises, eq_, ok_
+
+import dbdb
+from dbdb.async_interface import AsyncDBDB
+
+class TestAsyncDBDB(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.temp_dir, 'async.db')
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_get_set_delete_commit(self):
+        async def main():
+            async with AsyncDBDB(self.dbname, tree='balanced') as db:
+                await db.set('a', 'aye')
+                eq_(await db.get('a'), 'aye')
+                with assert_raises(KeyError):
+                    await db.get('b')
+                await db.commit()
+                await db.set('b', 'bee')
+                await db.delete('a')
+                ok_(not await db.contains('a'))
+                with assert_raises(KeyError):
+                    await db.delete('c')
+                await db.commit()
+                eq_(await db.get('b'), 'bee')
+                await db.set('c', 'see')
+        self.run(main())
+        db = dbdb.connect(self.dbname, tree='balanced')
+        # 没有提交的修改在关闭时被丢弃
+        eq_(list(db.items()), [('b', 'bee')])
+        db.close()
+
+    def test_range(self):
+        async def main():
+            async with AsyncDBDB(self.dbname, tree='bplus') as db:
+                for i in range(50):
+                    await db.set('%02d' % i, str(i))
+                await db.commit()
+                await db.set('10', 'ten')
+                await db.delete('11')
+                result = [item async for item in db.range('05', '45', chunk_size=7)]
+                expected = [('%02d' % i, str(i)) for i in range(5, 45) if i != 11]
+                expected[5] = ('10', 'ten')
+                eq_(result, expected)
+                result = [item async for item in db.range(reverse=True, chunk_size=3)]
+                eq_([key for key, value in result],
+                    ['%02d' % i for i in reversed(range(50)) if i != 11])
+        self.run(main())
+
+    def test_concurrent_commits_share_one_storage_commit(self):
+        async def main():
+            async with AsyncDBDB(self.dbname) as db:
+                async def writer(i):
+                    await db.set('%02d' % i, str(i))
+                    await db.commit()
+                await asyncio.gather(*[writer(i) for i in range(10)])
+                eq_(db.commits, 1)
+                await asyncio.gather(*[writer(i) for i in range(10, 20)])
+                eq_(db.commits, 2)
+                eq_(await db.get('15'), '15')
+        self.run(main())
+        db = dbdb.connect(self.dbname)
+        eq_(len(db), 20)
+        db.close()
+
+    def test_concurrent_reads_are_coalesced(self):
+        async def main():
+            async with AsyncDBDB(self.dbname) as db:
+                await db.set('a', 'aye')
+                await db.commit()
+                reads = []
+                release = threading.Event()
+                read = db._read
+
+                def slow_read(key):
+                    reads.append(key)
+                    release.wait()
+                    return read(key)
+                db._read = slow_read
+                tasks = [asyncio.ensure_future(db.get('a')) for _ in range(5)]
+                await asyncio.sleep(0.01)
+                release.set()
+                eq_(await asyncio.gather(*tasks), ['aye'] * 5)
+                eq_(reads, ['a'])
+        self.run(main())
@@ -0,0 +1,86 @@
+import math
+import random
+
+from nose.tools import assert_raises, eq_, ok_
+
+from dbdb.avl_tree import AVLNode, AVLNodeRef, AVLTree
+from dbdb.logical import ValueRef
+from dbdb.tests.test_binary_tree import StubStorage
+
+class TestAVLTree(object):
+    def setup(self):
+        self.tree = AVLTree(StubStorage())
+
+    def _check_balanced(self, ref):
+        """递归检查平衡因子和记录的高度，返回子树高度
+        """
+        node = self.tree._follow(ref)
+        if node is None:
+            return 0
+        left_height = self._check_balanced(node.left_ref)
+        right_height = self._check_balanced(node.right_ref)
+        eq_(node.left_height, left_height)
+        eq_(node.right_height, right_height)
+        ok_(abs(node.balance) <= 1)
+        return node.height
+
+    def test_sequential_inserts_stay_logarithmic(self):
+        n = 1000
+        for i in range(n):
+            self.tree.set(i, str(i))
+        height = self._check_balanced(self.tree._tree_ref)
+        ok_(height <= 1.45 * math.log2(n + 2))
+        eq_(len(self.tree), n)
+        for i in range(n):
+            eq_(self.tree.get(i), str(i))
+
+    def test_random_set_and_pop_keep_balance(self):
+        keys = random.sample(range(10000), 300)
+        for i, k in enumerate(keys, start=1):
+            self.tree.set(k, str(k))
+            eq_(len(self.tree), i)
+        self._check_balanced(self.tree._tree_ref)
+        random.shuffle(keys)
+        for i, k in enumerate(keys[:200], start=1):
+            self.tree.pop(k)
+            eq_(len(self.tree), len(keys) - i)
+            self._check_balanced(self.tree._tree_ref)
+        for k in keys[:200]:
+            with assert_raises(KeyError):
+                self.tree.get(k)
+        for k in keys[200:]:
+            eq_(self.tree.get(k), str(k))
+
+    def test_load_builds_balanced_tree(self):
+        for n in [0, 1, 2, 7, 100]:
+            self.tree.load(((i, str(i)) for i in range(n)), n)
+            self._check_balanced(self.tree._tree_ref)
+            eq_(len(self.tree), n)
+            eq_(list(self.tree.items()), [(i, str(i)) for i in range(n)])
+        self.tree.set(100, '100')
+        self.tree.pop(0)
+        self._check_balanced(self.tree._tree_ref)
+
+    def test_overwrite_and_get_key(self):
+        self.tree.set('a', 'b')
+        self.tree.set('a', 'c')
+        eq_(self.tree.get('a'), 'c')
+        eq_(len(self.tree), 1)
+
+    def test_pop_non_existent_key(self):
+        with assert_raises(KeyError):
+            self.tree.pop('Not A Key In The Tree')
+
+class TestAVLNodeRef(object):
+    def test_round_trip(self):
+        left_ref = AVLNodeRef(address=123)
+        right_ref = AVLNodeRef(address=321)
+        n = AVLNode(left_ref, 'k', ValueRef(address=999), right_ref, 3, 1, 2)
+        node = AVLNodeRef.string_to_referent(AVLNodeRef.referent_to_string(n))
+        eq_(node.left_ref.address, 123)
+        eq_(node.key, 'k')
+        eq_(node.value_ref.address, 999)
+        eq_(node.right_ref.address, 321)
+        eq_(node.length, 3)
+        eq_(node.height, 3)
+        eq_(node.balance, 1)
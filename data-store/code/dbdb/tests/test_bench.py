@@ -0,0 +1,41 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+import dbdb.bench
+
+class TestBench(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_json_output(self):
+        output = os.path.join(self.temp_dir, 'bench.json')
+        profile = os.path.join(self.temp_dir, 'profile')
+        dbdb.bench.main([
+            '--sizes', '50', '--trees', 'balanced,bplus', '--ops', '20',
+            '--commits', '5', '--scan-length', '5', '--dir', self.temp_dir,
+            '--output', output, '--profile', profile,
+        ])
+        with open(output) as f:
+            results = json.load(f)['results']
+        eq_([(r['tree'], r['workload']) for r in results], [
+            (tree, workload) for tree in ['balanced', 'bplus']
+            for workload in ['insert_random', 'insert_sequential', 'get',
+                             'miss', 'range', 'commit']
+        ])
+        for r in results:
+            ok_(r['ops_per_sec'] > 0)
+        eq_(results[0]['ops'], 50)
+        ok_(results[0]['bytes_per_op'] > 0)
+        ok_(results[0]['depth'] >= 5)
+        eq_(results[2]['ops'], 20)
+        ok_(results[2]['reads_per_op'] > 0)
+        ok_(os.path.exists(os.path.join(profile, 'bplus-50-get.prof')))
+        # 临时的数据库文件都已删除
+        eq_(sorted(os.listdir(self.temp_dir)), ['bench.json', 'profile'])
@@ -1,11 +1,15 @@
 import pickle
 import random
 
-from nose.tools import assert_raises, eq_
+from nose.tools import assert_raises, eq_, ok_
 
-from dbdb.binary_tree import BinaryNode, BinaryTree, BinaryNodeRef, ValueRef
+from dbdb.binary_tree import (
+    BinaryNode, BinaryTree, BinaryNodeRef, PackedBinaryNodeRef, ValueRef
+)
 
 class StubStorage(object):
+    format_version = 1
+
     def __init__(self):
         self.d = [0]
         self.locked = False
@@ -20,7 +24,7 @@ class StubStorage(object):
     def unlock(self):
         pass
 
-    def get_root_address(self):
+    def get_root_address(self, name=None):
         return 0
 
     def write(self, string):
@@ -31,6 +35,9 @@ class StubStorage(object):
     def read(self, address):
         return self.d[address]
 
+    def is_buffered(self, address):
+        return False
+
 class TestBinaryTree(object):
     def setup(self):
         self.tree = BinaryTree(StubStorage())
@@ -97,6 +104,20 @@ class TestBinaryTree(object):
         self.tree.get('a')
         self.tree.get('c')
 
+    def test_range(self):
+        keys = random.sample(range(100), 100)
+        for k in keys:
+            self.tree.set(k, str(k))
+        eq_(list(self.tree.keys()), list(range(100)))
+        eq_(list(self.tree.keys(reverse=True)), list(range(99, -1, -1)))
+        eq_(list(self.tree.items(10, 15)), [(k, str(k)) for k in range(10, 15)])
+        eq_(list(self.tree.keys(95, reverse=True)), [99, 98, 97, 96, 95])
+        eq_(list(self.tree.keys(stop=3)), [0, 1, 2])
+        eq_(list(self.tree.keys(50, 50)), [])
+
+    def test_range_empty_tree(self):
+        eq_(list(self.tree.items()), [])
+
 class TestBinaryNodeRef(object):
     def test_to_string_leaf(self):
         n = BinaryNode(BinaryNodeRef(), 'k', ValueRef(address=999), BinaryNodeRef(), 1)
@@ -116,4 +137,26 @@ class TestBinaryNodeRef(object):
         eq_(d['left'], 123)
         eq_(d['key'], 'k')
         eq_(d['value'], 999)
-        eq_(d['right'], 321)
\ No newline at end of file
+        eq_(d['right'], 321)
+
+class TestPackedBinaryNodeRef(object):
+    def test_round_trip(self):
+        left_ref = PackedBinaryNodeRef(address=123)
+        right_ref = PackedBinaryNodeRef(address=321)
+        for key in ['k', u'\u952e', b'k', 42, ('a', 1)]:
+            n = BinaryNode(left_ref, key, ValueRef(address=999), right_ref, 3)
+            string = PackedBinaryNodeRef.referent_to_string(n)
+            node = PackedBinaryNodeRef.string_to_referent(memoryview(string))
+            eq_(node.left_ref.address, 123)
+            eq_(node.key, key)
+            eq_(node.value_ref.address, 999)
+            eq_(node.right_ref.address, 321)
+            eq_(node.length, 3)
+            ok_(isinstance(node.left_ref, PackedBinaryNodeRef))
+
+    def test_smaller_than_pickle(self):
+        n = BinaryNode(BinaryNodeRef(address=123), 'key', ValueRef(address=999),
+                       BinaryNodeRef(address=321), 3)
+        eq_(len(PackedBinaryNodeRef.referent_to_string(n)), 33 + 3)
+        ok_(len(PackedBinaryNodeRef.referent_to_string(n)) <
+            len(BinaryNodeRef.referent_to_string(n)))
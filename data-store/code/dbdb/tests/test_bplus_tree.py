@@ -0,0 +1,117 @@
+import random
+
+from nose.tools import assert_raises, eq_, ok_
+
+from dbdb.bplus_tree import BPlusNode, BPlusNodeRef, BPlusTree
+from dbdb.logical import ValueRef
+from dbdb.tests.test_binary_tree import StubStorage
+
+class SmallPageTree(BPlusTree):
+    # 页很小，少量的键就能触发多层分裂
+    max_keys = 4
+
+class TestBPlusTree(object):
+    def setup(self):
+        self.tree = SmallPageTree(StubStorage())
+
+    def _check_page(self, ref, low=None, high=None):
+        """检查页内键有序且落在分隔键范围内，返回 (子树高度, 键数)
+        """
+        node = self.tree._follow(ref)
+        ok_(len(node.keys) <= self.tree.max_keys)
+        eq_(node.keys, sorted(node.keys))
+        for key in node.keys:
+            ok_(low is None or not key < low)
+            ok_(high is None or key < high)
+        if node.leaf:
+            return 1, len(node.keys)
+        eq_(len(node.refs), len(node.keys) + 1)
+        bounds = [low] + list(node.keys) + [high]
+        heights = set()
+        for i, child_ref in enumerate(node.refs):
+            height, length = self._check_page(child_ref, bounds[i], bounds[i + 1])
+            eq_(node.counts[i], length)
+            heights.add(height)
+        eq_(len(heights), 1)
+        return heights.pop() + 1, node.length
+
+    def test_get_missing_key_raises_key_error(self):
+        with assert_raises(KeyError):
+            self.tree.get('Not A Key In The Tree')
+
+    def test_sequential_inserts_split_pages(self):
+        for i in range(200):
+            self.tree.set(i, str(i))
+        height, length = self._check_page(self.tree._tree_ref)
+        eq_(length, 200)
+        ok_(height <= 6)
+        for i in range(200):
+            eq_(self.tree.get(i), str(i))
+
+    def test_random_set_and_pop(self):
+        keys = random.sample(range(10000), 300)
+        for i, k in enumerate(keys, start=1):
+            self.tree.set(k, str(k))
+            eq_(len(self.tree), i)
+        self._check_page(self.tree._tree_ref)
+        random.shuffle(keys)
+        for i, k in enumerate(keys, start=1):
+            self.tree.pop(k)
+            eq_(len(self.tree), len(keys) - i)
+            if i < len(keys):
+                self._check_page(self.tree._tree_ref)
+        with assert_raises(KeyError):
+            self.tree.get(keys[0])
+
+    def test_load_fills_pages(self):
+        for n in [0, 1, 4, 5, 21, 200]:
+            self.tree.load(((i, str(i)) for i in range(n)), n)
+            eq_(list(self.tree.items()), [(i, str(i)) for i in range(n)])
+            if n:
+                height, length = self._check_page(self.tree._tree_ref)
+                eq_(length, n)
+        self.tree.set(-1, '-1')
+        self.tree.pop(100)
+        self._check_page(self.tree._tree_ref)
+
+    def test_overwrite_and_get_key(self):
+        self.tree.set('a', 'b')
+        self.tree.set('a', 'c')
+        eq_(self.tree.get('a'), 'c')
+        eq_(len(self.tree), 1)
+
+    def test_pop_non_existent_key(self):
+        self.tree.set('a', 'b')
+        with assert_raises(KeyError):
+            self.tree.pop('Not A Key In The Tree')
+
+    def test_range(self):
+        keys = random.sample(range(200), 200)
+        for k in keys:
+            self.tree.set(k, str(k))
+        eq_(list(self.tree.keys()), list(range(200)))
+        eq_(list(self.tree.keys(reverse=True)), list(range(199, -1, -1)))
+        eq_(list(self.tree.items(10, 15)), [(k, str(k)) for k in range(10, 15)])
+        eq_(list(self.tree.keys(37, 45, reverse=True)), list(range(44, 36, -1)))
+        eq_(list(self.tree.keys(stop=3)), [0, 1, 2])
+        eq_(list(self.tree.keys(50, 50)), [])
+
+class TestBPlusNodeRef(object):
+    def test_round_trip_internal(self):
+        n = BPlusNode(
+            False, ['m'], [BPlusNodeRef(address=12), BPlusNodeRef(address=34)], [3, 5]
+        )
+        node = BPlusNodeRef.string_to_referent(BPlusNodeRef.referent_to_string(n))
+        ok_(not node.leaf)
+        eq_(node.keys, ['m'])
+        eq_([ref.address for ref in node.refs], [12, 34])
+        ok_(isinstance(node.refs[0], BPlusNodeRef))
+        eq_(node.length, 8)
+
+    def test_round_trip_leaf(self):
+        n = BPlusNode(True, ['a', 'b'], [ValueRef(address=56), ValueRef(address=78)])
+        node = BPlusNodeRef.string_to_referent(BPlusNodeRef.referent_to_string(n))
+        ok_(node.leaf)
+        eq_(node.keys, ['a', 'b'])
+        eq_([ref.address for ref in node.refs], [56, 78])
+        eq_(node.length, 2)
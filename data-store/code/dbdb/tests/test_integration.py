@@ -1,14 +1,21 @@
 import os
 import os.path
+import pickle
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import win32file
+import zlib
 
-from nose.tools import assert_raises, eq_
+from nose.tools import assert_raises, eq_, ok_
 
 import dbdb
 import dbdb.tool
+from dbdb.bplus_tree import BPlusNode
+from dbdb.physical import Storage
+from dbdb.wal import WriteAheadLog
 
 class TestDatabase(object):
     def setup(self):
@@ -47,6 +54,587 @@ class TestDatabase(object):
         eq_(len(db), 3)
         db.close()
 
+    def test_legacy_format(self):
+        # 没有文件头的旧文件仍然使用 pickle 编码的节点
+        with open(self.tempfile_name, 'wb') as f:
+            f.write(b'\x00' * 4096)
+        for tree in ['binary', 'balanced']:
+            db = dbdb.connect(self.tempfile_name, tree=tree)
+            eq_(db._storage.format_version, 0)
+            db['a'] = 'aye'
+            db.commit()
+            db.close()
+            db = dbdb.connect(self.tempfile_name, tree=tree)
+            eq_(db['a'], 'aye')
+            del db['a']
+            db.commit()
+            db.close()
+
+    def test_mmap_persistence(self):
+        db = dbdb.connect(self.tempfile_name, mmap=True)
+        db['b'] = 'bee'
+        db.commit()
+        eq_(db['b'], 'bee')
+        # 提交后文件变长，读取新节点需要重新映射
+        db['a'] = 'aye'
+        db['c'] = 'see'
+        db.commit()
+        eq_(db['a'], 'aye')
+        eq_(db['c'], 'see')
+        db.close()
+        db = dbdb.connect(self.tempfile_name, mmap=True)
+        eq_(list(db.items()), [('a', 'aye'), ('b', 'bee'), ('c', 'see')])
+        db.close()
+
+    def test_iteration(self):
+        db = dbdb.connect(self.tempfile_name)
+        for key in ['d', 'b', 'a', 'c', 'e']:
+            db[key] = key * 2
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db), ['a', 'b', 'c', 'd', 'e'])
+        eq_(list(db.keys()), ['a', 'b', 'c', 'd', 'e'])
+        eq_(list(db.items())[0], ('a', 'aa'))
+        eq_(list(db.range('b', 'd')), [('b', 'bb'), ('c', 'cc')])
+        eq_(list(db.range('b', 'd', reverse=True)), [('c', 'cc'), ('b', 'bb')])
+        db.close()
+
+    def test_batch(self):
+        db = dbdb.connect(self.tempfile_name)
+        with db.batch():
+            for key in ['b', 'a', 'c']:
+                db[key] = key * 3
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db.items()), [('a', 'aaa'), ('b', 'bbb'), ('c', 'ccc')])
+        db.close()
+
+    def test_batch_rollback(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        with assert_raises(KeyError):
+            with db.batch():
+                db['b'] = 'bee'
+                del db['missing']
+        eq_(list(db.keys()), ['a'])
+        db['c'] = 'see'
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db.keys()), ['a', 'c'])
+        db.close()
+
+    def test_reader_sees_other_commits(self):
+        reader = dbdb.connect(self.tempfile_name)
+        writer = dbdb.connect(self.tempfile_name)
+        writer['a'] = 'aye'
+        writer.commit()
+        eq_(reader['a'], 'aye')
+        writer['a'] = 'ay'
+        writer.commit()
+        eq_(reader['a'], 'ay')
+        writer.close()
+        reader.close()
+
+    def test_snapshot(self):
+        for tree in ['binary', 'balanced', 'bplus']:
+            name = os.path.join(self.temp_dir, tree + '.db')
+            db = dbdb.connect(name, tree=tree)
+            writer = dbdb.connect(name, tree=tree)
+            for i in range(100):
+                writer['%03d' % i] = 'old'
+            writer.commit()
+            with db.snapshot() as snap:
+                for i in range(0, 100, 2):
+                    writer['%03d' % i] = 'new'
+                del writer['099']
+                writer['100'] = 'new'
+                writer.commit()
+                eq_(db['000'], 'new')
+                eq_(snap['000'], 'old')
+                ok_('099' in snap)
+                ok_('100' not in snap)
+                eq_(len(snap), 100)
+                eq_(list(snap), ['%03d' % i for i in range(100)])
+                eq_(list(snap.range('010', '013')),
+                    [('010', 'old'), ('011', 'old'), ('012', 'old')])
+                ok_(all(value == 'old' for key, value in snap.items()))
+            with assert_raises(ValueError):
+                snap['000']
+            with db.snapshot() as snap:
+                eq_(snap['000'], 'new')
+                eq_(len(snap), 100)
+            writer.close()
+            db.close()
+
+    def test_wal(self):
+        db = dbdb.connect(self.tempfile_name, wal=True)
+        for i in range(10):
+            db['%02d' % i] = 'old'
+        db.commit()
+        wal_name = self.tempfile_name + '-wal'
+        ok_(os.path.getsize(wal_name) > 0)
+        db.checkpoint()
+        eq_(os.path.getsize(wal_name), 0)
+        db['05'] = 'new'
+        db['10'] = 'new'
+        del db['00']
+        eq_(db['05'], 'new')
+        ok_('00' not in db)
+        eq_(len(db), 10)
+        with db.snapshot() as snap:
+            eq_(snap['05'], 'old')
+            ok_('00' in snap)
+        db.commit()
+        with db.snapshot() as snap:
+            eq_(snap['05'], 'new')
+            eq_(len(snap), 10)
+        eq_(list(db), ['%02d' % i for i in range(1, 11)])
+        eq_(list(db.range('04', '07', reverse=True)),
+            [('06', 'old'), ('05', 'new'), ('04', 'old')])
+        with assert_raises(KeyError):
+            del db['00']
+        # 同一进程中的 WAL 连接共享日志
+        other = dbdb.connect(self.tempfile_name, wal=True)
+        eq_(other['10'], 'new')
+        other.close()
+        db.close()
+        ok_(not os.path.exists(wal_name))
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['05'], 'new')
+        eq_(len(db), 10)
+        db.close()
+
+    def test_wal_recovery(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        db.close()
+        records = [[('s', 'b', 'bee')], [('d', 'a'), ('s', 'c', 'see')]]
+        with open(self.tempfile_name + '-wal', 'wb') as f:
+            for ops in records:
+                data = pickle.dumps(ops)
+                f.write(WriteAheadLog.RECORD_HEADER.pack(len(data), zlib.crc32(data)))
+                f.write(data)
+            # 写了一半的记录在恢复时被丢弃
+            f.write(WriteAheadLog.RECORD_HEADER.pack(100, 0) + b'xx')
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db.items()), [('b', 'bee'), ('c', 'see')])
+        db.close()
+        ok_(not os.path.exists(self.tempfile_name + '-wal'))
+
+    def test_wal_group_commit(self):
+        db = dbdb.connect(self.tempfile_name, wal=True)
+        log = db._wal
+        fsyncs = log.fsyncs
+        connections = [dbdb.connect(self.tempfile_name, wal=True)
+                       for _ in range(4)]
+
+        def commit(conn, i):
+            conn['%d' % i] = 'v'
+            conn.commit()
+
+        # 第一个 fsync 被挡住时，其余的提交都写入了日志，随后一次 fsync 全部落盘
+        with log._sync_lock:
+            threads = [threading.Thread(target=commit, args=(conn, i))
+                       for i, conn in enumerate(connections)]
+            for t in threads:
+                t.start()
+            while len(log._overlay) < 4:
+                time.sleep(0.001)
+        for t in threads:
+            t.join()
+        eq_(log.fsyncs, fsyncs + 1)
+        eq_(len(db), 4)
+        for conn in connections:
+            conn.close()
+        db.close()
+
+    def test_scan_does_not_retain_nodes(self):
+        # 遍历读过的节点不能挂在当前的树上，否则内存随扫描的记录数增长
+        def loaded(node):
+            if isinstance(node, BPlusNode):
+                refs = [] if node.leaf else node.refs
+            else:
+                refs = [node.left_ref, node.right_ref]
+            return [ref for ref in refs if ref._referent is not None]
+        for tree in ['binary', 'balanced', 'bplus']:
+            name = os.path.join(self.temp_dir, tree + '.db')
+            db = dbdb.connect(name, tree=tree, cache_size=0)
+            with db.batch():
+                for i in range(200):
+                    db['%03d' % ((i * 37) % 200)] = 'v'
+            db.close()
+            db = dbdb.connect(name, tree=tree, cache_size=0)
+            eq_(len(list(db.items())), 200)
+            eq_(len(list(db.range('050', '150', reverse=True))), 100)
+            root = db._tree._follow(db._tree._tree_ref)
+            eq_(loaded(root), [])
+            db.close()
+
+    def test_bloom(self):
+        db = dbdb.connect(self.tempfile_name, tree='balanced', bloom=True)
+        for i in range(100):
+            db['%03d' % i] = str(i)
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree='balanced', bloom=True)
+        ok_('050' in db)
+        ok_('abc' not in db)
+        ok_(db._tree._bloom is not None)
+        with db.snapshot() as snap:
+            ok_('abc' not in snap)
+            eq_(snap['050'], '50')
+        db.close()
+        dbdb.compact(self.tempfile_name, self.new_tempfile_name, tree='balanced')
+        db = dbdb.connect(self.new_tempfile_name, tree='balanced', bloom=True)
+        ok_('abc' not in db)
+        eq_(db._tree._bloom.count, 100)
+        db.close()
+
+    def test_bloom_numeric_keys(self):
+        # 1、1.0 和 True 是同一个键，过滤器不能给出假阴性
+        db = dbdb.connect(self.tempfile_name, tree='balanced', bloom=True,
+                          codec='pickle')
+        db[1] = 'one'
+        db.commit()
+        for key in [1, 1.0, True]:
+            ok_(key in db)
+            eq_(db[key], 'one')
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree='balanced', bloom=True)
+        ok_(1.0 in db)
+        ok_(2 not in db)
+        db.close()
+
+    def test_codecs(self):
+        blob = '{"data": [%s]}' % ', '.join(['"value"'] * 1000)
+        sizes = {}
+        for codec, value in [('utf-8', blob), ('raw', b'\x00\xff'),
+                             ('pickle', {'a': [1, 2.5, None]}),
+                             ('zlib', blob), ('lzma', blob)]:
+            name = os.path.join(self.temp_dir, codec + '.db')
+            db = dbdb.connect(name, tree='balanced', codec=codec)
+            for i in range(10):
+                db['%d' % i] = value
+            db.commit()
+            db.close()
+            sizes[codec] = os.path.getsize(name)
+            # 编码记录在文件头中，打开时不必再指定
+            db = dbdb.connect(name, tree='balanced')
+            eq_(db['5'], value)
+            eq_(list(db.items()), [('%d' % i, value) for i in range(10)])
+            with db.snapshot() as snap:
+                eq_(snap['5'], value)
+            db.close()
+        ok_(sizes['zlib'] < sizes['utf-8'] / 10)
+        ok_(sizes['lzma'] < sizes['utf-8'] / 10)
+        name = os.path.join(self.temp_dir, 'zlib.db')
+        with assert_raises(ValueError):
+            dbdb.connect(name, codec='pickle')
+        with assert_raises(ValueError):
+            dbdb.connect(self.tempfile_name, codec='nope')
+
+    def test_codec_of_existing_database(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        db.close()
+        with assert_raises(ValueError):
+            dbdb.connect(self.tempfile_name, codec='zlib')
+        dbdb.compact(self.tempfile_name, self.new_tempfile_name, codec='zlib')
+        db = dbdb.connect(self.new_tempfile_name)
+        eq_(db._tree.value_ref_class.codec, 'zlib')
+        eq_(db['a'], 'aye')
+        db.close()
+
+    def test_tree_of_existing_database(self):
+        db = dbdb.connect(self.tempfile_name, tree='bplus')
+        db.close()
+        # 空数据库可以换一种树，不指定时沿用记录的树
+        db = dbdb.connect(self.tempfile_name)
+        eq_(type(db._tree).__name__, 'BPlusTree')
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree='binary')
+        db['a'] = 'aye'
+        db.commit()
+        db.close()
+        with assert_raises(ValueError):
+            dbdb.connect(self.tempfile_name, tree='bplus')
+        with assert_raises(ValueError):
+            dbdb.compact(self.tempfile_name, tree='bplus')
+        # 没有记录树的旧文件不做检查，压缩失败时不留下临时文件
+        with open(self.tempfile_name, 'r+b') as f:
+            f.seek(Storage.TREE_OFFSET)
+            f.write(b'\x00' * Storage.TREE_LENGTH)
+        with assert_raises(Exception):
+            dbdb.compact(self.tempfile_name, tree='bplus')
+        ok_(not os.path.exists(self.tempfile_name + '.compact'))
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['a'], 'aye')
+        db.close()
+
+    def _check_indexes(self, tree):
+        def by_city(value):
+            return value.get('city')
+        db = dbdb.connect(self.tempfile_name, tree=tree, codec='pickle')
+        db['ann'] = {'city': 'paris'}
+        db['bob'] = {'city': 'rome'}
+        db.commit()
+        db.create_index('by_city', by_city)
+        db['cat'] = {'city': 'paris'}
+        db['dan'] = {}
+        db['bob'] = {'city': 'paris'}
+        db.commit()
+        eq_([key for key, value in db.find('by_city', 'paris')],
+            ['ann', 'bob', 'cat'])
+        eq_(list(db.find('by_city', 'rome')), [])
+        del db['ann']
+        with db.batch():
+            db['eve'] = {'city': 'rome'}
+        eq_(list(db.find('by_city', 'rome')), [('eve', {'city': 'rome'})])
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree=tree, codec='pickle')
+        db.create_index('by_city', by_city)
+        # 文件中已有索引，不再遍历主树
+        ok_(db._storage.get_root_address('by_city'))
+        eq_([key for key, value in db.find('by_city', 'paris')], ['bob', 'cat'])
+        db.drop_index('by_city')
+        ok_('by_city' not in db._storage.get_root_table())
+        eq_(db['bob'], {'city': 'paris'})
+        db.close()
+
+    def test_indexes(self):
+        self._check_indexes('binary')
+
+    def test_indexes_balanced(self):
+        self._check_indexes('balanced')
+
+    def test_indexes_bplus(self):
+        self._check_indexes('bplus')
+
+    def test_index_rebuilt_after_other_writer(self):
+        def first_letter(value):
+            return value[0]
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'apple'
+        db.commit()
+        db.create_index('first', first_letter)
+        other = dbdb.connect(self.tempfile_name)
+        other['b'] = 'avocado'
+        other.commit()
+        # other 没有维护索引，提交时丢弃了它
+        ok_('first' not in db._storage.get_root_table())
+        eq_([key for key, value in db.find('first', 'a')], ['a', 'b'])
+        other.close()
+        db.close()
+
+    def test_index_batch_rollback(self):
+        def length(value):
+            return len(value)
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'x'
+        db.commit()
+        with assert_raises(ZeroDivisionError):
+            with db.batch():
+                db['b'] = 'yy'
+                db.create_index('length', length)
+                eq_([key for key, value in db.find('length', 2)], ['b'])
+                1 / 0
+        # 索引仍然登记在连接上，下一次使用时重建
+        ok_('length' not in db._storage.get_root_table())
+        with assert_raises(ValueError):
+            db.create_index('length', length)
+        eq_(list(db.find('length', 2)), [])
+        eq_(list(db.find('length', 1)), [('a', 'x')])
+        db.close()
+
+    def test_batch_rollback_node_cache(self):
+        # 回滚的批量写入读过的节点不能留在缓存中，下一次写入会复用这些地址
+        def last_letter(value):
+            return value[-1]
+        db = dbdb.connect(self.tempfile_name, tree='balanced')
+        for i in range(20):
+            db['k%02d' % i] = 'v%d' % i
+        db.commit()
+        with assert_raises(ZeroDivisionError):
+            with db.batch():
+                db['k05'] = 'CHANGED1'
+                db.create_index('last', last_letter)
+                eq_([key for key, value in db.find('last', '1')],
+                    ['k01', 'k05', 'k11'])
+                1 / 0
+        with db.batch():
+            db['k04'] = 'CHANGED4'
+            for i in range(20, 30):
+                db['k%02d' % i] = 'v%d' % i
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree='balanced')
+        eq_(db['k05'], 'v5')
+        eq_(db['k04'], 'CHANGED4')
+        db.create_index('last', last_letter)
+        eq_([key for key, value in db.find('last', '1')],
+            ['k01', 'k11', 'k21'])
+        eq_([key for key, value in db.find('last', '4')],
+            ['k04', 'k14', 'k24'])
+        db.close()
+
+    def test_index_in_wal_mode(self):
+        db = dbdb.connect(self.tempfile_name, wal=True)
+        with assert_raises(ValueError):
+            db.create_index('length', len)
+        db.close()
+
+    def test_contains_does_not_decode_values(self):
+        db = dbdb.connect(self.tempfile_name, codec='pickle')
+        db['a'] = 'aye'
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name, cache_size=0)
+        value_ref_class = db._tree.value_ref_class
+        decode = value_ref_class.__dict__['string_to_referent']
+        value_ref_class.string_to_referent = None
+        try:
+            ok_('a' in db)
+            ok_('b' not in db)
+            eq_(list(db.keys()), ['a'])
+            with db.snapshot() as snap:
+                ok_('a' in snap)
+        finally:
+            value_ref_class.string_to_referent = decode
+        eq_(db['a'], 'aye')
+        db.close()
+
+    def _check_compact(self, tree):
+        db = dbdb.connect(self.tempfile_name, tree=tree)
+        for i in range(300):
+            db['%03d' % i] = 'old'
+            db.commit()
+        for i in range(0, 300, 3):
+            db['%03d' % i] = 'new'
+        for i in range(1, 300, 3):
+            del db['%03d' % i]
+        db.commit()
+        expected = list(db.items())
+        db.close()
+        size = os.path.getsize(self.tempfile_name)
+
+        dbdb.compact(self.tempfile_name, self.new_tempfile_name, tree=tree)
+        ok_(os.path.getsize(self.new_tempfile_name) < size / 5)
+        db = dbdb.connect(self.new_tempfile_name, tree=tree)
+        eq_(list(db.items()), expected)
+        eq_(len(db), 200)
+        db['zzz'] = 'z'
+        del db['000']
+        db.commit()
+        eq_(db['zzz'], 'z')
+        eq_(len(db), 200)
+        db.close()
+
+    def test_compact(self):
+        self._check_compact('binary')
+
+    def test_compact_balanced(self):
+        self._check_compact('balanced')
+
+    def test_compact_bplus(self):
+        self._check_compact('bplus')
+
+    def test_compact_in_place(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        db['a'] = 'ay'
+        db['b'] = 'bee'
+        db.commit()
+        reader = dbdb.connect(self.tempfile_name)
+        dbdb.compact(self.tempfile_name)
+        ok_(not os.path.exists(self.tempfile_name + '.compact'))
+        # 已经打开的读者继续读取旧文件
+        eq_(reader['b'], 'bee')
+        # 旧文件上的写入者必须重新连接
+        with assert_raises(RuntimeError):
+            db['c'] = 'see'
+        db.close()
+        reader.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db.items()), [('a', 'ay'), ('b', 'bee')])
+        db.close()
+
+    def _check_bulk_load(self, tree):
+        items = [('%05d' % i, str(i)) for i in range(1000)]
+        for length, source in [(1000, iter(items)), (None, items),
+                               (None, iter(items))]:
+            dbdb.bulk_load(self.new_tempfile_name, source, length, tree=tree)
+            db = dbdb.connect(self.new_tempfile_name, tree=tree)
+            eq_(len(db), 1000)
+            eq_(list(db.items()), items)
+            db['00500'] = 'x'
+            del db['00000']
+            db.commit()
+            eq_(db['00500'], 'x')
+            db.close()
+            os.remove(self.new_tempfile_name)
+
+    def test_bulk_load(self):
+        self._check_bulk_load('binary')
+
+    def test_bulk_load_balanced(self):
+        self._check_bulk_load('balanced')
+
+    def test_bulk_load_bplus(self):
+        self._check_bulk_load('bplus')
+
+    def test_bulk_load_writes_each_node_once(self):
+        items = [('%05d' % i, 'v') for i in range(1000)]
+        dbdb.bulk_load(self.new_tempfile_name, items)
+        dbdb.compact(self.new_tempfile_name, self.tempfile_name)
+        eq_(os.path.getsize(self.new_tempfile_name),
+            os.path.getsize(self.tempfile_name))
+
+    def test_bulk_load_rejects_bad_input(self):
+        for tree in ['binary', 'bplus']:
+            for length, source in [(None, [('b', '1'), ('a', '2')]),
+                                   (None, [('a', '1'), ('a', '2')]),
+                                   (3, [('a', '1'), ('b', '2')]),
+                                   (1, [('a', '1'), ('b', '2')])]:
+                with assert_raises(ValueError):
+                    dbdb.bulk_load(self.new_tempfile_name, iter(source),
+                                   length, tree=tree)
+                ok_(not os.path.exists(self.new_tempfile_name))
+                ok_(not os.path.exists(self.new_tempfile_name + '.load'))
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        db.close()
+        with assert_raises(ValueError):
+            dbdb.bulk_load(self.tempfile_name, [('b', 'bee')])
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db.items()), [('a', 'aye')])
+        db.close()
+
+    def test_bplus_persistence(self):
+        db = dbdb.connect(self.tempfile_name, tree='bplus')
+        for i in range(1000):
+            db['%04d' % i] = str(i)
+        db.commit()
+        del db['0500']
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree='bplus')
+        eq_(len(db), 1000)
+        eq_(db['0500'], '500')
+        del db['0500']
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree='bplus')
+        eq_(len(db), 999)
+        with assert_raises(KeyError):
+            db['0500']
+        eq_(db['0999'], '999')
+        db.close()
+
 class TestTool(object):
     def setup(self):
         self.tempfile_name = os.path.join(os.getcwd(), "temp2.db")
@@ -68,6 +656,22 @@ class TestTool(object):
             self._tool('get', 'a')
         eq_(raised.exception.returncode, dbdb.tool.BAD_KEY)
     
+    def test_compact(self):
+        self._tool('set', 'a', b'b')
+        self._tool('set', 'a', b'c')
+        self._tool('compact')
+        eq_(self._tool('get', 'a'), b'c')
+
+    def test_compact_recorded_tree(self):
+        db = dbdb.connect(self.tempfile_name, tree='balanced')
+        db['a'] = 'b'
+        db.commit()
+        db.close()
+        self._tool('compact')
+        eq_(self._tool('get', 'a'), b'b')
+        with assert_raises(subprocess.CalledProcessError):
+            self._tool('compact', 'bplus')
+
     def test_tool(self):
         expected = b'b'
         self._tool('set', 'a', expected)
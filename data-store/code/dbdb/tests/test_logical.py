@@ -0,0 +1,149 @@
+import random
+
+from nose.tools import assert_raises, eq_, ok_
+
+from dbdb.binary_tree import BinaryTree
+from dbdb.bloom import BloomFilter
+from dbdb.logical import NodeCache
+from dbdb.tests.test_binary_tree import StubStorage
+
+class CountingStorage(StubStorage):
+    def __init__(self):
+        super(CountingStorage, self).__init__()
+        self.reads = 0
+        self.root_address = 0
+        self.bloom_address = 0
+
+    def read(self, address):
+        self.reads += 1
+        return super(CountingStorage, self).read(address)
+
+    def get_root_address(self, name=None):
+        return self.root_address
+
+    def get_bloom_address(self):
+        return self.bloom_address
+
+    def commit_root_address(self, address, bloom_address=0, roots=None):
+        self.root_address = address
+        self.bloom_address = bloom_address
+        self.locked = False
+
+class TestNodeCache(object):
+    def test_evicts_least_recently_used(self):
+        cache = NodeCache(2)
+        cache.put(1, 'one')
+        cache.put(2, 'two')
+        eq_(cache.get(1), 'one')
+        cache.put(3, 'three')
+        eq_(cache.get(2), None)
+        eq_(cache.get(1), 'one')
+        eq_(cache.get(3), 'three')
+        eq_(cache.info(), (3, 1, 2, 2))
+
+class TestCachedTree(object):
+    def setup(self):
+        self.storage = CountingStorage()
+        self.tree = BinaryTree(self.storage)
+        for key in ['d', 'b', 'f', 'a', 'c', 'e', 'g']:
+            self.tree.set(key, key.upper())
+        self.tree.commit()
+
+    def test_cached_nodes_survive_refresh(self):
+        eq_(self.tree.get('g'), 'G')
+        reads = self.storage.reads
+        eq_(self.tree.get('g'), 'G')
+        # 节点都来自缓存，只有值需要重新读取
+        eq_(self.storage.reads, reads + 1)
+        ok_(self.tree.cache_info().hits >= 3)
+
+    def test_cached_nodes_are_not_shared(self):
+        self.tree.get('a')
+        self.tree.get('g')
+        # 缓存中的根节点不会通过子节点引用持有已加载的子树
+        root = self.tree._node_cache.get(self.storage.root_address)
+        eq_(root.left_ref._referent, None)
+        eq_(root.right_ref._referent, None)
+
+    def test_disabled_cache(self):
+        tree = BinaryTree(self.storage, cache_size=0)
+        eq_(tree.get('a'), 'A')
+        eq_(tree.cache_info(), None)
+
+class TestBloomFilter(object):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        keys = [b'key%d' % i for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        ok_(all(key in bloom for key in keys))
+        misses = sum(b'other%d' % i in bloom for i in range(10000))
+        ok_(misses < 300)
+
+    def test_round_trip(self):
+        bloom = BloomFilter(100, root_address=42)
+        bloom.add(b'a')
+        copy = BloomFilter.from_bytes(memoryview(bloom.to_bytes()))
+        eq_(copy.root_address, 42)
+        eq_(copy.count, 1)
+        ok_(b'a' in copy)
+
+class TestBloomTree(object):
+    def setup(self):
+        self.storage = CountingStorage()
+        self.tree = BinaryTree(self.storage, cache_size=0, bloom=True)
+        for key in ['d', 'b', 'f', 'a', 'c', 'e', 'g']:
+            self.tree.set(key, key.upper())
+        self.tree.commit()
+
+    def _miss_reads(self, tree, keys):
+        reads = self.storage.reads
+        for key in keys:
+            with assert_raises(KeyError):
+                tree.get(key)
+        return self.storage.reads - reads
+
+    def test_misses_skip_tree(self):
+        eq_(self.tree.get('a'), 'A')
+        misses = ['x%d' % i for i in range(100)]
+        # 只有第一次读取过滤器本身，误判的键才会读取节点
+        ok_(self._miss_reads(self.tree, misses) < 10)
+        plain = BinaryTree(self.storage, cache_size=0)
+        ok_(self._miss_reads(plain, misses) >= 300)
+
+    def test_updates_after_commit(self):
+        self.tree.set('x', 'X')
+        self.tree.pop('a')
+        self.tree.commit()
+        eq_(self.tree.get('x'), 'X')
+        with assert_raises(KeyError):
+            self.tree.get('a')
+        bloom = self.tree._bloom_for(self.storage.root_address)
+        eq_(bloom.root_address, self.storage.root_address)
+
+    def test_stale_filter_is_ignored(self):
+        # 没有启用过滤器的写入者提交后，旧的过滤器不再使用
+        plain = BinaryTree(self.storage)
+        plain.set('x', 'X')
+        plain.commit()
+        eq_(self.storage.bloom_address, 0)
+        eq_(self.tree.get('x'), 'X')
+        self.tree.set('y', 'Y')
+        self.tree.commit()
+        eq_(self.tree.get('x'), 'X')
+        ok_(self.tree._bloom_base.count >= 9)
+
+    def test_rebuild_when_full(self):
+        tree = BinaryTree(CountingStorage(), bloom=True)
+        tree.bloom_min_capacity = 8
+        tree.set('a', 'A')
+        tree.commit()
+        eq_(tree._bloom.capacity, 8)
+        keys = ['k%02d' % i for i in range(20)]
+        random.shuffle(keys)
+        for key in keys:
+            tree.set(key, 'v')
+        tree.commit()
+        eq_(tree._bloom.capacity, 42)
+        for key in keys:
+            eq_(tree.get(key), 'v')
@@ -2,18 +2,19 @@ import os
 import uuid
 import shutil
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dbdb.physical import Storage
+from dbdb.physical import MmapStorage, Storage
 
 class TestStorage(object):
+    storage_class = Storage
 
     def setup(self):
         self.temp_dir = os.path.join(os.getcwd(), uuid.uuid4().hex)
         if not os.path.exists(self.temp_dir):
             os.mkdir(self.temp_dir)
         self.f = open(os.path.join(self.temp_dir, "temp.db"), "wb+")
-        self.p = Storage(self.f)
+        self.p = self.storage_class(self.f)
 
     def teardown(self):
         if not self.f.closed:
@@ -32,10 +33,20 @@ class TestStorage(object):
             return f.read()
 
     def test_init_ensures_superblock(self):
-        EMPTY_SUPERBLOCK = (b'\x00' * Storage.SUPERBLOCK_SIZE)
+        EMPTY_SUPERBLOCK = (b'\x00' * 8 + b'DBDB\x00\x01' +
+                            b'\x00' * (Storage.SUPERBLOCK_SIZE - 14))
         self.f.seek(0, os.SEEK_END)
         value = self._get_f_contents()
         eq_(value, EMPTY_SUPERBLOCK)
+        eq_(self.p.format_version, Storage.FORMAT_VERSION)
+
+    def test_legacy_superblock(self):
+        self.f.close()
+        with open(self.f.name, 'wb') as f:
+            f.write(b'\x00' * Storage.SUPERBLOCK_SIZE)
+        self.f = open(self.f.name, 'r+b')
+        self.p = self.storage_class(self.f)
+        eq_(self.p.format_version, 0)
 
     def test_write(self):
         self.p.write(b'ABCDE')
@@ -72,3 +83,60 @@ class TestStorage(object):
         eq_(self.p.read(a3), b'three')
         eq_(self.p.read(a4), b'four')
         eq_(self.p.get_root_address(), a4)
+
+    def test_root_table(self):
+        a1 = self.p.write(b'one')
+        self.p.commit_root_address(a1)
+        eq_(self.p.get_root_table(), {None: a1})
+        a2 = self.p.write(b'two')
+        a3 = self.p.write(b'three')
+        self.p.commit_root_address(a2, roots={'index': a3})
+        eq_(self.p.get_root_address(), a2)
+        eq_(self.p.get_root_address('index'), a3)
+        eq_(self.p.get_root_address('missing'), 0)
+        # 文件已经使用根表，没有给出 roots 时索引被丢弃
+        self.p.commit_root_address(a1)
+        eq_(self.p.get_root_table(), {None: a1})
+        self.p.close()
+        self.f = open(self.f.name, 'r+b')
+        self.p = self.storage_class(self.f)
+        eq_(self.p.get_root_table(), {None: a1})
+
+    def test_batch_write(self):
+        self.p.begin_batch()
+        a1 = self.p.write(b'one')
+        a2 = self.p.write(b'two')
+        eq_(a1, Storage.SUPERBLOCK_SIZE)
+        eq_(a2, a1 + 8 + 3)
+        eq_(self.p.read(a2), b'two')
+        self.f.seek(0, os.SEEK_END)
+        eq_(self.f.tell(), Storage.SUPERBLOCK_SIZE)
+        self.p.commit_root_address(a2)
+        a3 = self.p.write(b'three')
+        eq_(a3, a2 + 8 + 3)
+        self.p.commit_root_address(a3)
+        self.p.end_batch()
+        eq_(self.p.read(a1), b'one')
+        eq_(self.p.read(a3), b'three')
+        value = self._get_f_contents()
+        superblock, data = self._get_superblock_and_data(value)
+        eq_(data, b'\x00' * 7 + b'\x03one' + b'\x00' * 7 + b'\x03two' +
+            b'\x00' * 7 + b'\x05three')
+
+    def test_end_batch_discards_uncommitted(self):
+        self.p.begin_batch()
+        self.p.write(b'lost')
+        self.p.end_batch()
+        self.p.unlock()
+        value = self._get_f_contents()
+        eq_(len(value), Storage.SUPERBLOCK_SIZE)
+
+class TestMmapStorage(TestStorage):
+    storage_class = MmapStorage
+
+    def test_read_returns_memoryview(self):
+        address = self.p.write(b'ABCDE')
+        self.p.commit_root_address(address)
+        value = self.p.read(address)
+        ok_(isinstance(value, memoryview))
+        eq_(value, b'ABCDE')
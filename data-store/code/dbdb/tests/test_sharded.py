@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_raises, eq_, ok_
+
+import dbdb
+from dbdb.sharded import ShardedDBDB
+
+class TestShardedDBDB(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.temp_dir, 'sharded')
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_set_delete_commit(self):
+        with ShardedDBDB(self.directory, shards=3, processes=2) as db:
+            for i in range(100):
+                db['%03d' % i] = str(i)
+            eq_(db['042'], '42')
+            eq_(len(db), 100)
+            db.commit()
+            del db['042']
+            ok_('042' not in db)
+            with assert_raises(KeyError):
+                del db['042']
+            db['100'] = 'hundred'
+            db.commit()
+            eq_(len(db), 100)
+            db['101'] = 'lost'
+        eq_(sorted(os.listdir(self.directory)),
+            ['shard-000.db', 'shard-001.db', 'shard-002.db'])
+        with ShardedDBDB(self.directory, shards=3) as db:
+            with assert_raises(KeyError):
+                db['042']
+            ok_('101' not in db)
+            eq_(db['100'], 'hundred')
+            eq_(len(db), 100)
+        # 每个分片都是普通的 dbdb 文件，键按哈希分布
+        lengths = []
+        for name in sorted(os.listdir(self.directory)):
+            shard = dbdb.connect(os.path.join(self.directory, name))
+            lengths.append(len(shard))
+            shard.close()
+        eq_(sum(lengths), 100)
+        ok_(all(lengths))
+
+    def test_range_merges_shards(self):
+        with ShardedDBDB(self.directory, shards=4, tree='bplus') as db:
+            for i in range(50):
+                db['%02d' % i] = str(i)
+            db.commit()
+            db['10'] = 'ten'
+            del db['11']
+            expected = [('%02d' % i, str(i)) for i in range(5, 45) if i != 11]
+            expected[5] = ('10', 'ten')
+            eq_(list(db.range('05', '45')), expected)
+            eq_(list(db.keys()), ['%02d' % i for i in range(50) if i != 11])
+            eq_([key for key, value in db.range(reverse=True)][:3],
+                ['49', '48', '47'])
+
+    def test_shard_count_must_match(self):
+        ShardedDBDB(self.directory, shards=2).close()
+        with assert_raises(ValueError):
+            ShardedDBDB(self.directory, shards=3)
+        with assert_raises(ValueError):
+            ShardedDBDB(self.directory, shards=2, wal=True)
+
+    def test_shard_for_is_stable(self):
+        with ShardedDBDB(self.directory, shards=8) as db:
+            eq_(db.shard_for('key'), db.shard_for('key'))
+            ok_(len(set(db.shard_for(str(i)) for i in range(100))) == 8)
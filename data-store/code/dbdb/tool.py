@@ -5,7 +5,7 @@ import sys
 
 import dbdb
 
-OK = 0,
+OK = 0
 BAD_ARGS = 1
 BAD_VERB = 2
 BAD_KEY = 3
@@ -15,8 +15,25 @@ def usage():
     print("\tpython -m dbdb.tool DBNAME get KEY", file=sys.stderr)
     print("\tpython -m dbdb.tool DBNAME set KEY VALUE", file=sys.stderr)
     print("\tpython -m dbdb.tool DBNAME delete KEY VALUE", file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME compact [TREE]", file=sys.stderr)
+
+def compact(argv):
+    """压缩数据库文件，TREE 为 connect 的 tree 参数，省略时沿用文件中记录的树
+    """
+    if len(argv) > 4:
+        usage()
+        return BAD_ARGS
+    tree = argv[3] if len(argv) == 4 else None
+    try:
+        dbdb.compact(argv[1], tree=tree)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return BAD_ARGS
+    return OK
 
 def main(argv):
+    if len(argv) >= 3 and argv[2] == 'compact':
+        return compact(argv)
     if not (4 <= len(argv) <= 5):
         usage()
         return BAD_ARGS
@@ -0,0 +1,225 @@
+'''
+预写日志（WAL）
+
+WAL 模式下提交不再重写树中的整条路径，只把本次提交的修改作为一条记录
+追加到 `数据库名-wal` 文件并 fsync。已提交但还没写进树的修改保存在内存
+中的覆盖层里，读取时先查覆盖层再查树。后台的检查点线程定期把覆盖层
+合并进树，然后从日志中去掉已经合并的记录。
+
+同一进程内对同一个文件的 WAL 连接共享一个 WriteAheadLog，同时提交的
+连接共用一次 fsync（组提交）。日志文件被一个进程独占，其他进程只能
+在检查点之后看到这些修改。
+'''
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+import dbdb.locks as locks
+
+# 覆盖层中表示键已被删除
+TOMBSTONE = object()
+
+class WriteAheadLog(object):
+    """一个数据库文件的预写日志
+
+    每条记录是一次提交：长度、crc32 和 pickle 后的操作列表，操作为
+    ('s', key, value) 或 ('d', key)。恢复时只重放校验通过的最长前缀，
+    写了一半的记录被丢弃。
+    """
+    RECORD_HEADER = struct.Struct("!II")
+
+    # 进程内按日志路径共享的实例
+    _logs = {}
+    _logs_lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, path, open_db, **kwargs):
+        """获取 path 的日志，已经打开时增加引用计数
+
+        open_db 返回检查点使用的 DBDB 连接，只在第一次打开时调用。
+        日志被其他进程占用时抛出 RuntimeError。
+        """
+        key = os.path.abspath(path)
+        with cls._logs_lock:
+            log = cls._logs.get(key)
+            if log is None:
+                log = cls._logs[key] = cls(key, open_db(), **kwargs)
+            log._refs += 1
+            return log
+
+    def __init__(self, path, db, checkpoint_interval=1.0,
+                 checkpoint_size=1 << 20):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_size = checkpoint_size
+        self._db = db
+        self._refs = 0
+        # 锁文件在整个生命周期内持有，日志文件本身在检查点时会被替换。
+        # 关闭时不删除锁文件，否则等待中的进程可能锁住已经删除的文件
+        self._lock_file = open(path + '.lock', 'a+b')
+        if not locks.lock(self._lock_file, locks.LOCK_EX | locks.LOCK_NB):
+            self._lock_file.close()
+            db.close()
+            raise RuntimeError('WAL is in use by another process: %s' % path)
+        self._f = open(path, 'a+b')
+        # 已提交的修改，键到值或 TOMBSTONE
+        self._overlay = {}
+        # _lock 保护覆盖层和日志写入，_sync_lock 保证同一时刻只有一个 fsync
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        # 按写入日志的总字节数计数，_base 是检查点已经去掉的字节数
+        self._written = 0
+        self._synced = 0
+        self._base = 0
+        self.fsyncs = 0
+        self._recover()
+        self._closing = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _recover(self):
+        """重放日志中完整的记录，然后立即做一次检查点
+        """
+        self._f.seek(0)
+        data = self._f.read()
+        offset = 0
+        header = self.RECORD_HEADER
+        while offset + header.size <= len(data):
+            length, crc = header.unpack_from(data, offset)
+            payload = data[offset + header.size:offset + header.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self._apply(pickle.loads(payload))
+            offset += header.size + length
+        if offset < len(data):
+            self._f.truncate(offset)
+        self._written = self._synced = offset
+        self.checkpoint()
+
+    def _apply(self, ops):
+        """把一次提交的操作写入覆盖层
+        """
+        for op in ops:
+            if op[0] == 's':
+                self._overlay[op[1]] = op[2]
+            else:
+                self._overlay[op[1]] = TOMBSTONE
+
+    def get(self, key, default=None):
+        """覆盖层中 key 的值，已删除时为 TOMBSTONE，没有修改时为 default
+        """
+        return self._overlay.get(key, default)
+
+    def view(self, tree):
+        """覆盖层的副本和 tree 最近一次提交的根，两者对应同一时刻
+
+        检查点在更新根之后才从覆盖层中去掉已合并的键，这里加锁保证副本
+        和根之间不会漏掉修改。
+        """
+        with self._lock:
+            return dict(self._overlay), tree.snapshot()
+
+    def append(self, ops):
+        """把一次提交追加到日志，返回时已经落盘
+
+        记录在锁内写入并进入覆盖层，保证覆盖层的顺序和日志一致；fsync 在
+        锁外进行，等待期间其他提交者继续追加，下一次 fsync 一并落盘。
+        """
+        data = pickle.dumps(ops, pickle.HIGHEST_PROTOCOL)
+        record = self.RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self._lock:
+            self._f.write(record)
+            self._written += len(record)
+            target = self._written
+            self._apply(ops)
+        self._sync(target)
+        if self._written - self._base >= self.checkpoint_size:
+            self._wakeup.set()
+
+    def _sync(self, target):
+        """确保日志至少落盘到 target
+        """
+        with self._sync_lock:
+            if self._synced >= target:
+                # 已经被其他提交者的 fsync 覆盖
+                return
+            with self._lock:
+                self._f.flush()
+                end = self._written
+            os.fsync(self._f.fileno())
+            self.fsyncs += 1
+            self._synced = end
+
+    def checkpoint(self):
+        """把覆盖层合并进树，然后从日志中去掉已合并的记录
+
+        合并期间提交照常进行。合并完成后，把这期间追加的记录复制到新的
+        日志文件，落盘后原子地替换旧日志。
+        """
+        with self._checkpoint_lock:
+            with self._lock:
+                frozen = dict(self._overlay)
+                end = self._written
+            if frozen:
+                with self._db.batch():
+                    for key, value in frozen.items():
+                        if value is TOMBSTONE:
+                            try:
+                                del self._db[key]
+                            except KeyError:
+                                pass
+                        else:
+                            self._db[key] = value
+            with self._sync_lock, self._lock:
+                if end == self._base and self._written == end:
+                    return
+                self._f.flush()
+                self._f.seek(end - self._base)
+                tail = self._f.read()
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+                self._f.close()
+                self._f = open(self.path, 'a+b')
+                self._base = end
+                self._synced = self._written
+                for key, value in frozen.items():
+                    if self._overlay.get(key) is value:
+                        del self._overlay[key]
+
+    def _run(self):
+        """后台检查点线程
+        """
+        while not self._closing:
+            self._wakeup.wait(self.checkpoint_interval)
+            self._wakeup.clear()
+            if not self._closing:
+                self.checkpoint()
+
+    def release(self):
+        """减少引用计数，最后一个连接关闭时做最终的检查点并删除日志
+        """
+        with self._logs_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+            del self._logs[self.path]
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join()
+        try:
+            self.checkpoint()
+        finally:
+            self._f.close()
+            self._db.close()
+            if not self._overlay:
+                os.remove(self.path)
+            locks.unlock(self._lock_file)
+            self._lock_file.close()
@@ -0,0 +1,52 @@
+'''用 render_many 批量渲染同一个模板
+
+    python bench_render_many.py [CONTEXTS]
+
+依次比较逐个调用 render 和不同进程数的 render_many，每个上下文是一个
+客户的账单。工作进程数超过 CPU 数时不会更快。
+'''
+
+import os
+import sys
+import time
+
+from templite import Templite
+
+TEMPLATE = '''<h1>Dear {{customer.name|title}},</h1>
+<table>
+{% for line in customer.lines %}<tr><td>{{line.item}}</td><td>{{line.amount}}</td></tr>
+{% endfor %}</table>
+{% if customer.overdue %}<p>Your account is overdue.</p>{% endif %}
+'''
+
+def contexts(count):
+    """按需生成上下文，不把所有客户放在内存中"""
+    for i in range(count):
+        yield {'customer': {
+            'name': 'customer %d' % i,
+            'lines': [{'item': 'item %d' % j, 'amount': i * j} for j in range(10)],
+            'overdue': i % 7 == 0,
+        }}
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    template = Templite(TEMPLATE, {'title': str.title})
+    cpus = os.cpu_count() or 1
+    print('%d contexts, %d CPUs' % (count, cpus))
+    print('%-16s %12s' % ('workload', 'renders/s'))
+
+    start = time.perf_counter()
+    for context in contexts(count):
+        template.render(context)
+    print('%-16s %12.0f' % ('render', count / (time.perf_counter() - start)))
+
+    for workers in sorted({1, 2, 4, cpus}):
+        start = time.perf_counter()
+        for _ in template.render_many(contexts(count), workers=workers):
+            pass
+        print('%-16s %12.0f' % (
+            'render_many(%d)' % workers, count / (time.perf_counter() - start)
+        ))
+
+if __name__ == '__main__':
+    main(sys.argv)
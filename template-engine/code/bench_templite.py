@@ -0,0 +1,152 @@
+'''Templite 的构造和渲染速度
+
+    python bench_templite.py [ITERATIONS]
+
+- compile：每次清空缓存后构造，相当于没有缓存
+- cached：相同的模板文本重复构造
+- from_file：按路径重复构造，文件没有修改
+- from_compiled：每次清空缓存后导入 `python -m templite compile` 生成的模块，
+  相当于冷启动时加载预编译的模板
+- render：用同一个 Templite 渲染
+- render_dots：循环中大量点表达式取字典的项
+- render_strict：同一个模板用 strict=True 编译
+- render_cached：同一个模板整个包在 `{% cache %}` 中，每次命中缓存
+- render_partials：页面由每行一个 Templite 渲染后拼接而成
+- render_include：同样的页面用 `{% include %}` 编译成一个渲染函数
+- render_optimized：render 的模板用 optimize=True 编译，除 topics 以外
+  都是构造时的常量
+
+最后用一个大的报表比较 render 和流式的 render_iter：总时间、第一块
+输出的时间和峰值内存。
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import templite
+from templite import Templite, compile_template
+
+TEMPLATE = '''
+<h1>Hello {{name|upper}}!</h1>
+{% for topic in topics %}
+    <p>You are interested in {{topic}}.</p>
+    {% if user.admin %}<p>Admin: {{user.name}}</p>{% endif %}
+{% endfor %}
+'''
+
+CONTEXT = {
+    'name': 'Ned',
+    'upper': str.upper,
+    'topics': ['Python', 'Geometry', 'Juggling'],
+    'user': {'name': 'ned', 'admin': True},
+}
+
+REPORT = '''<table>
+{% for row in rows %}<tr><td>{{row.id}}</td><td>{{row.name}}</td></tr>
+{% endfor %}</table>
+'''
+
+ROW = '<tr><td>{{row.id}}</td><td>{{row.name}}</td></tr>\n'
+PARTIALS = {'row.html': ROW}
+PAGE = '<table>{% for row in rows %}{% include "row.html" %}{% endfor %}</table>'
+
+def render_partials(context):
+    """不用 include 时的写法：每行单独渲染再拼接"""
+    row = Templite(ROW)
+    return '<table>%s</table>' % ''.join(
+        row.render({'row': r}) for r in context['rows']
+    )
+
+def report(rows):
+    """大报表的 (方式, 秒数, 第一块输出的秒数, 峰值内存)"""
+    template = Templite(REPORT)
+    context = {'rows': [{'id': i, 'name': 'name %d' % i} for i in range(rows)]}
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        for name in ['render', 'render_iter']:
+            tracemalloc.start()
+            start = time.perf_counter()
+            if name == 'render':
+                devnull.write(template.render(context))
+                first = time.perf_counter() - start
+            else:
+                chunks = template.render_iter(context)
+                devnull.write(next(chunks))
+                first = time.perf_counter() - start
+                for chunk in chunks:
+                    devnull.write(chunk)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((name, seconds, first, peak))
+    return results
+
+def rate(func, iterations):
+    """每秒调用 `func` 的次数"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 20000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'page.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(TEMPLATE)
+
+        def uncached():
+            compile_template.cache_clear()
+            Templite(TEMPLATE)
+
+        compiled = templite.compile_directory(
+            temp_dir, os.path.join(temp_dir, 'build')
+        )[0]
+
+        def cold_import():
+            templite._module_cache.clear()
+            Templite.from_compiled(compiled)
+
+        template = Templite(TEMPLATE)
+        rows = {'rows': [{'id': i, 'name': 'name %d' % i} for i in range(20)]}
+        dots = Templite(REPORT)
+        strict = Templite(REPORT, strict=True)
+        cached = Templite('{% cache key %}' + REPORT + '{% endcache %}')
+        rows['key'] = 'report'
+        page = Templite(PAGE, loader=PARTIALS.__getitem__)
+        constants = dict(CONTEXT)
+        topics = {'topics': constants.pop('topics')}
+        optimized = Templite(TEMPLATE, constants, optimize=True)
+        results = [
+            ('compile', rate(uncached, iterations // 10)),
+            ('cached', rate(lambda: Templite(TEMPLATE), iterations)),
+            ('from_file', rate(lambda: Templite.from_file(path), iterations)),
+            ('from_compiled', rate(cold_import, iterations // 10)),
+            ('render', rate(lambda: template.render(CONTEXT), iterations)),
+            ('render_dots', rate(lambda: dots.render(rows), iterations // 10)),
+            ('render_strict', rate(lambda: strict.render(rows), iterations // 10)),
+            ('render_cached', rate(lambda: cached.render(rows), iterations)),
+            ('render_partials',
+             rate(lambda: render_partials(rows), iterations // 10)),
+            ('render_include', rate(lambda: page.render(rows), iterations // 10)),
+            ('render_optimized',
+             rate(lambda: optimized.render(topics), iterations)),
+        ]
+    finally:
+        shutil.rmtree(temp_dir)
+    print('%-16s %12s' % ('workload', 'ops/s'))
+    for name, ops in results:
+        print('%-16s %12.0f' % (name, ops))
+    print()
+    print('%-14s %10s %14s %10s' % ('report', 'seconds', 'first byte ms', 'peak MB'))
+    for name, seconds, first, peak in report(iterations * 10):
+        print('%-14s %10.3f %14.3f %10.1f' % (
+            name, seconds, first * 1000, peak / 2 ** 20))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,10 +1,43 @@
 """一个简单的 Python 模板渲染器，用于 Django 语法的 nano 子级"""
 
+import argparse
+import functools
+import hashlib
+import importlib.util
+import os
+import py_compile
 import re
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# 模板中的标记：表达式、标签和注释，其余是文字内容
+TOKEN_RE = re.compile(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})")
+
+# 编译结果和模板文件内容的缓存容量
+CACHE_SIZE = 256
+
+# 流式渲染时，循环结束时累积了这么多段输出就交出一块
+FLUSH_PIECES = 64
+
+# render_many 每次交给工作进程的上下文数量
+RENDER_CHUNK = 256
+
+# 常量折叠时表示表达式的值在编译时不能确定
+_NOT_CONSTANT = object()
 
 class TempliteSyntaxError(ValueError):
-    """当模板有语法错误时引发"""
-    pass
+    """当模板有语法错误时引发，`lineno` 是出错的标记所在的行号，
+    从文件编译时 `filename` 是模板文件的路径
+    """
+    def __init__(self, msg, lineno=None, filename=None):
+        super(TempliteSyntaxError, self).__init__(msg)
+        self.lineno = lineno
+        self.filename = filename
 
 class CodeBuilder(object):
     """方便地构建源代码"""
@@ -49,42 +82,94 @@ class CodeBuilder(object):
         exec(python_source, global_namespace)
         return global_namespace
 
-class Templite(object):
-    def __init__(self, text, *contexts):
-        """一个简单的 Python 模板渲染器，用于 Django 语法的 nano 子级。
-        支持扩展变量访问结构::
-            {{var.modifer.modifier|filter|filter}}
-        循环::
-            {% for var in list %}...{% endfor %}
-        条件语句::
-            {% if var %}...{% endif %}
-        注释在井号里面::
-            {# This will be ignored #}
-        用模板本文构建 Templite， 然后对字典上下文使用 `render` 来创建
-        最终的字符串::
-            templite = Templite('''
-                <h1>Hello {{name|upper}}!</h1>
-                {% for topic in topics %}
-                    <p>You are interested in {{topic}}.</p>
-                {% endif %}
-                ''',
-                {'upper': str.upper},
-            )
-            text = templite.render({
-                'name': "Ned",
-                'topics': ['Python', 'Geometry', 'Juggling'],
-            })
-        """
-        self.context = {}
-        for context in contexts:
-            self.context.update(context)
+class TempliteCompiler(object):
+    """把模板文本编译成渲染函数
 
+    编译结果由 `compile_template` 按模板文本和选项缓存，
+    多个 Templite 共享同一个渲染函数。同一份模板还会编译成一个
+    生成器 `render_iter_function`，用于流式渲染。
+
+    `strict` 为 True 时上下文中只有字典，点表达式直接编译成下标。
+    否则每种点表达式编译成一个带内联缓存的函数，见 `dots_lookup`。
+
+    `{% include %}` 和 `{% extends %}` 在编译时展开，引用的模板由
+    `loader(name)` 读取，整个页面编译成一个渲染函数。`name` 是模板自己
+    的名字，用于错误信息和检查循环引用。`dependencies` 记录读取过的
+    模板名字和文本。
+
+    生成代码之前先用 `_optimize` 处理标记：去掉注释，合并相邻的文字。
+    `constants` 中的值在编译时已知，只由它们组成的表达式直接算成文字，
+    条件已知的 `{% if %}` 只保留会执行的分支。`optimize` 和 `strict`
+    都为 True 时，循环中不依赖循环变量、没有过滤器的表达式只在第一次
+    循环时计算。`strip_whitespace`
+    为 True 时文字中包含换行的空白都压缩成一个换行，紧跟在活动标签
+    后面的则完全去掉。
+    """
+    def __init__(self, text, strict=False, loader=None, name=None,
+                 optimize=False, constants=None, strip_whitespace=False):
+        self.strict = strict
+        self.loader = loader
+        self.optimize = optimize
+        self.constants = dict(constants or ())
+        self.strip_whitespace = strip_whitespace
         self.all_vars = set()
         self.loop_vars = set()
+        self.dependencies = {}
+        self.uses_cache = False
+        # 点表达式的各段到取值函数的名字，相同的表达式共用一个
+        self.dots_sites = {}
+        # 正在编译的标记所在的模板和行号
+        self.filename = name
+        self.lineno = 1
 
+        tokens = self._expand(name, text, {}, ())
+        # 片段缓存的键以模板文本的摘要开头，不同模板中的 {% cache %} 互不冲突
+        digest = hashlib.sha1(text.encode('utf-8'))
+        # 改变输出的选项也是键的一部分
+        digest.update(repr((strict, optimize, strip_whitespace)).encode('utf-8'))
+        for dependency in sorted(self.dependencies):
+            digest.update(self.dependencies[dependency].encode('utf-8'))
+        if self.constants:
+            # 折叠的常量也是片段内容的一部分
+            digest.update(repr(sorted(self.constants.items())).encode('utf-8'))
+        self.fragment_prefix = digest.hexdigest()[:16]
+        if self.constants:
+            # 先按原样生成一次，被删掉的分支中的语法错误也要报告
+            self._generate(tokens, stream=False)
+            self.all_vars, self.loop_vars = set(), set()
+            self.dots_sites = {}
+            self.uses_cache = False
+        tokens = self._optimize(tokens)
+        self.python_source = self._generate(tokens, stream=False)
+        self.stream_source = self._generate(tokens, stream=True)
+        self.sites_source = "".join(
+            self._site_source(name, dots)
+            for dots, name in self.dots_sites.items()
+        )
+        global_namespace = {'dots_lookup': dots_lookup}
+        exec(
+            self.sites_source + self.python_source + self.stream_source,
+            global_namespace
+        )
+        self.render_function = global_namespace['render_function']
+        self.render_iter_function = global_namespace['render_iter_function']
+
+    def _generate(self, tokens, stream):
+        """生成渲染函数的源代码
+        `stream` 为 True 时生成 `render_iter_function`：每次循环结束时
+        如果累积了至少 `FLUSH_PIECES` 段输出，就把它们连接起来交出去。
+        `{% cache %}` 块内的输出要整体放进缓存，块内不交出。
+        """
         code = CodeBuilder()
 
-        code.add_line("def render_function(context, do_dots):")
+        if stream:
+            code.add_line(
+                "def render_iter_function(context, do_dots, fragment_cache=None):"
+            )
+        else:
+            code.add_line(
+                "def render_function(context, do_dots, fragment_cache=None):"
+            )
         code.indent()
         vars_code = code.add_section()
         code.add_line("result = []")
@@ -103,16 +188,22 @@ class Templite(object):
             del buffered[:]
         
         ops_stack = []
-        tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text)
-
-        for token in tokens:
+        # 打开的 {% cache %} 块的编号和 ttl
+        cache_stack = []
+        cache_count = 0
+        # 打开的循环：(循环变量, 循环前面的代码块, 只计算一次的表达式到名字)
+        loops = []
+        self.hoisting = False
+        for self.filename, self.lineno, token in tokens:
             if token.startswith('{#'):
                 # 注释：忽略并继续
                 continue
             elif token.startswith('{{'):
                 # 要计算的表达式
                 expr = self._expr_code(token[2:-2].strip())
-                buffered.append("to_str(%s)" % expr)
+                buffered.append(self._hoist(
+                    "to_str(%s)" % expr, ops_stack, loops, code, flush_output
+                ))
             elif token.startswith('{%'):
                 # 活动标签，拆分成 words 并进一步解析
                 flush_output()
@@ -122,7 +213,10 @@ class Templite(object):
                     if len(words) != 2:
                         self._syntax_error("Don't understand if", token)
                     ops_stack.append('if')
-                    code.add_line("if %s:" % self._expr_code(words[1]))
+                    code.add_line("if %s:" % self._hoist(
+                        self._expr_code(words[1]), ops_stack, loops, code,
+                        flush_output
+                    ))
                     code.indent()
                 elif words[0] == 'for':
                     # 循环，迭代表达式结果
@@ -130,6 +224,7 @@ class Templite(object):
                         self._syntax_error("Don't understand for", token)
                     ops_stack.append('for')
                     self._variable(words[1], self.loop_vars)
+                    loops.append((words[1], code.add_section(), {}))
                     code.add_line(
                         "for c_%s in %s:" % (
                             words[1],
@@ -137,6 +232,34 @@ class Templite(object):
                         )
                     )
                     code.indent()
+                elif words[0] == 'cache':
+                    # 片段缓存，按键表达式的值缓存块的输出
+                    if len(words) not in (2, 3):
+                        self._syntax_error("Don't understand cache", token)
+                    ttl = None
+                    if len(words) == 3:
+                        try:
+                            ttl = float(words[2])
+                        except ValueError:
+                            self._syntax_error("Don't understand cache", token)
+                    self.uses_cache = True
+                    ops_stack.append('cache')
+                    n = cache_count
+                    cache_count += 1
+                    cache_stack.append((n, ttl))
+                    code.add_line("cache_key_%d = (%r, %d, %s)" % (
+                        n, self.fragment_prefix, n, self._expr_code(words[1])
+                    ))
+                    code.add_line(
+                        "fragment_%d = fragment_cache.get(cache_key_%d)" % (n, n)
+                    )
+                    code.add_line("if fragment_%d is not None:" % n)
+                    code.indent()
+                    code.add_line("append_result(fragment_%d)" % n)
+                    code.dedent()
+                    code.add_line("else:")
+                    code.indent()
+                    code.add_line("cache_start_%d = len(result)" % n)
                 elif words[0].startswith('end'):
                     # 结束上一个，弹出 ops
                     if len(words) != 1:
@@ -147,6 +270,25 @@ class Templite(object):
                     start_what = ops_stack.pop()
                     if start_what != end_what:
                         self._syntax_error("Mismatched end tag", end_what)
+                    if end_what == 'for':
+                        loops.pop()
+                    if end_what == 'cache':
+                        n, ttl = cache_stack.pop()
+                        code.add_line(
+                            "fragment_%d = ''.join(result[cache_start_%d:])" % (n, n)
+                        )
+                        code.add_line("del result[cache_start_%d:]" % n)
+                        code.add_line("append_result(fragment_%d)" % n)
+                        code.add_line(
+                            "fragment_cache.set(cache_key_%d, fragment_%d, %r)"
+                            % (n, n, ttl)
+                        )
+                    if stream and end_what == 'for' and not cache_stack:
+                        code.add_line("if len(result) >= %d:" % FLUSH_PIECES)
+                        code.indent()
+                        code.add_line("yield ''.join(result)")
+                        code.add_line("del result[:]")
+                        code.dedent()
                     code.dedent()
                 else:
                     self._syntax_error("Don't understand tag", words[0])
@@ -162,10 +304,321 @@ class Templite(object):
 
         for var_name in self.all_vars - self.loop_vars:
             vars_code.add_line("c_%s = context[%r]" % (var_name, var_name))
+        if self.hoisting:
+            vars_code.add_line("unset = object()")
+
+        if stream:
+            code.add_line("if result:")
+            code.indent()
+            code.add_line("yield ''.join(result)")
+            code.dedent()
+        else:
+            code.add_line("return ''.join(result)")
+        code.dedent()
+        assert code.indent_level == 0
+        return str(code)
+
+    def _hoist(self, expr, ops_stack, loops, code, flush_output):
+        """`optimize` 为 True 时，直接位于循环体中、不使用循环变量的表达式
+        只在第一次循环时计算，之后直接使用保存的结果，返回保存结果的
+        变量名。循环一次也不执行时不会计算。
+        只有纯粹的取值才能这样做：非 strict 模式的点表达式会调用取到的
+        值，过滤器是任意的函数，每次计算的结果可能不同，都不移出。
+        """
+        if not self.optimize or not loops or ops_stack[-1] != 'for':
+            return expr
+        if not self.strict or re.search(r"\bc_\w+\(", expr):
+            return expr
+        loop_var, section, hoisted = loops[-1]
+        if (re.match(r"c_\w+$", expr)
+                or loop_var in re.findall(r"\bc_(\w+)", expr)):
+            return expr
+        name = hoisted.get(expr)
+        if name is None:
+            name = hoisted[expr] = "hoisted_%d_%d" % (len(loops), len(hoisted))
+            section.add_line("%s = unset" % name)
+            # 先输出前面的内容，保持计算的顺序
+            flush_output()
+            code.add_line("if %s is unset:" % name)
+            code.indent()
+            code.add_line("%s = %s" % (name, expr))
+            code.dedent()
+            self.hoisting = True
+        return name
 
-        code.add_line("return ''.join(result)")
+    def _site_source(self, name, dots):
+        """生成点表达式的取值函数，每一段有自己的直接取项的类型集合"""
+        code = CodeBuilder()
+        for i in range(len(dots)):
+            code.add_line("%s_types_%d = set()" % (name, i))
+        code.add_line("def %s(value):" % name)
+        code.indent()
+        for i, dot in enumerate(dots):
+            types = "%s_types_%d" % (name, i)
+            code.add_line("if type(value) in %s:" % types)
+            code.indent()
+            code.add_line("value = value[%r]" % dot)
+            code.dedent()
+            code.add_line("else:")
+            code.indent()
+            code.add_line("value = dots_lookup(value, %r, %s)" % (dot, types))
+            code.dedent()
+            code.add_line("if callable(value):")
+            code.indent()
+            code.add_line("value = value()")
+            code.dedent()
+        code.add_line("return value")
         code.dedent()
-        self._render_function = code.get_globals()['render_function']
+        return str(code)
+
+    def module_source(self, name):
+        """生成可以导入的模块源代码，`name` 是模板的名字
+        模块定义 `all_vars`、`loop_vars`、`uses_cache`、`render_function`
+        和 `render_iter_function`，由 `Templite.from_compiled` 加载。
+        """
+        return (
+            '"""由 templite 从 %s 生成，不要修改"""\n\n'
+            'from templite import dots_lookup\n\n'
+            'all_vars = set(%r)\n'
+            'loop_vars = set(%r)\n'
+            'uses_cache = %r\n'
+            '%s\n'
+            '%s\n'
+            '%s' % (
+                name, sorted(self.all_vars), sorted(self.loop_vars),
+                self.uses_cache, self.sites_source, self.python_source,
+                self.stream_source,
+            )
+        )
+
+    def _load(self, name):
+        """通过 `loader` 读取被引用的模板"""
+        if self.loader is None:
+            self._syntax_error("No loader for template", name)
+        try:
+            text = self.loader(name)
+        except (OSError, LookupError):
+            self._syntax_error("Template not found", name)
+        self.dependencies[name] = text
+        return text
+
+    def _template_name(self, words, token):
+        """`{% include "name" %}` 和 `{% extends "name" %}` 中带引号的名字"""
+        if len(words) != 2 or not re.match(r"""(['"]).+\1$""", words[1]):
+            self._syntax_error("Don't understand %s" % words[0], token)
+        return words[1][1:-1]
+
+    def _expand(self, name, text, blocks, parents):
+        """把模板切分成 (模板名, 行号, 标记)，展开 include 和 extends
+        `blocks` 是子模板中定义的块，覆盖这里同名的块；`parents` 是
+        正在展开的模板，用于发现循环引用。
+        """
+        if name is not None and name in parents:
+            self._syntax_error("Recursive template", name)
+        parents += (name,)
+        tokens = [
+            (name, lineno, token) for lineno, token in self._tokenize(text)
+        ]
+        for self.filename, self.lineno, token in tokens:
+            if token.startswith('{%'):
+                words = token[2:-2].split()
+                if words and words[0] == 'extends':
+                    # 子模板只提供块，块外面的内容被忽略
+                    parent = self._template_name(words, token)
+                    self._collect_blocks(tokens, blocks)
+                    return self._expand(
+                        parent, self._load(parent), blocks, parents
+                    )
+                break
+        return self._inline(tokens, blocks, parents)
+
+    def _block_end(self, tokens, start):
+        """`tokens[start]` 处的 `{% block %}` 对应的 `{% endblock %}` 的位置"""
+        depth = 0
+        for i in range(start, len(tokens)):
+            self.filename, self.lineno, token = tokens[i]
+            if token.startswith('{%'):
+                words = token[2:-2].split()
+                if words[:1] == ['block']:
+                    depth += 1
+                elif words[:1] == ['endblock']:
+                    if len(words) != 1:
+                        self._syntax_error("Don't understand end", token)
+                    depth -= 1
+                    if depth == 0:
+                        return i
+        self.filename, self.lineno, token = tokens[start]
+        self._syntax_error("Unmatched action tag", 'block')
+
+    def _block_name(self, words, token):
+        if len(words) != 2 or not re.match(r"[_a-zA-Z][_a-zA-Z0-9]*$", words[1]):
+            self._syntax_error("Don't understand block", token)
+        return words[1]
+
+    def _collect_blocks(self, tokens, blocks):
+        """把 `tokens` 中定义的块（包括嵌套的块）加入 `blocks`
+        已经有的块来自更下层的子模板，不覆盖
+        """
+        defined = set()
+        for i, (self.filename, self.lineno, token) in enumerate(tokens):
+            if token.startswith('{%'):
+                words = token[2:-2].split()
+                if words[:1] == ['block']:
+                    name = self._block_name(words, token)
+                    if name in defined:
+                        self._syntax_error("Duplicate block", name)
+                    defined.add(name)
+                    blocks.setdefault(name, tokens[i + 1:self._block_end(tokens, i)])
+
+    def _inline(self, tokens, blocks, parents):
+        """展开 `tokens` 中的 include 和 block，返回新的标记列表"""
+        result = []
+        i = 0
+        while i < len(tokens):
+            self.filename, self.lineno, token = tokens[i]
+            i += 1
+            words = token[2:-2].split() if token.startswith('{%') else None
+            if not words:
+                result.append(tokens[i - 1])
+            elif words[0] == 'include':
+                name = self._template_name(words, token)
+                result.extend(self._expand(name, self._load(name), {}, parents))
+            elif words[0] == 'block':
+                name = self._block_name(words, token)
+                end = self._block_end(tokens, i - 1)
+                body = blocks.get(name, tokens[i:end])
+                i = end + 1
+                result.extend(self._inline(body, blocks, parents))
+            elif words[0] == 'extends':
+                self._syntax_error("extends must be the first tag", token)
+            elif words[0] == 'endblock':
+                if len(words) != 1:
+                    self._syntax_error("Don't understand end", token)
+                self._syntax_error("Too many ends", token)
+            else:
+                result.append(tokens[i - 1])
+        return result
+
+    def _optimize(self, tokens):
+        """生成代码之前对标记的优化，见类的说明"""
+        result = []
+        # 当前可见的循环变量，它们遮住同名的常量
+        loop_vars = []
+        # 打开的标签，条件已知为真的 if 记为 'drop'，结束标签也要去掉
+        ops = []
+        # 前一个标记是否是活动标签
+        after_tag = False
+        i = 0
+        while i < len(tokens):
+            filename, lineno, token = tokens[i]
+            i += 1
+            if token.startswith('{#'):
+                continue
+            literal_after_tag, after_tag = after_tag, token.startswith('{%')
+            if token.startswith('{{'):
+                value = self._fold(token[2:-2].strip(), loop_vars)
+                if value is _NOT_CONSTANT:
+                    result.append(tokens[i - 1])
+                    continue
+                token = str(value)
+                if token[:2] in ('{{', '{%', '{#'):
+                    # 不能作为文字的开头，保留原来的表达式
+                    result.append(tokens[i - 1])
+                    continue
+            elif token.startswith('{%'):
+                # 有语法错误的标签原样留给 `_generate` 报告
+                words = token[2:-2].split() or ['']
+                if words[0] == 'if' and len(words) == 2:
+                    value = self._fold(words[1], loop_vars)
+                    if value is _NOT_CONSTANT:
+                        ops.append('if')
+                    elif value:
+                        ops.append('drop')
+                        continue
+                    else:
+                        i = self._skip_if(tokens, i)
+                        continue
+                elif words[0] in ('if', 'for', 'cache'):
+                    ops.append(words[0])
+                    if words[0] == 'for':
+                        loop_vars.append(words[1:2])
+                elif words[0].startswith('end') and ops:
+                    start_what = ops.pop()
+                    if start_what == 'drop':
+                        continue
+                    if start_what == 'for':
+                        loop_vars.pop()
+                result.append(tokens[i - 1])
+                continue
+            elif self.strip_whitespace:
+                token = re.sub(r"\s*\n\s*", "\n", token)
+                # 标签后面的换行也去掉，标签独占一行时不留下空行
+                if literal_after_tag and token.startswith("\n"):
+                    token = token[1:]
+            if not token:
+                continue
+            # 文字，和前面的文字合并
+            if result and not result[-1][2][:2] in ('{{', '{%', '{#'):
+                result[-1] = result[-1][:2] + (result[-1][2] + token,)
+            else:
+                result.append((filename, lineno, token))
+        return result
+
+    def _skip_if(self, tokens, start):
+        """跳过条件为假的 if 的内容，返回对应的 endif 后面的位置"""
+        depth = 1
+        for i in range(start, len(tokens)):
+            token = tokens[i][2]
+            if token.startswith('{%'):
+                words = token[2:-2].split() or ['']
+                if words[0] == 'if':
+                    depth += 1
+                elif words[0] == 'endif':
+                    depth -= 1
+                    if depth == 0:
+                        return i + 1
+        return len(tokens)
+
+    def _fold(self, expr, loop_vars):
+        """在编译时计算只用到 `constants` 的表达式
+        用到其他变量、循环变量或者计算出错时返回 `_NOT_CONSTANT`，
+        留到渲染时计算。
+        """
+        pipes = expr.split("|")
+        dots = pipes[0].split(".")
+        for name in [dots[0]] + pipes[1:]:
+            if name not in self.constants or [name] in loop_vars:
+                return _NOT_CONSTANT
+        try:
+            value = self.constants[dots[0]]
+            for dot in dots[1:]:
+                if self.strict:
+                    value = value[dot]
+                else:
+                    value = dots_lookup(value, dot, set())
+                    if callable(value):
+                        value = value()
+            for func in pipes[1:]:
+                value = self.constants[func](value)
+        except Exception:
+            return _NOT_CONSTANT
+        return value
+
+    def _tokenize(self, text):
+        """依次产生 (行号, 文字内容或标记)"""
+        lineno = 1
+        pos = 0
+        for match in TOKEN_RE.finditer(text):
+            literal = text[pos:match.start()]
+            if literal:
+                yield lineno, literal
+                lineno += literal.count("\n")
+            token = match.group()
+            yield lineno, token
+            lineno += token.count("\n")
+            pos = match.end()
+        if pos < len(text):
+            yield lineno, text[pos:]
 
     def _expr_code(self, expr):
         """为 `expr` 生成 Python 表达式"""
@@ -178,8 +631,13 @@ class Templite(object):
         elif "." in expr:
             dots = expr.split(".")
             code = self._expr_code(dots[0])
-            args = ", ".join(repr(d) for d in dots[1:])
-            code = "do_dots(%s, %s)" % (code, args)
+            if self.strict:
+                code += "".join("[%r]" % d for d in dots[1:])
+            else:
+                site = self.dots_sites.setdefault(
+                    tuple(dots[1:]), "dots_%d" % len(self.dots_sites)
+                )
+                code = "%s(%s)" % (site, code)
         else:
             self._variable(expr, self.all_vars)
             code = "c_%s" % expr
@@ -187,7 +645,9 @@ class Templite(object):
 
     def _syntax_error(self, msg, thing):
         """使用 `msg` 引发语法错误，并显示 `thing`"""
-        raise TempliteSyntaxError("%s: %r" % (msg, thing))
+        raise TempliteSyntaxError(
+            "%s: %r" % (msg, thing), self.lineno, self.filename
+        )
 
     def _variable(self, name, vars_set):
         """跟踪 `name` ，被用作变量
@@ -198,6 +658,309 @@ class Templite(object):
             self._syntax_error("Not a valid name", name)
         vars_set.add(name)
 
+_SLOT_WRAPPER = type(object.__getattribute__)
+
+def dots_lookup(value, dot, item_types):
+    """点表达式中一段的完整查找，生成的代码在内联缓存没有命中时调用
+
+    先取属性，没有时取项，和 `Templite._do_dots` 相同。取属性失败要
+    引发并捕获一次异常，对字典这样的值每次都是如此，所以把直接取项的
+    类型记在 `item_types` 中，下次由生成的代码直接取项。只有实例不能
+    有自己的属性、也没有自定义属性查找的类型才会被记住，保证结果和
+    原来的规则一致。
+    """
+    try:
+        return getattr(value, dot)
+    except AttributeError:
+        cls = type(value)
+        # 用 Python 重写的 __getattribute__ 是函数，内置类型的是 slot wrapper
+        if (not hasattr(value, '__dict__')
+                and not hasattr(cls, dot)
+                and type(cls.__getattribute__) is _SLOT_WRAPPER
+                and not hasattr(cls, '__getattr__')):
+            item_types.add(cls)
+        return value[dot]
+
+class FragmentCache(object):
+    """`{% cache %}` 默认使用的进程内 LRU 缓存
+
+    最多保存 `maxsize` 个片段，过期的片段在下次读取时丢弃。其他缓存
+    只要提供同样的 `get(key)` 和 `set(key, fragment, ttl)` 就可以替换它，
+    `ttl` 是秒数，为 None 时不过期。键是元组，放进共享的缓存时需要
+    自己序列化。
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """缓存的片段，没有或者已经过期时返回 None"""
+        with self._lock:
+            entry = self._fragments.get(key)
+            if entry is None:
+                return None
+            fragment, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._fragments[key]
+                return None
+            self._fragments.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment, ttl=None):
+        """保存片段，超出容量时淘汰最久未使用的"""
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._fragments[key] = (fragment, expires)
+            self._fragments.move_to_end(key)
+            if len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def __len__(self):
+        return len(self._fragments)
+
+# 没有指定 fragment_cache 的模板共用的缓存
+default_fragment_cache = FragmentCache()
+
+class _Identity(object):
+    """按身份比较的值，保持对它的引用，id 不会被别的对象复用"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return type(other) is _Identity and other.value is self.value
+
+    def __hash__(self):
+        return id(self.value)
+
+def _freeze(value):
+    """常量在编译缓存的键中的形式
+    带上类型，`True` 和 `1` 不会相等；字典、列表和元组按内容比较，
+    其他不能散列的值按身份比较。
+    """
+    cls = type(value)
+    if cls is dict:
+        return (cls, tuple((_freeze(k), _freeze(v)) for k, v in value.items()))
+    if cls is list or cls is tuple:
+        return (cls, tuple(_freeze(item) for item in value))
+    try:
+        hash(value)
+    except TypeError:
+        return (cls, _Identity(value))
+    return (cls, value)
+
+class Constants(object):
+    """`optimize` 时构造上下文中的常量，作为 `compile_template` 的参数
+    按 `_freeze` 的结果比较和散列，迭代时产生 (名字, 值)。
+    """
+    def __init__(self, context):
+        self.items = tuple(sorted(context.items()))
+        self.key = tuple((name, _freeze(value)) for name, value in self.items)
+        self._hash = hash(self.key)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __eq__(self, other):
+        return type(other) is Constants and other.key == self.key
+
+    def __hash__(self):
+        return self._hash
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile_template(text, strict=False, loader=None, optimize=False,
+                     constants=None, strip_whitespace=False, generation=0):
+    """编译模板文本，最近使用的 `CACHE_SIZE` 个结果被缓存
+    参数都是缓存的键的一部分，必须可以散列，`constants` 是
+    `Constants`。`generation` 只用于区分缓存：被引用的模板变化后
+    递增，旧的结果不再命中，由 LRU 自然淘汰。
+    """
+    return TempliteCompiler(
+        text, strict, loader, optimize=optimize, constants=constants,
+        strip_whitespace=strip_whitespace,
+    )
+
+# 被引用的模板变化过的编译参数到 compile_template 的 generation
+_generations = {}
+
+# 模板文件的内容和已加载的预编译模块，绝对路径到 ((修改时间, 长度), 结果)
+_file_cache = {}
+_module_cache = {}
+
+def _load_cached(cache, path, load):
+    """按路径缓存 `load(path)` 的结果，文件的修改时间或长度变化时重新加载"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    result = load(path)
+    cache.pop(path, None)
+    cache[path] = (version, result)
+    if len(cache) > CACHE_SIZE:
+        del cache[next(iter(cache))]
+    return result
+
+def _read_text(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+class FileLoader(object):
+    """从 `directory` 下读取 `{% include %}` 和 `{% extends %}` 引用的模板
+    名字是相对于 `directory` 的路径。文件内容和 `Templite.from_file`
+    共用缓存，修改时间或长度变化时重新读取。目录相同的 FileLoader
+    相等，共用编译缓存。
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def __call__(self, name):
+        return _load_cached(
+            _file_cache, os.path.join(self.directory, name), _read_text
+        )
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.directory == self.directory
+
+    def __hash__(self):
+        return hash(self.directory)
+
+def _import_module(path):
+    """导入预编译的模块，和普通模块一样使用 __pycache__ 中的字节码"""
+    spec = importlib.util.spec_from_file_location(
+        "templite_compiled_%d" % len(_module_cache), path
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class Templite(object):
+    def __init__(self, text, *contexts, strict=False, fragment_cache=None,
+                 loader=None, optimize=False, strip_whitespace=False):
+        """一个简单的 Python 模板渲染器，用于 Django 语法的 nano 子级。
+        支持扩展变量访问结构::
+            {{var.modifer.modifier|filter|filter}}
+        循环::
+            {% for var in list %}...{% endfor %}
+        条件语句::
+            {% if var %}...{% endif %}
+        片段缓存，按 key 的值缓存块的输出 ttl 秒，省略 ttl 时不过期::
+            {% cache key ttl %}...{% endcache %}
+        包含其他模板，继承父模板并覆盖其中的块::
+            {% include "nav.html" %}
+            {% extends "base.html" %}{% block body %}...{% endblock %}
+        注释在井号里面::
+            {# This will be ignored #}
+        用模板本文构建 Templite， 然后对字典上下文使用 `render` 来创建
+        最终的字符串::
+            templite = Templite('''
+                <h1>Hello {{name|upper}}!</h1>
+                {% for topic in topics %}
+                    <p>You are interested in {{topic}}.</p>
+                {% endif %}
+                ''',
+                {'upper': str.upper},
+            )
+            text = templite.render({
+                'name': "Ned",
+                'topics': ['Python', 'Geometry', 'Juggling'],
+            })
+        `strict` 为 True 时，点表达式只对字典取项，`{{a.b}}` 直接编译成
+        `a['b']`，不再尝试属性，也不调用取到的值。
+        `fragment_cache` 是 `{% cache %}` 使用的缓存，默认为进程内共用的
+        `default_fragment_cache`。
+        `loader(name)` 返回被引用的模板的文本，例如 `FileLoader`。引用
+        在编译时展开，整个页面只有一个渲染函数。
+        `optimize` 为 True 时，构造时传入的上下文被当作常量：只用到它们
+        的表达式和 `{% if %}` 条件在编译时计算（过滤器也在编译时调用），
+        渲染时的上下文不能再覆盖这些名字；`strict` 模式下循环中不依赖
+        循环变量、没有过滤器的表达式只在第一次循环时计算。`strip_whitespace` 为 True 时，文字中包含换行
+        的空白压缩成一个换行，紧跟在 `{% %}` 标签后面的则完全去掉。
+        """
+        self._setup_context(contexts, fragment_cache)
+        constants = None
+        if optimize:
+            constants = Constants(self.context)
+        self._setup(self._compile(
+            text, strict, loader, optimize, constants, strip_whitespace
+        ))
+
+    @staticmethod
+    def _compile(text, strict, loader, optimize, constants, strip_whitespace):
+        """从缓存取得编译结果，被引用的模板有变化时只重新编译这一个"""
+        options = (text, strict, loader, optimize, constants, strip_whitespace)
+        generation = _generations.get(options, 0)
+        compiled = compile_template(*options, generation)
+        for name, source in compiled.dependencies.items():
+            try:
+                current = loader(name)
+            except (OSError, LookupError):
+                current = None
+            if current != source:
+                _generations.pop(options, None)
+                _generations[options] = generation + 1
+                if len(_generations) > CACHE_SIZE:
+                    del _generations[next(iter(_generations))]
+                return compile_template(*options, generation + 1)
+        return compiled
+
+    def _setup_context(self, contexts, fragment_cache):
+        self.context = {}
+        for context in contexts:
+            self.context.update(context)
+        if fragment_cache is None:
+            fragment_cache = default_fragment_cache
+        self.fragment_cache = fragment_cache
+
+    def _setup(self, compiled):
+        """使用编译结果，`TempliteCompiler` 或预编译的模块"""
+        self.all_vars = compiled.all_vars
+        self.loop_vars = compiled.loop_vars
+        self._compiled = compiled
+        self._render_function = compiled.render_function
+        # 旧版本生成的预编译模块没有流式渲染函数，也不接受片段缓存
+        self._render_iter_function = getattr(
+            compiled, 'render_iter_function', None
+        )
+        if getattr(compiled, 'uses_cache', False):
+            self._render_args = (self._do_dots, self.fragment_cache)
+        else:
+            self._render_args = (self._do_dots,)
+
+    @classmethod
+    def from_file(cls, path, *contexts, strict=False, fragment_cache=None,
+                  loader=None, optimize=False, strip_whitespace=False):
+        """从 UTF-8 编码的文件创建模板
+        文件内容按路径缓存，修改时间或长度变化时重新读取，
+        相同的文本再由 `compile_template` 的缓存得到渲染函数。
+        `loader` 默认从文件所在的目录读取被引用的模板。
+        """
+        if loader is None:
+            loader = FileLoader(os.path.dirname(os.path.abspath(path)))
+        return cls(
+            _load_cached(_file_cache, path, _read_text), *contexts,
+            strict=strict, fragment_cache=fragment_cache, loader=loader,
+            optimize=optimize, strip_whitespace=strip_whitespace
+        )
+
+    @classmethod
+    def from_compiled(cls, path, *contexts, fragment_cache=None):
+        """从 `python -m templite compile` 生成的模块创建模板
+        直接导入渲染函数，不需要解析和编译模板。模块按路径缓存，
+        文件变化时重新导入。
+        """
+        template = cls.__new__(cls)
+        template._setup_context(contexts, fragment_cache)
+        template._setup(_load_cached(_module_cache, path, _import_module))
+        return template
+
     def render(self, context=None):
         """通过应用 `context`渲染模板
         `context` 是用来渲染的值的字典
@@ -206,7 +969,66 @@ class Templite(object):
         render_context = dict(self.context)
         if context:
             render_context.update(context)
-        return self._render_function(render_context, self._do_dots)
+        return self._render_function(render_context, *self._render_args)
+
+    def render_iter(self, context=None):
+        """流式渲染，依次产生输出的各个部分
+        每次循环结束时输出累积够了就交出一块，不在内存中保存
+        完整的结果。
+        """
+        render_context = dict(self.context)
+        if context:
+            render_context.update(context)
+        if self._render_iter_function is None:
+            return iter([self._render_function(render_context, *self._render_args)])
+        return self._render_iter_function(render_context, *self._render_args)
+
+    def render_many(self, contexts, workers=None, chunksize=RENDER_CHUNK):
+        """用多个进程依次渲染 `contexts` 中的每个上下文，按顺序产生结果
+        生成的模块源代码和 `self.context` 在每个工作进程启动时发送一次，
+        之后每次只发送 `chunksize` 个上下文，同时最多有 `2 * workers`
+        组在处理，`contexts` 可以是很长的迭代器。上下文和结果都要经过
+        pickle，过滤器等必须可以序列化（不能是 lambda）。`workers`
+        默认为 CPU 数，为 1 时在当前进程中渲染。工作进程中的
+        `{% cache %}` 使用各自的 `default_fragment_cache`。
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1:
+            for context in contexts:
+                yield self.render(context)
+            return
+        contexts = iter(contexts)
+        pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(self._module_source(), self.context),
+        )
+        try:
+            pending = deque()
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = list(islice(contexts, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_render_chunk, chunk))
+                if not pending:
+                    break
+                yield from pending.popleft().result()
+        finally:
+            # 提前停止迭代时不再渲染剩下的组
+            pool.shutdown(cancel_futures=True)
+
+    def _module_source(self):
+        """发送给工作进程的模块源代码"""
+        if isinstance(self._compiled, TempliteCompiler):
+            return self._compiled.module_source('render_many')
+        return _read_text(self._compiled.__file__)
+
+    def render_to(self, file, context=None):
+        """流式渲染，把输出依次写入 `file`"""
+        write = file.write
+        for chunk in self.render_iter(context):
+            write(chunk)
 
     def _do_dots(self, value, *dots):
         """运行时计算点表达式"""
@@ -219,3 +1041,103 @@ class Templite(object):
                 value = value()
         return value
 
+# 工作进程中 render_many 使用的模板
+_worker_template = None
+
+def _init_worker(source, context):
+    """在工作进程中执行模块源代码，得到渲染函数"""
+    global _worker_template
+    module = types.ModuleType('templite_render_many')
+    exec(compile(source, '<templite render_many>', 'exec'), module.__dict__)
+    template = Templite.__new__(Templite)
+    template._setup_context([context], None)
+    template._setup(module)
+    _worker_template = template
+
+def _render_chunk(contexts):
+    render = _worker_template.render
+    return [render(context) for context in contexts]
+
+def compiled_path(name):
+    """模板的相对路径对应的预编译模块的相对路径
+    文件名中不能出现在模块名里的字符换成下划线，例如
+    `pages/index.html` 对应 `pages/index_html.py`。
+    """
+    head, tail = os.path.split(name)
+    return os.path.join(head, re.sub(r"\W", "_", tail) + ".py")
+
+def compile_directory(src, dst, strict=False, optimize=False,
+                      strip_whitespace=False):
+    """把 `src` 下的所有模板编译成 `dst` 下的模块，返回写入的文件
+    被引用的模板按相对于 `src` 的路径查找，展开在模块中。`optimize`
+    和 `strip_whitespace` 见 `TempliteCompiler`，预编译时没有常量。
+    有语法错误时引发 `TempliteSyntaxError`，其 `filename` 是出错的模板。
+    """
+    loader = FileLoader(src)
+    written = []
+    dst_path = os.path.abspath(dst)
+    for root, dirs, files in os.walk(src):
+        # 输出目录可能在 src 里面
+        dirs[:] = sorted(
+            d for d in dirs
+            if not d.startswith('.') and d != '__pycache__'
+            and os.path.abspath(os.path.join(root, d)) != dst_path
+        )
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, src)
+            try:
+                compiled = TempliteCompiler(
+                    _read_text(path), strict, loader, name, optimize=optimize,
+                    strip_whitespace=strip_whitespace,
+                )
+            except TempliteSyntaxError as exc:
+                exc.filename = os.path.join(src, exc.filename)
+                raise
+            target = os.path.join(dst, compiled_path(name))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'w', encoding='utf-8') as f:
+                f.write(compiled.module_source(name.replace(os.sep, '/')))
+            # 同时写入字节码，不依赖第一次导入时能否写 __pycache__
+            py_compile.compile(target, doraise=True)
+            written.append(target)
+    return written
+
+def main(argv=None):
+    """命令行入口::
+        python -m templite compile templates/ -o build/
+    """
+    parser = argparse.ArgumentParser(prog='python -m templite')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser(
+        'compile', help='compile templates to importable Python modules'
+    )
+    command.add_argument('src', help='directory of templates')
+    command.add_argument('-o', '--output', default='build',
+                         help='output directory (default: %(default)s)')
+    command.add_argument('--strict', action='store_true',
+                         help='contexts are dicts only, compile dots to subscripts')
+    command.add_argument('--optimize', action='store_true',
+                         help='with --strict, evaluate loop-invariant lookups '
+                              'once per loop')
+    command.add_argument('--strip-whitespace', action='store_true',
+                         help='collapse whitespace containing newlines')
+    args = parser.parse_args(argv)
+    if args.command != 'compile':
+        parser.print_help()
+        return 2
+    try:
+        written = compile_directory(
+            args.src, args.output, args.strict, args.optimize,
+            args.strip_whitespace,
+        )
+    except TempliteSyntaxError as exc:
+        print("%s:%s: %s" % (exc.filename, exc.lineno, exc), file=sys.stderr)
+        return 1
+    print("compiled %d templates into %s" % (len(written), args.output))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
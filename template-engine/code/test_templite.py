@@ -1,8 +1,16 @@
 """templite测试用例"""
 
+import io
+import os
 import re
+import shutil
+import tempfile
 import unittest
-from templite import TempliteSyntaxError, Templite
+import templite
+from templite import (
+    FileLoader, FragmentCache, TempliteSyntaxError, Templite, compile_template,
+    dots_lookup
+)
 
 
 class AnyOldObject(object):
@@ -259,5 +267,402 @@ class TempliteTest(unittest.TestCase):
         with self.assertSynErr("Don't understand end: '{% endif now %}'"):
             self.try_render("{% if x %}X{% endif now %}")
 
+    def test_syntax_error_lineno(self):
+        with self.assertRaises(TempliteSyntaxError) as cm:
+            self.try_render("one\n{# two\n #}{{ a }}\n{% if %}\n")
+        self.assertEqual(cm.exception.lineno, 4)
+
+    def test_compile_cache(self):
+        # 相同的模板文本只编译一次
+        compile_template.cache_clear()
+        first = Templite("Cached {{name}}", {'name': 'one'})
+        second = Templite("Cached {{name}}", {'name': 'two'})
+        self.assertIs(first._render_function, second._render_function)
+        self.assertEqual(compile_template.cache_info().hits, 1)
+        self.assertEqual(first.render(), "Cached one")
+        self.assertEqual(second.render(), "Cached two")
+
+    def test_from_file(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'hello.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("Hello, {{name}}!")
+        first = Templite.from_file(path, {'name': 'Ned'})
+        self.assertEqual(first.render(), "Hello, Ned!")
+        self.assertIs(
+            Templite.from_file(path)._render_function, first._render_function
+        )
+        # 文件修改后重新读取
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("Bye, {{name}}!")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(
+            Templite.from_file(path).render({'name': 'Ned'}), "Bye, Ned!"
+        )
+
+    def test_precompile(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        src = os.path.join(temp_dir, 'templates')
+        out = os.path.join(temp_dir, 'build')
+        os.makedirs(os.path.join(src, 'pages'))
+        with open(os.path.join(src, 'pages', 'list.html'), 'w') as f:
+            f.write("{% for n in nums %}{{n|twice}},{% endfor %}")
+        self.assertEqual(templite.main(['compile', src, '-o', out]), 0)
+        path = os.path.join(out, templite.compiled_path('pages/list.html'))
+        self.assertTrue(path.endswith(os.path.join('pages', 'list_html.py')))
+        self.assertTrue(os.listdir(os.path.join(out, 'pages', '__pycache__')))
+        # 加载预编译的模块不经过编译
+        misses = compile_template.cache_info().misses
+        template = Templite.from_compiled(path, {'twice': lambda n: n * 2})
+        self.assertEqual(template.render({'nums': [1, 2]}), "2,4,")
+        self.assertEqual(compile_template.cache_info().misses, misses)
+        self.assertEqual(template.all_vars, {'nums', 'twice', 'n'})
+        self.assertEqual(template.loop_vars, {'n'})
+        self.assertEqual(list(template.render_iter({'nums': [3]})), ["6,"])
+        # 工作进程直接执行预编译模块的源代码
+        template = Templite.from_compiled(path, {'twice': str})
+        self.assertEqual(
+            list(template.render_many([{'nums': [1]}, {'nums': []}], workers=2)),
+            ["1,", ""]
+        )
 
+    def test_precompile_syntax_error(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        with open(os.path.join(temp_dir, 'bad.html'), 'w') as f:
+            f.write("ok\n{% if %}")
+        with self.assertRaises(TempliteSyntaxError) as cm:
+            templite.compile_directory(temp_dir, os.path.join(temp_dir, 'out'))
+        self.assertEqual(cm.exception.filename, os.path.join(temp_dir, 'bad.html'))
+        self.assertEqual(cm.exception.lineno, 2)
+
+    def test_render_iter(self):
+        template = Templite(
+            "<ul>{% for row in rows %}<li>{% for n in row %}{{n}}{% endfor %}"
+            "</li>{% endfor %}</ul>"
+        )
+        rows = [range(10)] * 100
+        chunks = list(template.render_iter({'rows': rows}))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), template.render({'rows': rows}))
+        # 输出少的时候只有一块
+        self.assertEqual(list(template.render_iter({'rows': []})), ["<ul></ul>"])
+        self.assertEqual(list(Templite("").render_iter()), [])
+
+    def test_render_to(self):
+        template = Templite("{% for n in nums %}{{n}} {% endfor %}!")
+        out = io.StringIO()
+        template.render_to(out, {'nums': range(1000)})
+        self.assertEqual(out.getvalue(), template.render({'nums': range(1000)}))
+
+    def test_dots_lookup(self):
+        # 字典取项的方式被记住，对象仍然先取属性
+        item_types = set()
+        self.assertEqual(dots_lookup({'b': 17}, 'b', item_types), 17)
+        self.assertEqual(item_types, {dict})
+        self.assertEqual(dots_lookup(AnyOldObject(b=23), 'b', item_types), 23)
+        self.assertEqual(item_types, {dict})
+
+        class Proxy(object):
+            """用 __getattr__ 提供属性的对象"""
+            __slots__ = ()
+            def __getattr__(self, name):
+                return 'attr'
+            def __getitem__(self, name):
+                return 'item'
+        self.assertEqual(dots_lookup(Proxy(), 'x', item_types), 'attr')
+
+        class Record(dict):
+            """实例可以有自己的属性，不能记住"""
+        self.assertEqual(dots_lookup(Record(name='item'), 'name', item_types), 'item')
+        self.assertEqual(item_types, {dict})
+
+    def test_dots_inline_cache(self):
+        template = Templite("{% for x in xs %}{{x.a.b}},{% endfor %}")
+        record = type('Record', (dict,), {})(a={'b': 'item'})
+        record.a = AnyOldObject(b='attr')
+        xs = [{'a': {'b': 1}}, {'a': {'b': lambda: 2}}, AnyOldObject(a={'b': 3}),
+              record]
+        self.assertEqual(template.render({'xs': xs}), "1,2,3,attr,")
+        # 字典上的同名方法仍然优先
+        self.try_render("{{d.keys|list}}", {'d': {'a': 1}, 'list': list}, "['a']")
+
+    def test_strict(self):
+        data = {'user': {'name': 'Ned', 'items': [1, 2]}}
+        template = Templite("{{user.name}} {{user.items}}", strict=True)
+        self.assertEqual(template.render(data), "Ned [1, 2]")
+        self.assertNotEqual(
+            Templite("{{user.name}}")._render_function,
+            Templite("{{user.name}}", strict=True)._render_function
+        )
+        with self.assertRaises(TypeError):
+            Templite("{{obj.a}}", strict=True).render(
+                {'obj': AnyOldObject(a=1)}
+            )
+
+    def test_cache(self):
+        calls = []
+        def count(x):
+            calls.append(x)
+            return x
+        template = Templite(
+            "{% for u in users %}{% cache u.id %}<{{u.name|count}}>"
+            "{% endcache %}{% endfor %}!",
+            {'count': count}, fragment_cache=FragmentCache()
+        )
+        users = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+        self.assertEqual(template.render({'users': users}), "<a><b>!")
+        # 同一个键不再渲染，即使数据变了
+        users[0]['name'] = 'c'
+        self.assertEqual(template.render({'users': users}), "<a><b>!")
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual("".join(template.render_iter({'users': users})), "<a><b>!")
+        # 不同的模板不共用片段
+        self.try_render("{% cache k %}x{% endcache %}", {'k': 1}, "x")
+        self.try_render("{% cache k %}y{% endcache %}", {'k': 1}, "y")
+
+    def test_cache_ttl(self):
+        class Recorder(object):
+            """记录 set 的参数，从不命中"""
+            def __init__(self):
+                self.sets = []
+            def get(self, key):
+                return None
+            def set(self, key, fragment, ttl):
+                self.sets.append((key[2], fragment, ttl))
+        recorder = Recorder()
+        template = Templite(
+            "{% cache k 30 %}{% for n in nums %}{{n}}{% endfor %}{% endcache %}.",
+            fragment_cache=recorder
+        )
+        self.assertEqual(template.render({'k': 'x', 'nums': [1, 2]}), "12.")
+        self.assertEqual(recorder.sets, [('x', "12", 30.0)])
+
+        cache = FragmentCache(maxsize=2)
+        cache.set('a', 'A', 0)
+        self.assertIsNone(cache.get('a'))
+        cache.set('b', 'B')
+        cache.set('c', 'C')
+        cache.get('b')
+        cache.set('d', 'D')
+        self.assertEqual((cache.get('b'), cache.get('c'), len(cache)), ('B', None, 2))
+
+    def test_malformed_cache(self):
+        with self.assertSynErr("Don't understand cache: '{% cache %}'"):
+            self.try_render("{% cache %}x{% endcache %}")
+        with self.assertSynErr("Don't understand cache: '{% cache a b c %}'"):
+            self.try_render("{% cache a b c %}x{% endcache %}")
+        with self.assertSynErr("Don't understand cache: '{% cache a soon %}'"):
+            self.try_render("{% cache a soon %}x{% endcache %}")
+        with self.assertSynErr("Mismatched end tag: 'if'"):
+            self.try_render("{% cache a %}x{% endif %}")
+
+    def test_include(self):
+        partials = {
+            'row.html': "<li>{{user.name}}</li>",
+            'list.html': "<ul>{% for user in users %}{% include 'row.html' %}"
+                         "{% endfor %}</ul>",
+        }
+        template = Templite(
+            "{% include \"list.html\" %}!", loader=lambda name: partials[name]
+        )
+        users = [{'name': 'a'}, {'name': 'b'}]
+        self.assertEqual(
+            template.render({'users': users}), "<ul><li>a</li><li>b</li></ul>!"
+        )
+        self.assertEqual(template.all_vars, {'users', 'user'})
+
+    def test_extends(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        files = {
+            'base.html': "<title>{% block title %}Site{% endblock %}</title>"
+                         "{% block body %}<p>{% block content %}empty"
+                         "{% endblock %}</p>{% endblock %}",
+            'page.html': "{% extends 'base.html' %}ignored"
+                         "{% block title %}{{title}}{% endblock %}"
+                         "{% block content %}{% include 'nav.html' %}{% endblock %}",
+            'special.html': "{# 多层继承 #}{% extends 'page.html' %}"
+                            "{% block title %}Special{% endblock %}",
+            'nav.html': "nav",
+        }
+        for name, text in files.items():
+            with open(os.path.join(temp_dir, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+        page = Templite.from_file(os.path.join(temp_dir, 'page.html'))
+        self.assertEqual(
+            page.render({'title': 'Home'}), "<title>Home</title><p>nav</p>"
+        )
+        special = Templite.from_file(os.path.join(temp_dir, 'special.html'))
+        self.assertEqual(special.render(), "<title>Special</title><p>nav</p>")
+        self.assertEqual(
+            Templite.from_file(os.path.join(temp_dir, 'base.html')).render(),
+            "<title>Site</title><p>empty</p>"
+        )
+        unrelated = Templite("Unrelated {{x}}")
+        # 被引用的模板修改后重新编译
+        path = os.path.join(temp_dir, 'nav.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("menu")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(
+            Templite("{% include 'page.html' %}", {'title': 'T'},
+                     loader=FileLoader(temp_dir)).render(),
+            "<title>T</title><p>menu</p>"
+        )
+        self.assertEqual(special.render(), "<title>Special</title><p>nav</p>")
+        self.assertEqual(
+            Templite.from_file(os.path.join(temp_dir, 'special.html')).render(),
+            "<title>Special</title><p>menu</p>"
+        )
+        # 只替换过期的结果，其他模板的缓存不受影响
+        self.assertIs(
+            Templite.from_file(os.path.join(temp_dir, 'special.html'))._compiled,
+            Templite.from_file(os.path.join(temp_dir, 'special.html'))._compiled,
+        )
+        self.assertIs(Templite("Unrelated {{x}}")._compiled, unrelated._compiled)
 
+    def test_bad_include(self):
+        partials = {
+            'self.html': "{% include 'self.html' %}",
+            'bad.html': "ok\n{% if %}",
+            'late.html': "{% if x %}{% endif %}{% extends 'bad.html' %}",
+        }
+        loader = lambda name: partials[name]
+        with self.assertSynErr("No loader for template: 'x.html'"):
+            self.try_render("{% include 'x.html' %}")
+        with self.assertSynErr("Template not found: 'x.html'"):
+            Templite("{% include 'x.html' %}", loader=loader)
+        with self.assertSynErr("Don't understand include: '{% include x.html %}'"):
+            Templite("{% include x.html %}", loader=loader)
+        with self.assertSynErr("Recursive template: 'self.html'"):
+            Templite("{% include 'self.html' %}", loader=loader)
+        with self.assertSynErr("extends must be the first tag: \"{% extends 'bad.html' %}\""):
+            Templite("{% include 'late.html' %}", loader=loader)
+        with self.assertSynErr("Unmatched action tag: 'block'"):
+            Templite("{% block a %}x")
+        with self.assertSynErr("Too many ends: '{% endblock %}'"):
+            Templite("x{% endblock %}")
+        with self.assertRaises(TempliteSyntaxError) as cm:
+            Templite("{% include 'bad.html' %}", loader=loader)
+        self.assertEqual((cm.exception.filename, cm.exception.lineno), ('bad.html', 2))
+
+    def test_render_many(self):
+        template = Templite(
+            "{% for n in nums %}{{n|str}}{% endfor %}:{% cache key %}{{name|upper}}"
+            "{% endcache %}", {'upper': str.upper, 'str': str}
+        )
+        contexts = [
+            {'nums': range(i % 5), 'key': i % 3, 'name': 'n%d' % (i % 3)}
+            for i in range(50)
+        ]
+        expected = [template.render(context) for context in contexts]
+        self.assertEqual(
+            list(template.render_many(iter(contexts), workers=2, chunksize=7)),
+            expected
+        )
+        self.assertEqual(list(template.render_many(contexts, workers=1)), expected)
+        # 提前停止时关闭进程池
+        results = template.render_many(contexts, workers=2, chunksize=1)
+        self.assertEqual(next(results), expected[0])
+        results.close()
+
+    def test_render_many_errors(self):
+        template = Templite("{{a.b}}")
+        with self.assertRaises(KeyError):
+            list(template.render_many([{'a': {'b': 1}}, {'a': {}}], workers=2))
+
+    def test_optimize(self):
+        constants = {'site': {'title': 'Hi'}, 'upper': str.upper, 'debug': False}
+        template = Templite(
+            "{{site.title|upper}}{% if debug %}{{secret}}{% endif %}"
+            "{% if site %}{{name}}{% endif %}", constants, optimize=True
+        )
+        self.assertEqual(template.all_vars, {'name'})
+        self.assertIn("'HI'", template._compiled.python_source)
+        self.assertEqual(template.render({'name': 'Ned'}), "HINed")
+        # 循环变量遮住同名的常量
+        self.assertEqual(
+            Templite("{% for site in sites %}{{site}}{% endfor %}",
+                     constants, optimize=True).render({'sites': 'ab'}),
+            "ab"
+        )
+        # 常量按类型和内容缓存编译结果
+        self.assertEqual(Templite("{{x}}", {'x': True}, optimize=True).render(), "True")
+        self.assertEqual(Templite("{{x}}", {'x': 1}, optimize=True).render(), "1")
+        first = Templite("{{site.title}}", {'site': {'title': 'A'}}, optimize=True)
+        second = Templite("{{site.title}}", {'site': {'title': 'A'}}, optimize=True)
+        self.assertIs(first._compiled, second._compiled)
+        self.assertEqual(
+            Templite("{{site.title}}", {'site': {'title': 'B'}},
+                     optimize=True).render(), "B"
+        )
+        obj = AnyOldObject(title='C')
+        self.assertIs(
+            Templite("{{o.title}}", {'o': obj}, optimize=True)._compiled,
+            Templite("{{o.title}}", {'o': obj}, optimize=True)._compiled,
+        )
+        # 和片段缓存一起使用
+        template = Templite(
+            "{% cache v %}{{v|upper}}{% endcache %}", constants, optimize=True,
+            fragment_cache=FragmentCache()
+        )
+        self.assertEqual(template.render({'v': 'a'}), "A")
+        self.assertEqual(list(template.render_iter({'v': 'a'})), ["A"])
+        # 删掉的分支中的语法错误也要报告
+        with self.assertSynErr("Don't understand if: '{% if %}'"):
+            Templite("{% if debug %}{% if %}{% endif %}{% endif %}",
+                     constants, optimize=True)
+
+    def test_literal_coalescing(self):
+        template = Templite("a{# x #}b\n  \n  {% if x %}c{% endif %}")
+        self.assertIn("'ab\\n  \\n  '", template._compiled.python_source)
+        template = Templite(
+            "<ul>\n    {% for n in nums %}\n    <li>{{n}}</li>\n    {% endfor %}\n</ul>",
+            strip_whitespace=True
+        )
+        self.assertEqual(
+            template.render({'nums': [1, 2]}), "<ul>\n<li>1</li>\n<li>2</li>\n</ul>"
+        )
+        # 选项不同的模板不共用缓存的片段
+        text = "{% cache k %}a\n  b{% endcache %}"
+        self.assertEqual(Templite(text, strip_whitespace=True).render({'k': 1}), "a\nb")
+        self.assertEqual(Templite(text).render({'k': 1}), "a\n  b")
+
+    def test_hoist(self):
+        template = Templite(
+            "{% for n in nums %}{{user.name}}{{n}}{% if n %}{{user.name|upper}}"
+            "{% endif %}{% endfor %}", {'upper': str.upper},
+            strict=True, optimize=True
+        )
+        self.assertIn("hoisted_", template._compiled.python_source)
+        self.assertEqual(
+            template.render({'nums': [0, 1], 'user': {'name': 'ned'}}),
+            "ned0ned1NED"
+        )
+        # 循环不执行时不计算
+        template = Templite(
+            "{% for x in xs %}{{obj.missing}}{% endfor %}done",
+            strict=True, optimize=True
+        )
+        self.assertEqual(template.render({'xs': [], 'obj': {}}), "done")
+        # 会调用取到的值或者过滤器的表达式不移出循环
+        class Counter(object):
+            def __init__(self):
+                self.count = 0
+            def next(self):
+                self.count += 1
+                return self.count
+        for text in ["{{c.next}},", "{{c|next}},"]:
+            template = Templite(
+                "{% for x in xs %}" + text + "{% endfor %}",
+                {'next': lambda c: c.next()}, optimize=True
+            )
+            self.assertNotIn("hoisted_", template._compiled.python_source)
+            self.assertEqual(
+                template.render({'xs': [1, 2, 3], 'c': Counter()}), "1,2,3,"
+            )